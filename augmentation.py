@@ -0,0 +1,134 @@
+'''
+Vectorized on-the-fly augmentation of uint8 MNIST batches
+
+Random shifts, small rotations and elastic distortions are combined into one sampling grid
+per image and the whole batch is resampled with a single bilinear gather, so the cost
+is a handful of numpy operations per batch rather than a Python loop per image. The
+elastic field is random displacements on a coarse grid of control points upsampled
+bilinearly to the image size, a cheap stand-in for Gaussian smoothed per pixel noise.
+
+Usage:
+    from augmentation import BatchAugmenter
+    from mnist_input_pipeline import InputPipeline
+    NumberRecognition(input_pipeline=InputPipeline(augment=BatchAugmenter()))
+'''
+import threading
+
+import numpy as np
+
+
+def upsample_bilinear(grid, size):
+    '''
+    :param grid: (batch, rows, cols) array of values at evenly spaced control points
+    :param size: side of the square output
+    :return: (batch, size, size) array interpolated between the control points
+    '''
+    rows, cols = grid.shape[1:]
+    y = np.linspace(0., rows - 1., size, dtype=np.float32)
+    x = np.linspace(0., cols - 1., size, dtype=np.float32)
+    y0 = np.minimum(np.floor(y).astype(np.int64), rows - 2)
+    x0 = np.minimum(np.floor(x).astype(np.int64), cols - 2)
+    wy = (y - y0)[:, np.newaxis]
+    wx = (x - x0)[np.newaxis, :]
+    top = grid[:, y0][:, :, x0] * (1. - wx) + grid[:, y0][:, :, x0 + 1] * wx
+    bottom = grid[:, y0 + 1][:, :, x0] * (1. - wx) + grid[:, y0 + 1][:, :, x0 + 1] * wx
+    return top * (1. - wy) + bottom * wy
+
+
+def bilinear_sample(images, rows, cols):
+    '''
+    resample every image of a batch at its own fractional coordinates, pixels outside
+    the image are 0
+
+    :param images: (batch, height, width) array
+    :param rows: (batch, height, width) source row of every output pixel
+    :param cols: (batch, height, width) source column of every output pixel
+    :return: (batch, height, width) float32 array
+    '''
+    batch_size, height, width = images.shape
+    #a zero border, source coordinates outside the image are clipped onto it
+    padded = np.zeros((batch_size, height + 2, width + 2), dtype=np.float32)
+    padded[:, 1:-1, 1:-1] = images
+    rows = np.clip(rows + 1., 0., height + 1.)
+    cols = np.clip(cols + 1., 0., width + 1.)
+    row0 = np.minimum(np.floor(rows).astype(np.int64), height)
+    col0 = np.minimum(np.floor(cols).astype(np.int64), width)
+    wy = (rows - row0).astype(np.float32)
+    wx = (cols - col0).astype(np.float32)
+    flat = padded.ravel()
+    index = np.arange(batch_size)[:, np.newaxis, np.newaxis] * (height + 2) * (width + 2) + row0 * (width + 2) + col0
+    top = flat[index] * (1. - wx) + flat[index + 1] * wx
+    bottom = flat[index + width + 2] * (1. - wx) + flat[index + width + 3] * wx
+    return top * (1. - wy) + bottom * wy
+
+
+class BatchAugmenter:
+    '''
+    Applies a random shift, rotation and elastic distortion to every image of a uint8 batch
+    Safe to call from the worker threads of mnist_input_pipeline.InputPipeline, every
+    thread draws from its own random generator
+    '''
+    def __init__(self, max_shift=2., max_rotation=15., elastic_alpha=1.5, elastic_grid=4, seed=None):
+        '''
+
+        :param max_shift: largest shift in pixels along each axis
+        :param max_rotation: largest rotation in degrees either way
+        :param elastic_alpha: standard deviation in pixels of the elastic displacement at the
+            control points, 0 disables the elastic distortion
+        :param elastic_grid: number of control points of the elastic field along each axis
+        :param seed: seed of the random generators, unseeded if None
+        '''
+        if elastic_grid < 2:
+            raise ValueError('elastic_grid needs at least 2 control points, got {}'.format(elastic_grid))
+        self._max_shift = max_shift
+        self._max_rotation = np.deg2rad(max_rotation)
+        self._elastic_alpha = elastic_alpha
+        self._elastic_grid = elastic_grid
+        self._seed_sequence = np.random.SeedSequence(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        return
+
+    def _rng(self):
+        rng = getattr(self._local, 'rng', None)
+        if rng is None:
+            with self._lock:
+                rng = np.random.default_rng(self._seed_sequence.spawn(1)[0])
+            self._local.rng = rng
+        return rng
+
+    def __call__(self, images):
+        '''
+        :param images: uint8 images of shape (N, 28, 28) or (N, 28, 28, 1)
+        :return: augmented uint8 images of the same shape
+        '''
+        shape = images.shape
+        images = np.reshape(images, shape[:3])
+        batch_size, height, width = images.shape
+        rng = self._rng()
+
+        #output pixel coordinates relative to the image center
+        center_y = (height - 1) / 2.
+        center_x = (width - 1) / 2.
+        y = np.arange(height, dtype=np.float32)[np.newaxis, :, np.newaxis] - center_y
+        x = np.arange(width, dtype=np.float32)[np.newaxis, np.newaxis, :] - center_x
+
+        angle = rng.uniform(-self._max_rotation, self._max_rotation, batch_size).astype(np.float32)
+        shift = rng.uniform(-self._max_shift, self._max_shift, (2, batch_size)).astype(np.float32)
+        cos = np.cos(angle)[:, np.newaxis, np.newaxis]
+        sin = np.sin(angle)[:, np.newaxis, np.newaxis]
+        shift_y = shift[0][:, np.newaxis, np.newaxis]
+        shift_x = shift[1][:, np.newaxis, np.newaxis]
+        #inverse mapping, the source of every output pixel is the pixel rotated and shifted back
+        rows = cos * (y - shift_y) - sin * (x - shift_x) + center_y
+        cols = sin * (y - shift_y) + cos * (x - shift_x) + center_x
+
+        if self._elastic_alpha > 0:
+            control = rng.normal(0., self._elastic_alpha,
+                                 (2 * batch_size, self._elastic_grid, self._elastic_grid)).astype(np.float32)
+            displacement = upsample_bilinear(control, height)
+            rows = rows + displacement[:batch_size]
+            cols = cols + displacement[batch_size:]
+
+        augmented = bilinear_sample(images, rows, cols)
+        return np.clip(np.rint(augmented), 0, 255).astype(np.uint8).reshape(shape)
@@ -0,0 +1,91 @@
+'''
+Throughput of augmentation.BatchAugmenter against the CNN training rate on CPU
+
+Augmentation throughput is measured on random uint8 batches, in one thread and split over
+the worker threads the input pipeline would use. With --compare-training, NumberRecognition
+is also trained for one epoch on synthetic MNIST through an InputPipeline with and without
+augmentation, the two training rates match when augmentation keeps up with training.
+
+Usage:
+    python benchmarks/bench_augmentation.py
+    python benchmarks/bench_augmentation.py --workers 4 --compare-training
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from augmentation import BatchAugmenter
+
+
+def augment_images_per_sec(augmenter, batches, workers):
+    '''
+    :return: images augmented per second, over all batches spread on the worker threads
+    '''
+    start = time.perf_counter()
+    if workers == 1:
+        for batch in batches:
+            augmenter(batch)
+    else:
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(augmenter, batches))
+    return sum(len(batch) for batch in batches) / (time.perf_counter() - start)
+
+
+def training_samples_per_sec(augment, workers, num_train):
+    '''
+    :return: samples per second of one NumberRecognition epoch on synthetic MNIST
+    '''
+    from mnist_input_pipeline import InputPipeline
+    from mnist_number_recognition import NumberRecognition
+    from run_benchmarks import synthetic_mnist
+    work_dir = tempfile.mkdtemp()
+    try:
+        data_path = synthetic_mnist(work_dir, num_train, 100)
+        model = NumberRecognition(epochs=1, data_path=data_path, cache_dir=work_dir,
+                                  input_pipeline=InputPipeline(workers=workers,
+                                                               augment=BatchAugmenter() if augment else None))
+        model.build()
+        start = time.perf_counter()
+        model.train_model()
+        return num_train / (time.perf_counter() - start)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 128, 512])
+    parser.add_argument('--num-images', type=int, default=60000, help='images augmented per measurement')
+    parser.add_argument('--workers', type=int, default=4, help='worker threads of the input pipeline')
+    parser.add_argument('--compare-training', action='store_true',
+                        help='also measure the NumberRecognition training rate with and without augmentation')
+    parser.add_argument('--train-size', type=int, default=10000, help='synthetic training images for --compare-training')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    augmenter = BatchAugmenter(seed=0)
+    print('{:>6} {:>8} {:>14}'.format('batch', 'threads', 'images/sec'))
+    for batch_size in args.batch_sizes:
+        images = rng.integers(0, 256, (batch_size, 28, 28, 1), dtype=np.uint8)
+        batches = [images] * max(1, args.num_images // batch_size)
+        for workers in sorted({1, args.workers}):
+            print('{:>6} {:>8} {:>14.0f}'.format(batch_size, workers,
+                                                 augment_images_per_sec(augmenter, batches, workers)))
+
+    if args.compare_training:
+        print('{:<24} {:>14}'.format('training', 'samples/sec'))
+        for augment in [False, True]:
+            print('{:<24} {:>14.0f}'.format('augmented' if augment else 'not augmented',
+                                            training_samples_per_sec(augment, args.workers, args.train_size)))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+'''
+Time-to-accuracy of SharedVisionModel with uniformly drawn pairs against hard negative mining
+
+Both runs train on real MNIST, synthetic images carry no signal to measure accuracy on,
+with the same seed in their own process. Reported for each run are the validation match
+accuracy after every epoch, and the epoch and wall clock seconds at which it first
+reached the target accuracy, mining time included.
+
+Usage:
+    python benchmarks/bench_hard_negative_mining.py --epochs 6 --target 0.97
+    python benchmarks/bench_hard_negative_mining.py --data-path mnist.npz --hard-fraction 0.3
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import get_context
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def match_accuracy_key(logs):
+    '''
+    :return: key of the validation accuracy of the Dot output, its layer name varies across keras versions
+    '''
+    keys = [key for key in logs if key.startswith('val_dot') and 'acc' in key]
+    if not keys:
+        raise KeyError('No validation match accuracy in the training logs: {}'.format(sorted(logs)))
+    return keys[0]
+
+
+def train_run(mine, args):
+    '''
+    train one model in a fresh process
+
+    :param mine: train with a HardNegativeMiner
+    :return: dictionary of per epoch accuracy and seconds, and mining seconds
+    '''
+    import random
+    import keras
+    import instrumentation
+    from hard_negative_mining import HardNegativeMiner
+    from mnist_shared_vision_model import SharedVisionModel
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    instrumentation.enable()
+
+    miner = None
+    if mine:
+        miner = HardNegativeMiner(hard_fraction=args.hard_fraction, refresh_every=args.refresh_every,
+                                  num_anchors=args.num_anchors)
+    model = SharedVisionModel(epochs=args.epochs, train_size=args.train_size, test_size=args.test_size,
+                              data_path=args.data_path, cache_dir=args.cache_dir, hard_negative_miner=miner)
+    model.build()
+    accuracies = []
+    elapsed = []
+    start = time.perf_counter()
+
+    def on_epoch_end(epoch, logs):
+        accuracies.append(float(logs[match_accuracy_key(logs)]))
+        elapsed.append(time.perf_counter() - start)
+        return
+    #runs before the mining callback, the mining after every epoch counts towards the next one
+    model.train_model(callbacks=[keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)])
+    timers = instrumentation.report()['timers']
+    mining_seconds = sum(timers.get(name, {'seconds': 0.})['seconds']
+                         for name in ['hard_negative_mining.embed', 'hard_negative_mining.search'])
+    return {'val_match_accuracy': accuracies, 'seconds': elapsed, 'mining_seconds': mining_seconds}
+
+
+def time_to_accuracy(run, target):
+    '''
+    :return: first epoch, counted from 1, and seconds at which the run reached the target, or None
+    '''
+    for epoch, (accuracy, seconds) in enumerate(zip(run['val_match_accuracy'], run['seconds']), 1):
+        if accuracy >= target:
+            return {'epoch': epoch, 'seconds': seconds}
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--epochs', type=int, default=6)
+    parser.add_argument('--target', type=float, default=0.97, help='validation match accuracy to reach')
+    parser.add_argument('--train-size', type=int, default=60000, help='training pairs per epoch')
+    parser.add_argument('--test-size', type=int, default=18000)
+    parser.add_argument('--hard-fraction', type=float, default=0.5)
+    parser.add_argument('--refresh-every', type=int, default=1)
+    parser.add_argument('--num-anchors', type=int, default=10000)
+    parser.add_argument('--data-path', default=None, help='local mnist.npz file, downloaded through keras if not given')
+    parser.add_argument('--cache-dir', default=None, help='directory of the preprocessed dataset cache')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='path to write the JSON results to')
+    args = parser.parse_args()
+
+    results = {}
+    context = get_context('spawn')
+    for name, mine in [('uniform', False), ('hard_negatives', True)]:
+        print('Training with {} pairs...'.format(name))
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(train_run, (mine, args))
+        results[name]['time_to_accuracy'] = time_to_accuracy(results[name], args.target)
+
+    print('{:<16} {:>10} {:>10} {:>14} {:>14}'.format('pairs', 'epochs', 'seconds', 'mining seconds',
+                                                     'final accuracy'))
+    for name, run in results.items():
+        reached = run['time_to_accuracy']
+        print('{:<16} {:>10} {:>10} {:>14.1f} {:>14.4f}'.format(name,
+                                                                reached['epoch'] if reached else '-',
+                                                                '{:.1f}'.format(reached['seconds']) if reached else '-',
+                                                                run['mining_seconds'],
+                                                                run['val_match_accuracy'][-1]))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results saved to ' + args.output)
+    return
+
+
+if __name__ == '__main__':
+    main()
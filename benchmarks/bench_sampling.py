@@ -0,0 +1,62 @@
+'''
+Micro-benchmark of the text_sampling samplers against the original per-row
+multinomial sampler of TextGeneration._sample
+
+Usage:
+    python benchmarks/bench_sampling.py
+'''
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from text_sampling import Sampler
+
+
+def legacy_sample(preds, temperature=1.0):
+    # original TextGeneration._sample, one row at a time with the global RNG
+    preds = np.asarray(preds).astype('float64')
+    preds = np.log(preds) / temperature
+    exp_preds = np.exp(preds)
+    preds = exp_preds / np.sum(exp_preds)
+    probas = np.random.multinomial(1, preds, 1)
+    return np.argmax(probas)
+
+
+def random_preds(batch_size, num_chars, rng):
+    '''
+    softmax outputs shaped like the Nietzsche model, num_chars is its vocabulary size
+    '''
+    logits = rng.normal(scale=3., size=(batch_size, num_chars))
+    preds = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return (preds / np.sum(preds, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main(num_chars=57, batch_sizes=(1, 4, 64, 1024), repeat=5):
+    rng = np.random.default_rng(0)
+    samplers = \
+        {
+        'cumsum': Sampler('cumsum', seed=0),
+        'gumbel': Sampler('gumbel', seed=0),
+        'cumsum top_k=5': Sampler('cumsum', top_k=5, seed=0),
+        'cumsum top_p=0.9': Sampler('cumsum', top_p=0.9, seed=0),
+        }
+    print('{:>6} {:>18} {:>14} {:>10}'.format('batch', 'sampler', 'usec/batch', 'speedup'))
+    for batch_size in batch_sizes:
+        preds = random_preds(batch_size, num_chars, rng)
+        temperatures = np.full(batch_size, 0.5)
+        number = max(1, 2000 // batch_size)
+        legacy = min(timeit.repeat(lambda: [legacy_sample(row, 0.5) for row in preds],
+                                   number=number, repeat=repeat)) / number
+        print('{:>6} {:>18} {:>14.1f} {:>10}'.format(batch_size, 'legacy', legacy*1e6, '1.0x'))
+        for name, sampler in samplers.items():
+            elapsed = min(timeit.repeat(lambda: sampler.sample(preds, temperatures),
+                                        number=number, repeat=repeat)) / number
+            print('{:>6} {:>18} {:>14.1f} {:>9.1f}x'.format(batch_size, name, elapsed*1e6, legacy/elapsed))
+    return
+
+
+if __name__ == '__main__':
+    main()
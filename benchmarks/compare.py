@@ -0,0 +1,62 @@
+'''
+Compare two benchmark result files written by benchmarks/run_benchmarks.py
+and flag metrics that regressed by more than a threshold
+
+Usage:
+    python benchmarks/compare.py baseline.json results.json --threshold 0.1
+'''
+import argparse
+import json
+import sys
+
+
+def flatten(results, prefix=''):
+    '''
+    :return: dictionary of dotted metric path to value for every numeric leaf
+    '''
+    flat = {}
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)):
+            flat[path] = value
+    return flat
+
+
+def higher_is_better(metric):
+    return 'per_sec' in metric
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', help='results of the reference commit')
+    parser.add_argument('candidate', help='results of the commit under test')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline.get('sizes') != candidate.get('sizes'):
+        print('Warning: comparing {} results against {} results'.format(baseline.get('sizes'), candidate.get('sizes')))
+
+    baseline_metrics = flatten(baseline['results'])
+    candidate_metrics = flatten(candidate['results'])
+    regressions = []
+    print('{:<70} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'candidate', 'change'))
+    for metric in sorted(set(baseline_metrics) & set(candidate_metrics)):
+        old = baseline_metrics[metric]
+        new = candidate_metrics[metric]
+        change = (new - old) / old if old else 0.
+        regressed = -change > args.threshold if higher_is_better(metric) else change > args.threshold
+        if regressed:
+            regressions.append(metric)
+        print('{:<70} {:>12.4g} {:>12.4g} {:>+7.1%}{}'.format(metric, old, new, change, ' REGRESSION' if regressed else ''))
+    print('{} regression(s) above {:.0%}'.format(len(regressions), args.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
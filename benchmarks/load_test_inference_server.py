@@ -0,0 +1,99 @@
+'''
+Load test a running inference_server.py with concurrent clients
+
+Every client keeps one connection open and sends requests back to back, so the
+concurrency is the number of requests the server can batch together.
+
+Usage:
+    python benchmarks/load_test_inference_server.py --endpoint /digits --concurrency 64 --requests 2000
+'''
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+def make_payload(endpoint, rng, images_per_request, length):
+    if endpoint == '/digits':
+        return {'images': rng.integers(0, 256, (images_per_request, 28, 28)).tolist()}
+    if endpoint == '/pairs':
+        return {'images_a': rng.integers(0, 256, (images_per_request, 28, 28)).tolist(),
+                'images_b': rng.integers(0, 256, (images_per_request, 28, 28)).tolist()}
+    return {'seed': 'he who has a why to live can bear almost any how',
+            'temperature': float(rng.choice([0.2, 0.5, 1.0, 1.2])),
+            'length': length}
+
+
+async def request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                 .format(method, path, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    status = await reader.readline()
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            content_length = int(value.strip())
+    response = json.loads((await reader.readexactly(content_length)).decode('utf-8'))
+    return status.decode('latin-1').split(' ', 2)[1], response
+
+
+async def client(args, num_requests, latencies, errors, seed):
+    rng = np.random.default_rng(seed)
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    payloads = [make_payload(args.endpoint, rng, args.images_per_request, args.length) for _ in range(min(num_requests, 8))]
+    for i in range(num_requests):
+        start = time.perf_counter()
+        status, _ = await request(reader, writer, 'POST', args.endpoint, payloads[i % len(payloads)])
+        latencies.append((time.perf_counter() - start) * 1000.)
+        if status != '200':
+            errors.append(status)
+    writer.close()
+    return
+
+
+async def run(args):
+    latencies = []
+    errors = []
+    per_client = [args.requests // args.concurrency + (i < args.requests % args.concurrency)
+                  for i in range(args.concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, n, latencies, errors, seed) for seed, n in enumerate(per_client) if n])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, metrics = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+
+    print('{} requests to {} in {:.2f}s with concurrency {}'.format(len(latencies), args.endpoint, elapsed,
+                                                                  args.concurrency))
+    print('throughput: {:.1f} requests/sec'.format(len(latencies) / elapsed))
+    print('client latency p50: {:.1f} ms, p99: {:.1f} ms'.format(np.percentile(latencies, 50),
+                                                                 np.percentile(latencies, 99)))
+    print('errors: {}'.format(len(errors)))
+    print('server metrics: {}'.format(json.dumps(metrics.get(args.endpoint, metrics), indent=2)))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint', default='/digits', choices=['/digits', '/pairs', '/generate'])
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--images-per-request', type=int, default=1)
+    parser.add_argument('--length', type=int, default=100, help='characters per /generate request')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+    return
+
+
+if __name__ == '__main__':
+    main()
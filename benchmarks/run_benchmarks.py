@@ -0,0 +1,299 @@
+'''
+Training and inference throughput benchmarks for the three models
+
+Every model is benchmarked on synthetic data shaped like MNIST or like the
+Nietzsche corpus, so nothing is downloaded, in its own process so peak RSS is
+measured per model. Dataset build times are measured with a cold and a warm
+dataset cache. text_generation_bpe repeats the text generation benchmark with the
+BPE token model, its train_corpus_chars_per_sec, generate_chars_per_sec, batch_input_bytes
+and peak_rss_mb compare directly against the character model. Results are written as
+JSON to be compared across commits with benchmarks/compare.py
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --quick --models number_recognition text_generation
+'''
+import argparse
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import instrumentation
+
+SIZES = \
+    {
+    'full': {'mnist_train': 60000, 'mnist_test': 10000, 'pairs_train': 60000, 'pairs_test': 18000,
+             'corpus_chars': 600000, 'generate_chars': 200, 'predict_repeat': 50},
+    'quick': {'mnist_train': 2000, 'mnist_test': 500, 'pairs_train': 2000, 'pairs_test': 500,
+              'corpus_chars': 20000, 'generate_chars': 20, 'predict_repeat': 10},
+    }
+PREDICT_BATCH_SIZES = (1, 32, 256)
+#size of the lowercased Nietzsche vocabulary
+CORPUS_VOCAB = ' !"\'(),-.0123456789:;=?[]_abcdefghijklmnopqrstuvwxyz\n\xe4\xe6\xe9\xeb'
+
+
+def synthetic_mnist(work_dir, num_train, num_test, seed=0):
+    '''
+    write random uint8 images and digit labels shaped like the keras mnist.npz file
+
+    :return: path to the written file
+    '''
+    rng = np.random.default_rng(seed)
+    path = os.path.join(work_dir, 'mnist.npz')
+    np.savez(path,
+             x_train=rng.integers(0, 256, (num_train, 28, 28), dtype=np.uint8),
+             y_train=rng.integers(0, 10, num_train, dtype=np.uint8),
+             x_test=rng.integers(0, 256, (num_test, 28, 28), dtype=np.uint8),
+             y_test=rng.integers(0, 10, num_test, dtype=np.uint8))
+    return path
+
+
+def synthetic_corpus(work_dir, num_chars, seed=0):
+    '''
+    write random text over a vocabulary the size of the Nietzsche corpus, with a skewed
+    character distribution
+
+    :return: path to the written file
+    '''
+    rng = np.random.default_rng(seed)
+    weights = 1. / np.arange(1, len(CORPUS_VOCAB) + 1)
+    chars = rng.choice(list(CORPUS_VOCAB), size=num_chars, p=weights / weights.sum())
+    path = os.path.join(work_dir, 'corpus.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(''.join(chars))
+    return path
+
+
+def with_timings(cls, method_names):
+    '''
+    subclass a model class so the given methods record their run time
+
+    :param cls: model class
+    :param method_names: names of the methods to time
+    :return: the subclass, and the dictionary the timings in seconds are written to
+    '''
+    timings = {}
+
+    def timed(name):
+        original = getattr(cls, name)
+
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            result = original(self, *args, **kwargs)
+            timings[name] = timings.get(name, 0.) + time.perf_counter() - start
+            return result
+        return wrapper
+
+    attributes = dict((name, timed(name)) for name in method_names)
+    return type('Benchmark' + cls.__name__, (cls,), attributes), timings
+
+
+def predict_latency(model, make_inputs, repeat):
+    '''
+    time predict_on_batch at several batch sizes
+
+    :param model: keras model
+    :param make_inputs: function of the batch size returning model inputs
+    :param repeat: number of timed calls per batch size
+    :return: dictionary of p50 and p99 latency in ms per batch size
+    '''
+    latencies = {}
+    for batch_size in PREDICT_BATCH_SIZES:
+        inputs = make_inputs(batch_size)
+        model.predict_on_batch(inputs)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.predict_on_batch(inputs)
+            times.append((time.perf_counter() - start) * 1000.)
+        latencies[str(batch_size)] = {'p50_ms': float(np.percentile(times, 50)),
+                                      'p99_ms': float(np.percentile(times, 99))}
+    return latencies
+
+
+def dataset_build_seconds(build, timings, method_names):
+    '''
+    build a model twice, with a cold and then a warm dataset cache
+
+    :param build: function constructing the model
+    :param timings: timings dictionary of the class returned by with_timings
+    :param method_names: timed methods that build the dataset
+    :return: the second model, and the cold and warm dataset build times in seconds
+    '''
+    build()
+    cold = sum(timings[name] for name in method_names)
+    timings.clear()
+    model = build()
+    warm = sum(timings[name] for name in method_names)
+    return model, {'cold': cold, 'warm': warm}
+
+
+def built(model):
+    '''
+    :return: the model after building its data set and model, which are otherwise built on first use
+    '''
+    model.build()
+    return model
+
+
+def time_training(train, num_samples):
+    '''
+    :return: training samples per second of one call to train
+    '''
+    start = time.perf_counter()
+    train()
+    return num_samples / (time.perf_counter() - start)
+
+
+def bench_number_recognition(sizes, work_dir):
+    from mnist_number_recognition import NumberRecognition
+    data_path = synthetic_mnist(work_dir, sizes['mnist_train'], sizes['mnist_test'])
+    cls, timings = with_timings(NumberRecognition, ['_create_data_set', '_define_model'])
+    model, build_seconds = dataset_build_seconds(lambda: built(cls(epochs=1, data_path=data_path,
+                                                                   cache_dir=work_dir)),
+                                                 timings, ['_create_data_set'])
+    images = np.load(data_path)['x_test'].reshape((-1, 28, 28, 1))
+    return {'dataset_build_seconds': build_seconds,
+            'model_build_seconds': timings['_define_model'],
+            'train_samples_per_sec': time_training(model.train_model, sizes['mnist_train']),
+            'predict_latency': predict_latency(model._classification_model,
+                                               lambda batch_size: images[:batch_size],
+                                               sizes['predict_repeat']),
+            'peak_rss_mb': instrumentation.peak_rss_mb()}
+
+
+def bench_shared_vision_model(sizes, work_dir):
+    from mnist_shared_vision_model import SharedVisionModel
+    data_path = synthetic_mnist(work_dir, sizes['mnist_train'], sizes['mnist_test'])
+    cls, timings = with_timings(SharedVisionModel, ['_create_data_set', '_define_model'])
+    model, build_seconds = dataset_build_seconds(lambda: built(cls(epochs=1, train_size=sizes['pairs_train'],
+                                                                   test_size=sizes['pairs_test'],
+                                                                   data_path=data_path, cache_dir=work_dir)),
+                                                 timings, ['_create_data_set'])
+    images = np.load(data_path)['x_test'].reshape((-1, 28, 28, 1))
+    return {'dataset_build_seconds': build_seconds,
+            'model_build_seconds': timings['_define_model'],
+            'train_samples_per_sec': time_training(model.train_model, sizes['pairs_train']),
+            'predict_latency': predict_latency(model._classification_model,
+                                               lambda batch_size: [images[:batch_size], images[-batch_size:]],
+                                               sizes['predict_repeat']),
+            'peak_rss_mb': instrumentation.peak_rss_mb()}
+
+
+def bench_text_generation(sizes, work_dir, tokenizer_vocab_size=None, streaming=False):
+    '''
+    :param tokenizer_vocab_size: benchmark the BPE token model with this vocabulary size
+        instead of the character model
+    :param streaming: benchmark the out-of-core corpus mode of the character model
+    '''
+    from nietzsche_lstm_text_generation import TextGeneration
+    data_path = synthetic_corpus(work_dir, sizes['corpus_chars'])
+    dataset_methods = ['_load_data', '_generate_char_index', '_generate_training_data']
+    cls, timings = with_timings(TextGeneration, dataset_methods + ['_define_model'])
+    model, build_seconds = dataset_build_seconds(lambda: built(cls(epochs=1, data_path=data_path,
+                                                                   cache_dir=work_dir,
+                                                                   tokenizer_vocab_size=tokenizer_vocab_size,
+                                                                   streaming=streaming)),
+                                                 timings, dataset_methods)
+    with open(data_path, encoding='utf-8') as f:
+        corpus = f.read()
+    sentence_char_len = 40
+    #windows and steps count tokens in tokenizer mode
+    num_sentences = (len(model._encoded_text) - sentence_char_len - 1) // 3 + 1
+    if tokenizer_vocab_size is None:
+        one_hot = np.eye(model._num_chars, dtype=np.float32)
+        windows = np.random.randint(0, model._num_chars, (max(PREDICT_BATCH_SIZES), sentence_char_len))
+        make_inputs = lambda batch_size: one_hot[windows[:batch_size]]
+    else:
+        #token 0 is padding
+        windows = np.random.randint(1, model._num_chars, (max(PREDICT_BATCH_SIZES), sentence_char_len))
+        make_inputs = lambda batch_size: windows[:batch_size]
+    batch_input_bytes = model._get_training_sequence()[0][0].nbytes
+    seed = corpus[:sentence_char_len]
+    num_chars = sizes['generate_chars']
+
+    generation = {}
+    for backend in ['keras', 'numpy']:
+        suffix = '' if backend == 'keras' else '_numpy'
+        for name, seeds, temperatures, stateful in [('single_windowed', [seed], [0.5], False),
+                                                    ('single_stateful', [seed], [0.5], True),
+                                                    ('batch4_windowed', [seed], [0.2, 0.5, 1.0, 1.2], False),
+                                                    ('batch4_stateful', [seed], [0.2, 0.5, 1.0, 1.2], True)]:
+            start = time.perf_counter()
+            model.generate_batch(seeds, temperatures, num_chars, stateful=stateful, backend=backend)
+            generation[name + suffix] = len(seeds) * len(temperatures) * num_chars / (time.perf_counter() - start)
+
+    train_samples_per_sec = time_training(lambda: model.train_model(print_callback_flag=False), num_sentences)
+    return {'dataset_build_seconds': build_seconds,
+            'model_build_seconds': timings['_define_model'],
+            'train_samples_per_sec': train_samples_per_sec,
+            #an epoch covers the corpus once whatever a sample is
+            'train_corpus_chars_per_sec': train_samples_per_sec * len(corpus) / num_sentences,
+            'batch_input_bytes': batch_input_bytes,
+            'predict_latency': predict_latency(model._text_generation_model,
+                                               make_inputs,
+                                               sizes['predict_repeat']),
+            'generate_chars_per_sec': generation,
+            'peak_rss_mb': instrumentation.peak_rss_mb()}
+
+
+BENCHMARKS = \
+    {
+    'number_recognition': bench_number_recognition,
+    'shared_vision_model': bench_shared_vision_model,
+    'text_generation': bench_text_generation,
+    'text_generation_bpe': functools.partial(bench_text_generation, tokenizer_vocab_size=512),
+    'text_generation_streaming': functools.partial(bench_text_generation, streaming=True),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_results.json', help='path of the JSON results')
+    parser.add_argument('--quick', action='store_true', help='use small synthetic datasets')
+    parser.add_argument('--models', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS))
+    args = parser.parse_args()
+
+    size_name = 'quick' if args.quick else 'full'
+    results = {'commit': git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'sizes': size_name,
+               'results': {}}
+    #a fresh process per model keeps peak RSS and framework state separate
+    context = get_context('spawn')
+    for name in args.models:
+        print('Benchmarking {}...'.format(name))
+        work_dir = tempfile.mkdtemp()
+        try:
+            with context.Pool(1) as pool:
+                results['results'][name] = pool.apply(BENCHMARKS[name], (SIZES[size_name], work_dir))
+        finally:
+            shutil.rmtree(work_dir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results saved to ' + args.output)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import re
+from collections import Counter, defaultdict
+
+import numpy as np
+
+#words keep their leading space, punctuation runs and whitespace runs are separate pieces,
+#so joining the pieces gives back the text
+PRETOKENIZE = re.compile(r' ?\w+| ?[^\w\s]+|\s+')
+
+
+def merge_pair(symbols, pair, new_symbol):
+    '''
+    :return: the symbols with every occurrence of pair replaced by new_symbol
+    '''
+    merged = []
+    i = 0
+    while i < len(symbols):
+        if i < len(symbols) - 1 and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+            merged.append(new_symbol)
+            i += 2
+        else:
+            merged.append(symbols[i])
+            i += 1
+    return merged
+
+
+class BPETokenizer:
+    '''
+    Byte pair encoding over the characters of a corpus
+    Token 0 is an empty padding token, followed by every character of the corpus and then
+    one token per learned merge of two tokens. Merges never cross the word boundaries
+    of PRETOKENIZE
+    '''
+    def __init__(self, vocabulary, merges):
+        '''
+
+        :param vocabulary: string of every token, see BPETokenizer.train
+        :param merges: (num_merges, 2) array of the token pair merged into each of the last
+            num_merges tokens
+        '''
+        self._vocabulary = [str(token) for token in vocabulary]
+        self._merges = np.asarray(merges, dtype=np.int64).reshape((-1, 2))
+        self._num_base = len(self._vocabulary) - len(self._merges)
+        self._char_ids = dict((char, i) for i, char in enumerate(self._vocabulary[1:self._num_base], 1))
+        #merged token of every pair, earlier merges have lower token indices
+        self._merge_ids = dict(((int(a), int(b)), self._num_base + i) for i, (a, b) in enumerate(self._merges))
+        self._word_cache = {}
+        return
+
+    @classmethod
+    def train(cls, text, vocab_size):
+        '''
+        learn merges of the most frequent adjacent token pairs until the vocabulary is full
+
+        :param text: corpus
+        :param vocab_size: size of the vocabulary, including the padding token and the characters
+        :return: BPETokenizer
+        '''
+        chars = sorted(set(text))
+        if vocab_size < len(chars) + 1:
+            raise ValueError('Vocabulary size {} is smaller than the {} characters of the corpus'
+                             .format(vocab_size, len(chars) + 1))
+        vocabulary = [''] + chars
+        char_ids = dict((char, i) for i, char in enumerate(chars, 1))
+        word_counts = Counter(PRETOKENIZE.findall(text))
+        words = [[char_ids[char] for char in word] for word in word_counts]
+        frequencies = list(word_counts.values())
+
+        #pair counts are updated incrementally, only words containing the merged pair are visited
+        pair_counts = Counter()
+        pair_words = defaultdict(set)
+        for word_index, (word, frequency) in enumerate(zip(words, frequencies)):
+            for pair in zip(word, word[1:]):
+                pair_counts[pair] += frequency
+                pair_words[pair].add(word_index)
+
+        merges = []
+        while len(vocabulary) < vocab_size and pair_counts:
+            pair, pair_count = max(pair_counts.items(), key=lambda item: item[1])
+            if pair_count < 2:
+                break
+            new_id = len(vocabulary)
+            vocabulary.append(vocabulary[pair[0]] + vocabulary[pair[1]])
+            merges.append(pair)
+            for word_index in list(pair_words[pair]):
+                word = words[word_index]
+                frequency = frequencies[word_index]
+                for old_pair in zip(word, word[1:]):
+                    pair_counts[old_pair] -= frequency
+                    if pair_counts[old_pair] <= 0:
+                        del pair_counts[old_pair]
+                    pair_words[old_pair].discard(word_index)
+                word = merge_pair(word, pair, new_id)
+                words[word_index] = word
+                for new_pair in zip(word, word[1:]):
+                    pair_counts[new_pair] += frequency
+                    pair_words[new_pair].add(word_index)
+            pair_counts.pop(pair, None)
+            pair_words.pop(pair, None)
+        return cls(vocabulary, np.array(merges, dtype=np.int64).reshape((-1, 2)))
+
+    @property
+    def vocabulary(self):
+        return self._vocabulary
+
+    def to_arrays(self):
+        '''
+        :return: dictionary of arrays that BPETokenizer(**arrays) is rebuilt from, for the dataset cache
+        '''
+        return {'vocabulary': np.array(self._vocabulary), 'merges': self._merges}
+
+    def _encode_word(self, word):
+        try:
+            symbols = [self._char_ids[char] for char in word]
+        except KeyError as e:
+            raise ValueError('Text has characters outside the vocabulary: {}'.format(e.args[0]))
+        while len(symbols) > 1:
+            #apply the earliest learned merge first, as in training
+            candidates = [self._merge_ids[pair] for pair in zip(symbols, symbols[1:]) if pair in self._merge_ids]
+            if not candidates:
+                break
+            new_id = min(candidates)
+            pair = tuple(int(i) for i in self._merges[new_id - self._num_base])
+            symbols = merge_pair(symbols, pair, new_id)
+        return symbols
+
+    def encode(self, text):
+        '''
+        :param text: string to encode
+        :return: 1d array of token indices
+        '''
+        ids = []
+        for word in PRETOKENIZE.findall(text):
+            encoded = self._word_cache.get(word)
+            if encoded is None:
+                encoded = self._encode_word(word)
+                self._word_cache[word] = encoded
+            ids.extend(encoded)
+        dtype = np.uint8 if len(self._vocabulary) <= 256 else np.uint16
+        return np.array(ids, dtype=dtype)
+
+    def decode(self, ids):
+        '''
+        :param ids: token indices
+        :return: decoded string, padding tokens decode to nothing
+        '''
+        return ''.join(self._vocabulary[i] for i in ids)
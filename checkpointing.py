@@ -0,0 +1,168 @@
+import os
+import pickle
+import random
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import keras
+
+
+def build_optimizer_weights(model):
+    '''
+    create the optimizer slots of a compiled model before its first training step,
+    so saved optimizer weights can be set on it
+    '''
+    optimizer = model.optimizer
+    if hasattr(optimizer, '_create_all_weights'):
+        optimizer._create_all_weights(model.trainable_weights)
+    elif hasattr(model, '_make_train_function'):
+        model._make_train_function()
+    return
+
+
+class CheckpointManager:
+    '''
+    Saves model weights, optimizer state, epoch and random number generator state
+    The state is copied on the training thread and written on a background thread,
+    so training only waits for disk I/O if the previous checkpoint is still being written.
+    Only the last max_to_keep checkpoints are kept
+    '''
+    def __init__(self, directory, max_to_keep=3):
+        '''
+
+        :param directory: directory of the checkpoints
+        :param max_to_keep: number of most recent checkpoints to keep
+        '''
+        self._directory = directory
+        self._max_to_keep = max_to_keep
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return
+
+    def checkpoints(self):
+        '''
+        :return: paths of the complete checkpoints, oldest first
+        '''
+        names = sorted(name for name in os.listdir(self._directory) if name.startswith('ckpt-'))
+        return [os.path.join(self._directory, name) for name in names]
+
+    def latest(self):
+        '''
+        :return: path of the most recent complete checkpoint, or None
+        '''
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, model, epoch, extra_state=None):
+        '''
+        snapshot the training state and write it in the background
+
+        :param model: compiled keras model
+        :param epoch: number of completed epochs
+        :param extra_state: picklable state to restore along with the model, such as data sampler positions
+        :return: None
+        '''
+        state = {'epoch': epoch,
+                 'numpy_rng': np.random.get_state(),
+                 'python_rng': random.getstate(),
+                 'extra': extra_state}
+        weights = model.get_weights()
+        optimizer_weights = model.optimizer.get_weights()
+        self.wait()
+        self._pending = self._executor.submit(self._write, epoch, weights, optimizer_weights, state)
+        return
+
+    def _write(self, epoch, weights, optimizer_weights, state):
+        tmp_dir = tempfile.mkdtemp(dir=self._directory)
+        np.savez(os.path.join(tmp_dir, 'weights.npz'), *weights)
+        np.savez(os.path.join(tmp_dir, 'optimizer.npz'), *optimizer_weights)
+        with open(os.path.join(tmp_dir, 'state.pkl'), 'wb') as f:
+            pickle.dump(state, f)
+        #the checkpoint only becomes visible once it is complete
+        checkpoint_dir = os.path.join(self._directory, 'ckpt-{:05d}'.format(epoch))
+        if os.path.isdir(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        os.rename(tmp_dir, checkpoint_dir)
+        for old_checkpoint in self.checkpoints()[:-self._max_to_keep]:
+            shutil.rmtree(old_checkpoint)
+        return
+
+    def wait(self):
+        '''
+        block until the checkpoint being written, if any, is on disk
+        '''
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        return
+
+    def restore(self, model, checkpoint_path=None):
+        '''
+        restore the model weights, optimizer state and random number generator state
+
+        :param model: compiled keras model with the same architecture
+        :param checkpoint_path: checkpoint to restore, defaults to the latest one
+        :return: the saved state with 'epoch' and 'extra', or None if there is no checkpoint
+        '''
+        checkpoint_path = checkpoint_path if checkpoint_path is not None else self.latest()
+        if checkpoint_path is None:
+            return None
+        with np.load(os.path.join(checkpoint_path, 'weights.npz')) as f:
+            model.set_weights([f['arr_{}'.format(i)] for i in range(len(f.files))])
+        with np.load(os.path.join(checkpoint_path, 'optimizer.npz')) as f:
+            optimizer_weights = [f['arr_{}'.format(i)] for i in range(len(f.files))]
+        if optimizer_weights:
+            build_optimizer_weights(model)
+            model.optimizer.set_weights(optimizer_weights)
+        with open(os.path.join(checkpoint_path, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        np.random.set_state(state['numpy_rng'])
+        random.setstate(state['python_rng'])
+        print('Resumed from {} after epoch {}'.format(checkpoint_path, state['epoch']))
+        return state
+
+
+    def resume(self, model, set_extra_state=None):
+        '''
+        restore the latest checkpoint, if any
+
+        :param model: compiled keras model with the same architecture
+        :param set_extra_state: function called with the extra state of the checkpoint
+        :return: number of epochs the checkpoint was trained for, 0 if there is no checkpoint
+        '''
+        state = self.restore(model)
+        if state is None:
+            print('No checkpoint in {}, starting from epoch 0'.format(self._directory))
+            return 0
+        if set_extra_state is not None and state['extra'] is not None:
+            set_extra_state(state['extra'])
+        return state['epoch']
+
+
+class CheckpointCallback(keras.callbacks.Callback):
+    '''
+    Saves a checkpoint at the end of every epoch through a CheckpointManager
+    '''
+    def __init__(self, manager, get_extra_state=None):
+        '''
+
+        :param manager: CheckpointManager
+        :param get_extra_state: function returning extra state to save with every checkpoint
+        '''
+        super(CheckpointCallback, self).__init__()
+        self._manager = manager
+        self._get_extra_state = get_extra_state
+        return
+
+    def on_epoch_end(self, epoch, logs=None):
+        extra_state = self._get_extra_state() if self._get_extra_state is not None else None
+        self._manager.save(self.model, epoch + 1, extra_state)
+        return
+
+    def on_train_end(self, logs=None):
+        self._manager.wait()
+        return
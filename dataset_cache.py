@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.keras', 'learning_keras_cache')
+MNIST_ORIGIN = 'https://storage.googleapis.com/tensorflow/tf-keras-datasets/mnist.npz'
+
+
+def file_digest(path, chunk_size=1 << 20):
+    '''
+    sha1 of a file's contents, read in chunks
+
+    :param path: path to the file
+    :param chunk_size: bytes read at a time
+    :return: hex digest
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetCache:
+    '''
+    On-disk cache of preprocessed dataset arrays
+    Every entry is a directory of .npy files named by a hash of the source data and the
+    preprocessing parameters, loaded back memory-mapped so startup does not parse or
+    copy the data again. Digests of the source files are remembered by source_digest so
+    they are not read either
+    '''
+    def __init__(self, cache_dir=None):
+        '''
+
+        :param cache_dir: directory of the cache, defaults to ~/.keras/learning_keras_cache
+        '''
+        self._cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        return
+
+    @staticmethod
+    def key(*parts):
+        '''
+        build a cache key
+
+        :param parts: json serializable description of the source data and preprocessing
+        :return: hex digest identifying the entry
+        '''
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self._cache_dir, key)
+
+    def source_digest(self, path):
+        '''
+        file_digest of a source file, remembered in the cache together with the path, size and
+        modification time of the file, so the file is only read again once one of them changes
+
+        :param path: path to the source file
+        :return: hex digest
+        '''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        digests_dir = os.path.join(self._cache_dir, 'digests')
+        record_path = os.path.join(digests_dir, DatasetCache.key('digest', path) + '.json')
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+            if record['stamp'] == stamp:
+                return record['digest']
+        except (OSError, ValueError, KeyError):
+            pass
+        digest = file_digest(path)
+        os.makedirs(digests_dir, exist_ok=True)
+        #written next to the record and renamed over it, so readers never see a partial record
+        fd, tmp_path = tempfile.mkstemp(dir=digests_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'stamp': stamp, 'digest': digest}, f)
+        os.replace(tmp_path, record_path)
+        return digest
+
+    def load(self, key):
+        '''
+        load a cached entry
+
+        :param key: cache key
+        :return: dictionary of read only memory-mapped arrays, or None if the entry is not cached
+        '''
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return None
+        return dict((file_name[:-len('.npy')], np.load(os.path.join(entry_dir, file_name), mmap_mode='r'))
+                    for file_name in os.listdir(entry_dir) if file_name.endswith('.npy'))
+
+    def save(self, key, arrays):
+        '''
+        save an entry, the entry only becomes visible once every array is written
+
+        :param key: cache key
+        :param arrays: dictionary of name to numpy array
+        :return: None
+        '''
+        def write(entry_dir):
+            for name, array in arrays.items():
+                np.save(os.path.join(entry_dir, name + '.npy'), array)
+        self.save_files(key, write)
+        return
+
+    def save_files(self, key, write):
+        '''
+        save an entry whose .npy files are written by a function, for arrays too large
+        to build in memory, the entry only becomes visible once write returns
+
+        :param key: cache key
+        :param write: function taking the directory to write the .npy files of the entry into
+        :return: None
+        '''
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        tmp_dir = tempfile.mkdtemp(dir=self._cache_dir)
+        try:
+            write(tmp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir)
+            raise
+        try:
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            #another process cached the same entry first
+            shutil.rmtree(tmp_dir)
+        return
+
+    def load_or_build(self, key, build):
+        '''
+        load a cached entry, building and caching it first if needed
+
+        :param key: cache key
+        :param build: function returning the dictionary of arrays to cache
+        :return: dictionary of read only memory-mapped arrays
+        '''
+        arrays = self.load(key)
+        if arrays is None:
+            self.save(key, build())
+            arrays = self.load(key)
+        return arrays
+
+    def load_or_build_files(self, key, write):
+        '''
+        load a cached entry, writing it first if needed, see save_files
+
+        :param key: cache key
+        :param write: function taking the directory to write the .npy files of the entry into
+        :return: dictionary of read only memory-mapped arrays
+        '''
+        arrays = self.load(key)
+        if arrays is None:
+            self.save_files(key, write)
+            arrays = self.load(key)
+        return arrays
+
+
+def load_mnist(data_path=None, cache=None):
+    '''
+    load the MNIST arrays through the dataset cache
+
+    :param data_path: local mnist.npz file, downloaded through keras if not given
+    :param cache: DatasetCache, defaults to the cache in the default directory
+    :return: (x_train, y_train), (x_test, y_test) as read only memory-mapped arrays
+    '''
+    if data_path is None:
+        from keras.utils.data_utils import get_file
+        data_path = get_file('mnist.npz', origin=MNIST_ORIGIN)
+    cache = cache if cache is not None else DatasetCache()
+
+    def build():
+        with np.load(data_path) as f:
+            return dict((name, f[name]) for name in ['x_train', 'y_train', 'x_test', 'y_test'])
+    arrays = cache.load_or_build(DatasetCache.key('mnist', cache.source_digest(data_path)), build)
+    return (arrays['x_train'], arrays['y_train']), (arrays['x_test'], arrays['y_test'])
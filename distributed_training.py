@@ -0,0 +1,211 @@
+'''
+Synchronous data parallel training of NumberRecognition and SharedVisionModel across
+local worker processes
+
+Every worker builds the model under a tf.distribute MultiWorkerMirroredStrategy over
+localhost, trains on its shard of every global batch and averages gradients with the
+other workers after each step. The global batch size is the per-worker batch size times
+the number of workers and the learning rate is scaled by the number of workers.
+
+Usage:
+    python distributed_training.py --model number_recognition --workers 4
+    python distributed_training.py --model shared_vision_model --workers 4 --compare
+'''
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import tempfile
+
+MODELS = \
+    {
+    #module, class, default per-worker batch size, default epochs
+    'number_recognition': ('mnist_number_recognition', 'NumberRecognition', 128, 12),
+    'shared_vision_model': ('mnist_shared_vision_model', 'SharedVisionModel', 32, 4),
+    }
+
+
+def free_ports(num_ports):
+    '''
+    :return: list of currently unused localhost ports
+    '''
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def make_strategy(tf):
+    if hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+
+def seed_everything(seed):
+    import numpy as np
+    random.seed(seed)
+    np.random.seed(seed)
+    return
+
+
+def load_model_class(model):
+    module_name, class_name = MODELS[model][:2]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def worker(model, index, cluster, epochs, batch_size, seed, save_path, results):
+    '''
+    train one worker of the cluster, the chief reports the test score
+
+    :param model: key of MODELS
+    :param index: index of this worker in the cluster
+    :param cluster: list of host:port of every worker
+    :param epochs: number of epochs
+    :param batch_size: per-worker batch size
+    :param seed: random seed shared by every worker so they sample the same data
+    :param save_path: prefix to save the trained model at, or None
+    :param results: queue the chief puts its test score on
+    '''
+    #TF_CONFIG has to be set before tensorflow is imported
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': cluster}, 'task': {'type': 'worker', 'index': index}})
+    seed_everything(seed)
+    import tensorflow as tf
+    #keras shuffles in-memory arrays with a tensorflow op before they are sharded, every
+    #worker has to draw the same permutation to train on its share of one global batch
+    tf.random.set_seed(seed)
+    strategy = make_strategy(tf)
+    num_workers = len(cluster)
+
+    instance = load_model_class(model)(epochs=epochs,
+                                       batch_size=batch_size*num_workers,
+                                       distribute_strategy=strategy,
+                                       learning_rate_scale=num_workers)
+    instance.train_model()
+    score = instance.evaluate_model()
+    if save_path is not None:
+        #every worker has to take part in saving, only the chief keeps its copy
+        instance.save_model(save_path if index == 0 else tempfile.mkdtemp() + os.sep)
+    if index == 0:
+        results.put([float(s) for s in score])
+    return
+
+
+def single_process(model, epochs, batch_size, seed, results):
+    '''
+    train the same model in one process without a distribution strategy
+    '''
+    seed_everything(seed)
+    import tensorflow as tf
+    tf.random.set_seed(seed)
+    instance = load_model_class(model)(epochs=epochs, batch_size=batch_size)
+    instance.train_model()
+    results.put([float(s) for s in instance.evaluate_model()])
+    return
+
+
+def wait_for_result(results, processes, poll_seconds=1.):
+    '''
+    wait for a result while watching the processes that produce it, so a worker that dies,
+    for example on a port collision or when it runs out of memory, fails the run instead of
+    leaving it waiting forever
+
+    :param results: queue the result is put on
+    :param processes: processes taking part in producing the result
+    :param poll_seconds: seconds between checks of the processes
+    :return: the result
+    '''
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            pass
+        failed = [process for process in processes if process.exitcode not in (None, 0)]
+        finished = all(process.exitcode is not None for process in processes)
+        if failed or finished:
+            if not failed:
+                #a result put just before its process exited may still be on its way
+                try:
+                    return results.get(timeout=poll_seconds)
+                except queue.Empty:
+                    pass
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join()
+            raise RuntimeError('Training processes exited without a result, exit codes {}'.format(
+                [process.exitcode for process in processes]))
+
+
+def train_distributed(model, num_workers, epochs, batch_size=None, seed=0, save_path=None):
+    '''
+    train a model with num_workers local worker processes
+
+    :param model: key of MODELS
+    :param num_workers: number of worker processes
+    :param epochs: number of epochs
+    :param batch_size: per-worker batch size, defaults to the batch size of the model class
+    :param seed: random seed shared by every worker
+    :param save_path: prefix to save the trained model at, or None
+    :return: test score reported by the chief
+    '''
+    batch_size = batch_size if batch_size is not None else MODELS[model][2]
+    cluster = ['localhost:{}'.format(port) for port in free_ports(num_workers)]
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=worker,
+                                 args=(model, index, cluster, epochs, batch_size, seed, save_path, results))
+                 for index in range(num_workers)]
+    for process in processes:
+        process.start()
+    score = wait_for_result(results, processes)
+    for process in processes:
+        process.join()
+    return score
+
+
+def train_single_process(model, epochs, batch_size=None, seed=0):
+    '''
+    :return: test score of the model trained in a fresh single process
+    '''
+    batch_size = batch_size if batch_size is not None else MODELS[model][2]
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=single_process, args=(model, epochs, batch_size, seed, results))
+    process.start()
+    score = wait_for_result(results, [process])
+    process.join()
+    return score
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=sorted(MODELS), default='number_recognition')
+    parser.add_argument('--workers', type=int, default=2, help='number of local worker processes')
+    parser.add_argument('--epochs', type=int, default=None, help='defaults to the epochs of the model class')
+    parser.add_argument('--batch-size', type=int, default=None, help='per-worker batch size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-path', default=None, help='prefix to save the trained model at')
+    parser.add_argument('--compare', action='store_true',
+                        help='also train in a single process and compare test scores')
+    args = parser.parse_args()
+    epochs = args.epochs if args.epochs is not None else MODELS[args.model][3]
+
+    score = train_distributed(args.model, args.workers, epochs, args.batch_size, args.seed, args.save_path)
+    print('{} workers: test loss {}, test scores {}'.format(args.workers, score[0], score[1:]))
+    if args.compare:
+        baseline = train_single_process(args.model, epochs, args.batch_size, args.seed)
+        print('single process: test loss {}, test scores {}'.format(baseline[0], baseline[1:]))
+        print('difference: {}'.format([d - b for d, b in zip(score, baseline)]))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+def hash_rows(arrays):
+    '''
+    hash every row of an array by its raw bytes
+
+    :param arrays: array whose first axis indexes the items to hash
+    :return: list of digests, one per row
+    '''
+    arrays = np.ascontiguousarray(arrays)
+    return [hashlib.sha1(row.tobytes()).digest() for row in arrays]
+
+
+class EmbeddingCache:
+    '''
+    Fixed capacity LRU cache of vectors stored in one preallocated array
+    Keys map to rows of the array, the least recently used row is reused once
+    the cache is full
+    '''
+    def __init__(self, capacity, vector_size, dtype=np.float32):
+        '''
+
+        :param capacity: maximum number of cached vectors
+        :param vector_size: length of every cached vector
+        :param dtype: dtype of the cached vectors
+        '''
+        self._capacity = capacity
+        self._vectors = np.zeros((capacity, vector_size), dtype=dtype)
+        self._slots = OrderedDict() #key -> row of _vectors, ordered from least to most recently used
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key):
+        return key in self._slots
+
+    def get(self, key):
+        '''
+        look up a single vector
+
+        :param key: hashable key
+        :return: the cached vector, or None on a miss
+        '''
+        slot = self._slots.get(key)
+        if slot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._slots.move_to_end(key)
+        return self._vectors[slot]
+
+    def put(self, key, vector):
+        '''
+        cache a vector, evicting the least recently used one if the cache is full
+
+        :param key: hashable key
+        :param vector: vector of length vector_size
+        :return: None
+        '''
+        if key in self._slots:
+            self._slots.move_to_end(key)
+            slot = self._slots[key]
+        elif len(self._slots) < self._capacity:
+            slot = len(self._slots)
+            self._slots[key] = slot
+        else:
+            _, slot = self._slots.popitem(last=False)
+            self._slots[key] = slot
+        self._vectors[slot] = vector
+        return
+
+    def get_many(self, keys):
+        '''
+        look up a batch of vectors
+
+        :param keys: list of hashable keys
+        :return: (len(keys), vector_size) array, and a boolean mask of the keys that missed
+            whose rows are left as zeros
+        '''
+        vectors = np.zeros((len(keys), self._vectors.shape[1]), dtype=self._vectors.dtype)
+        missing = np.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            vector = self.get(key)
+            if vector is None:
+                missing[i] = True
+            else:
+                vectors[i] = vector
+        return vectors, missing
+
+    def put_many(self, keys, vectors):
+        '''
+        cache a batch of vectors
+
+        :param keys: list of hashable keys
+        :param vectors: (len(keys), vector_size) array
+        :return: None
+        '''
+        for key, vector in zip(keys, vectors):
+            self.put(key, vector)
+        return
+
+    def get_or_compute(self, keys, compute):
+        '''
+        look up a batch of vectors, computing and caching the missing ones
+        a key repeated within the batch is computed once and its repeats count as hits
+
+        :param keys: list of hashable keys
+        :param compute: function of a list of positions in keys returning the vectors of those keys
+        :return: (len(keys), vector_size) array, and the number of vectors computed
+        '''
+        vectors = np.zeros((len(keys), self._vectors.shape[1]), dtype=self._vectors.dtype)
+        uncached = OrderedDict() #key -> position of its first occurrence
+        missing = []
+        for i, key in enumerate(keys):
+            if key in uncached:
+                self.hits += 1
+                missing.append(i)
+                continue
+            vector = self.get(key)
+            if vector is None:
+                uncached[key] = i
+                missing.append(i)
+            else:
+                vectors[i] = vector
+        if uncached:
+            new_vectors = compute(list(uncached.values()))
+            self.put_many(list(uncached.keys()), new_vectors)
+            new_vectors = dict(zip(uncached.keys(), new_vectors))
+            for i in missing:
+                vectors[i] = new_vectors[keys[i]]
+        return vectors, len(uncached)
+
+    def clear(self):
+        '''
+        drop every cached vector, for example when the model producing them changes
+        '''
+        self._slots.clear()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def stats(self):
+        '''
+        :return: dictionary of cache size, hits, misses and hit rate
+        '''
+        lookups = self.hits + self.misses
+        return {'size': len(self._slots),
+                'capacity': self._capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.}
@@ -0,0 +1,154 @@
+import numpy as np
+
+import instrumentation
+from pair_sampling import sample_pairs
+
+
+def find_hard_negatives(embeddings, labels, anchors, num_neighbours=10, block_size=256):
+    '''
+    exact nearest neighbour search by dot product, restricted to images of another digit
+    anchors are grouped by digit and scored against the images of every other digit a block
+    at a time, so memory is O(block_size x N) instead of O(N^2) and no same digit mask is needed
+
+    :param embeddings: (N, D) vision model outputs of every image
+    :param labels: digit label of every image
+    :param anchors: indices of the images to find neighbours for
+    :param num_neighbours: neighbours kept per anchor
+    :param block_size: anchors scored at once
+    :return: (len(anchors) * num_neighbours, 2) array of non-matching image index pairs, grouped
+        by anchor digit, and the Dot score of every pair
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    labels = np.asarray(labels)
+    anchors = np.asarray(anchors)
+    pairs = []
+    scores = []
+    for digit in np.unique(labels[anchors]):
+        digit_anchors = anchors[labels[anchors] == digit]
+        candidates = np.flatnonzero(labels != digit)
+        k = min(num_neighbours, len(candidates))
+        if k == 0:
+            continue
+        candidate_embeddings = embeddings[candidates].T
+        for start in range(0, len(digit_anchors), block_size):
+            block = digit_anchors[start: start + block_size]
+            block_scores = np.dot(embeddings[block], candidate_embeddings)
+            top = np.argpartition(block_scores, -k, axis=1)[:, -k:]
+            pairs.append(np.stack((np.repeat(block, k), candidates[top].ravel()), axis=1))
+            scores.append(np.take_along_axis(block_scores, top, axis=1).ravel())
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.float32)
+    return np.concatenate(pairs), np.concatenate(scores)
+
+
+class HardNegativeMiner:
+    '''
+    Mines non-matching training pairs that the shared vision model scores as similar
+    Every refresh embeds the training images with the current vision model, caches the
+    embeddings and searches the nearest other-digit images of a random subset of anchors.
+    sample_pairs then swaps part of the uniformly drawn non-matching pairs for mined ones
+    '''
+    def __init__(self, hard_fraction=0.5, refresh_every=1, num_anchors=10000, num_neighbours=10, block_size=256,
+                 batch_size=1024):
+        '''
+
+        :param hard_fraction: fraction of the non-matching pairs of an epoch replaced by mined pairs
+        :param refresh_every: number of epochs between refreshes
+        :param num_anchors: number of training images searched for hard negatives per refresh
+        :param num_neighbours: hard negatives kept per anchor
+        :param block_size: anchors scored at once by the nearest neighbour search
+        :param batch_size: batch size for embedding the training images
+        '''
+        if not 0. <= hard_fraction <= 1.:
+            raise ValueError('hard_fraction must be between 0 and 1, got {}'.format(hard_fraction))
+        self._hard_fraction = hard_fraction
+        self._refresh_every = refresh_every
+        self._num_anchors = num_anchors
+        self._num_neighbours = num_neighbours
+        self._block_size = block_size
+        self._batch_size = batch_size
+        self._images = None
+        self._labels = None
+        self._embeddings = None
+        #(pairs, scores) of the last refresh, replaced as one so samplers in other threads see either
+        self._hard_pairs = None
+        return
+
+    def set_data(self, images, labels):
+        '''
+        :param images: uint8 MNIST training images of shape (N, 28, 28), not copied
+        :param labels: digit label of every image
+        '''
+        self._images = images
+        self._labels = np.asarray(labels)
+        self._embeddings = None
+        self._hard_pairs = None
+        return
+
+    @property
+    def embeddings(self):
+        '''
+        :return: vision model outputs of every training image as of the last refresh, or None
+        '''
+        return self._embeddings
+
+    def refresh(self, embed):
+        '''
+        embed the training images and mine new hard negatives
+
+        :param embed: function returning the vision model outputs of a batch of uint8 images
+        :return: mean Dot score of the mined pairs
+        '''
+        if self._images is None:
+            raise ValueError('No training images, call set_data first')
+        with instrumentation.timer('hard_negative_mining.embed'):
+            self._embeddings = np.concatenate([embed(self._images[start: start + self._batch_size])
+                                               for start in range(0, len(self._images), self._batch_size)])
+        anchors = np.random.choice(len(self._labels), min(self._num_anchors, len(self._labels)), replace=False)
+        with instrumentation.timer('hard_negative_mining.search'):
+            pairs, scores = find_hard_negatives(self._embeddings, self._labels, anchors,
+                                                self._num_neighbours, self._block_size)
+        instrumentation.count('hard_negative_mining.pairs_mined', len(pairs))
+        self._hard_pairs = (pairs, scores)
+        return float(np.mean(scores)) if len(scores) else 0.
+
+    def sample_pairs(self, labels, num_pairs):
+        '''
+        draw pairs as pair_sampling.sample_pairs does, then replace hard_fraction of the
+        non-matching pairs with mined hard negatives, pairs are uniform until the first refresh
+
+        :param labels: digit label of every image, the labels given to set_data
+        :param num_pairs: number of pairs to draw
+        :return: (num_pairs, 2) array of image indices, and whether each pair matches
+        '''
+        pairs, match = sample_pairs(labels, num_pairs)
+        hard_pairs = self._hard_pairs
+        if hard_pairs is None or len(hard_pairs[0]) == 0:
+            return pairs, match
+        non_match = np.flatnonzero(match == 0)
+        num_hard = int(round(self._hard_fraction * len(non_match)))
+        replaced = np.random.choice(non_match, num_hard, replace=False)
+        mined = hard_pairs[0][np.random.randint(0, len(hard_pairs[0]), num_hard)]
+        #anchors show up as the first and as the second image
+        flip = np.random.rand(num_hard) < 0.5
+        mined[flip] = mined[flip, ::-1]
+        pairs[replaced] = mined
+        return pairs, match
+
+    def callback(self, embed):
+        '''
+        keras callback refreshing the mined pairs every refresh_every epochs
+        the training PairSequence redraws its pairs at the end of every epoch, and with a
+        prefetching enqueuer that can happen before this callback, so fresh hard negatives
+        are used from the next redraw on
+
+        :param embed: function returning the vision model outputs of a batch of uint8 images
+        :return: keras callback
+        '''
+        import keras
+
+        def on_epoch_end(epoch, logs=None):
+            if (epoch + 1) % self._refresh_every == 0:
+                self.refresh(embed)
+            return
+        return keras.callbacks.LambdaCallback(on_epoch_end=on_epoch_end)
@@ -0,0 +1,290 @@
+'''
+Grid or random hyperparameter search over the model class constructors
+
+Trials run in a pool of worker processes, each limited to a number of CPU threads so
+concurrent trials do not oversubscribe the machine. Every trial reads its data
+memory-mapped from the same dataset cache, which is built once before the trials start,
+so the operating system shares one copy of the data between all workers. A trial is
+stopped early when its best metric so far is worse than the median of the other trials
+at the same epoch.
+
+The search is described by a JSON spec:
+    {
+        "model": "shared_vision_model",
+        "search": "random",
+        "num_trials": 12,
+        "fixed": {"epochs": 4, "train_size": 20000},
+        "params": {
+            "batch_size": [32, 64, 128],
+            "loss_weights": [[0.1, 1, 1], [0.5, 1, 1], [1, 1, 1]],
+            "test_size": {"low": 2000, "high": 18000, "int": true}
+        }
+    }
+A grid search tries every combination of the listed values. A random search draws
+num_trials combinations, a {"low", "high"} range is sampled uniformly, or log-uniformly
+with "log": true, and rounded with "int": true.
+
+Usage:
+    python hyperparameter_sweep.py spec.json --workers 4 --output sweep_results.csv
+'''
+import argparse
+import csv
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+MODELS = \
+    {
+    #module, class, metric to minimize by default, method loading the dataset into the cache
+    'number_recognition': ('mnist_number_recognition', 'NumberRecognition', 'val_loss', '_load_mnist'),
+    'shared_vision_model': ('mnist_shared_vision_model', 'SharedVisionModel', 'val_loss', '_load_mnist'),
+    'text_generation': ('nietzsche_lstm_text_generation', 'TextGeneration', 'loss', '_load_corpus'),
+    }
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']
+
+
+def grid_trials(params):
+    '''
+    :param params: dictionary of parameter name to list of values
+    :return: list of parameter dictionaries, one per combination
+    '''
+    names = sorted(params)
+    return [dict(zip(names, values)) for values in itertools.product(*[params[name] for name in names])]
+
+
+def sample_value(space, rng):
+    if isinstance(space, list):
+        return space[rng.randrange(len(space))]
+    low, high = float(space['low']), float(space['high'])
+    if space.get('log', False):
+        value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    else:
+        value = rng.uniform(low, high)
+    return int(round(value)) if space.get('int', False) else value
+
+
+def random_trials(params, num_trials, seed=0):
+    '''
+    :param params: dictionary of parameter name to list of values or {"low", "high"} range
+    :param num_trials: number of trials to draw
+    :param seed: random seed
+    :return: list of parameter dictionaries
+    '''
+    rng = random.Random(seed)
+    return [dict((name, sample_value(params[name], rng)) for name in sorted(params)) for _ in range(num_trials)]
+
+
+def limit_threads(num_threads):
+    '''
+    pool initializer, limits the math library threads before tensorflow is imported
+    '''
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(num_threads)
+    return
+
+
+def load_model_class(model):
+    module_name, class_name = MODELS[model][:2]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def warm_cache(model, kwargs):
+    '''
+    build the cached dataset of a trial so every trial afterwards memory-maps it
+    '''
+    instance = load_model_class(model)(**kwargs)
+    getattr(instance, MODELS[model][3])()
+    return
+
+
+class MedianStoppingRule:
+    '''
+    Stops a trial whose best metric so far is worse than the median best metric of the
+    other trials at the same epoch
+    The metric history of every trial is kept in a dictionary shared between processes
+    '''
+    def __init__(self, trial_id, histories, metric, mode='min', min_epochs=1, min_trials=2):
+        '''
+
+        :param trial_id: key of this trial in histories
+        :param histories: multiprocessing manager dictionary of trial id to list of metrics per epoch
+        :param metric: name of the metric in the keras logs
+        :param mode: 'min' if lower metrics are better, 'max' otherwise
+        :param min_epochs: number of epochs every trial runs before it may be stopped
+        :param min_trials: number of other trials that must have reached an epoch before comparing
+        '''
+        self._trial_id = trial_id
+        self._histories = histories
+        self._metric = metric
+        self._sign = 1. if mode == 'min' else -1.
+        self._min_epochs = min_epochs
+        self._min_trials = min_trials
+        self._history = []
+        self._callback = None
+        self.stopped_epoch = None
+        return
+
+    def history(self):
+        return list(self._history)
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self._metric)
+        if value is None:
+            raise KeyError('Metric {} is not in the training logs: {}'.format(self._metric, sorted(logs or {})))
+        self._history.append(float(value))
+        #the shared dictionary only sees reassigned values
+        self._histories[self._trial_id] = list(self._history)
+        if len(self._history) < self._min_epochs:
+            return
+        epochs = len(self._history)
+        best = min(self._sign * v for v in self._history)
+        others = [min(self._sign * v for v in history[:epochs])
+                  for trial_id, history in self._histories.items()
+                  if trial_id != self._trial_id and len(history) >= epochs]
+        if len(others) >= self._min_trials and best > np.median(others):
+            self.stopped_epoch = epochs
+            self._callback.model.stop_training = True
+        return
+
+    def callback(self):
+        '''
+        :return: keras callback running the rule
+        '''
+        import keras
+        self._callback = keras.callbacks.LambdaCallback(on_epoch_end=self.on_epoch_end)
+        return self._callback
+
+
+def run_trial(model, trial_id, params, fixed, metric, mode, min_epochs, histories, num_threads, seed):
+    '''
+    train one trial in a pool worker
+
+    :return: dictionary of the trial parameters and results
+    '''
+    random.seed(seed)
+    np.random.seed(seed)
+    import keras
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+    except (ImportError, AttributeError, RuntimeError):
+        #older tensorflow, or the runtime of this worker was already initialized by an earlier trial
+        pass
+
+    kwargs = dict(fixed, **params)
+    start = time.perf_counter()
+    instance = load_model_class(model)(**kwargs)
+    rule = MedianStoppingRule(trial_id, histories, metric, mode, min_epochs)
+    train_kwargs = {'print_callback_flag': False} if model == 'text_generation' else {}
+    instance.train_model(callbacks=[rule.callback()], **train_kwargs)
+    result = {'trial': trial_id}
+    result.update(params)
+    history = rule.history()
+    best = min(history) if mode == 'min' else max(history)
+    result.update({'epochs_run': len(history),
+                   'stopped_early': rule.stopped_epoch is not None,
+                   'final_' + metric: history[-1],
+                   'best_' + metric: best,
+                   'seconds': time.perf_counter() - start})
+    if hasattr(instance, 'evaluate_model'):
+        result['test_loss'] = float(instance.evaluate_model()[0])
+    keras.backend.clear_session()
+    return result
+
+
+def run_sweep(spec, workers=2, threads_per_trial=None, min_epochs=1, metric=None, mode='min', seed=0):
+    '''
+    run every trial of a search spec
+
+    :param spec: search spec, see the module docstring
+    :param workers: number of trials run at the same time
+    :param threads_per_trial: CPU threads of every trial, defaults to the CPUs divided among the workers
+    :param min_epochs: number of epochs every trial runs before it may be stopped early
+    :param metric: keras log metric to compare trials on, defaults to the metric of the model
+    :param mode: 'min' if lower metrics are better, 'max' otherwise
+    :param seed: random seed of the random search and of every trial
+    :return: list of result dictionaries, best first
+    '''
+    model = spec['model']
+    if model not in MODELS:
+        raise ValueError('Invalid model {}, expected one of {}'.format(model, sorted(MODELS)))
+    metric = metric if metric is not None else MODELS[model][2]
+    fixed = spec.get('fixed', {})
+    if spec.get('search', 'grid') == 'grid':
+        trials = grid_trials(spec['params'])
+    else:
+        trials = random_trials(spec['params'], spec['num_trials'], seed)
+    threads_per_trial = threads_per_trial or max(1, multiprocessing.cpu_count() // workers)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        histories = manager.dict()
+        with context.Pool(workers, initializer=limit_threads, initargs=(threads_per_trial,)) as pool:
+            #build the cached dataset once, trials then share it memory-mapped
+            pool.apply(warm_cache, (model, dict(fixed, **trials[0])))
+            pending = [pool.apply_async(run_trial, (model, trial_id, params, fixed, metric, mode, min_epochs,
+                                                    histories, threads_per_trial, seed))
+                       for trial_id, params in enumerate(trials)]
+            results = [result.get() for result in pending]
+    key = 'best_' + metric
+    return sorted(results, key=lambda result: result[key] if mode == 'min' else -result[key])
+
+
+def write_results(results, path):
+    '''
+    write the results as CSV and print them as a table
+    '''
+    columns = []
+    for result in results:
+        columns.extend(column for column in result if column not in columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(dict((column, json.dumps(value) if isinstance(value, list) else value)
+                                 for column, value in result.items()))
+
+    def cell(value):
+        return '{:.4g}'.format(value) if isinstance(value, float) else str(value)
+    rows = [[cell(result.get(column, '')) for column in columns] for result in results]
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+    print('Results saved to ' + path)
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spec', help='JSON search spec')
+    parser.add_argument('--workers', type=int, default=2, help='number of trials run at the same time')
+    parser.add_argument('--threads-per-trial', type=int, default=None,
+                        help='CPU threads of every trial, defaults to the CPUs divided among the workers')
+    parser.add_argument('--min-epochs', type=int, default=1,
+                        help='number of epochs every trial runs before it may be stopped early')
+    parser.add_argument('--metric', default=None, help='keras log metric to compare trials on')
+    parser.add_argument('--mode', choices=['min', 'max'], default='min')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='sweep_results.csv', help='path of the CSV results')
+    args = parser.parse_args()
+    with open(args.spec) as f:
+        spec = json.load(f)
+
+    results = run_sweep(spec, args.workers, args.threads_per_trial, args.min_epochs, args.metric, args.mode,
+                        args.seed)
+    write_results(results, args.output)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+Inference only command line for the trained .h5 models
+
+Only loads the saved model, keras is imported after the arguments are parsed and no
+training data set or training model is built.
+
+Usage:
+    python inference_cli.py digits sample_number_recognition_model.h5 images.npy
+    python inference_cli.py pairs sample_model.h5 images_a.npy images_b.npy
+    python inference_cli.py generate Nietzche.h5 --seed "he who has a why to live can bear almost any how"
+    python inference_cli.py generate Nietzche.npz --stateful --seed "he who has a why to live can bear almost any how"
+'''
+import argparse
+import sys
+import time
+
+import numpy as np
+
+
+def load_images(path, scale):
+    '''
+    :param path: .npy file of 28x28 images
+    :param scale: scale images to [0, 1], for models trained with an input pipeline
+    :return: float32 array of shape (N, 28, 28, 1)
+    '''
+    images = np.load(path).astype(np.float32).reshape((-1, 28, 28, 1))
+    return images / 255. if scale else images
+
+
+def digits(args):
+    import keras
+    start = time.perf_counter()
+    model = keras.models.load_model(args.model)
+    loaded = time.perf_counter()
+    probabilities = model.predict(load_images(args.images, args.scale_images), batch_size=args.batch_size)
+    for digit, probability in zip(probabilities.argmax(axis=1), probabilities.max(axis=1)):
+        print('{} {:.4f}'.format(digit, probability))
+    return loaded - start, time.perf_counter() - loaded
+
+
+def pairs(args):
+    import keras
+    from mnist_shared_vision_model import CUSTOM_OBJECTS
+    start = time.perf_counter()
+    model = keras.models.load_model(args.model, custom_objects=CUSTOM_OBJECTS)
+    loaded = time.perf_counter()
+    scores = model.predict([load_images(args.images_a, args.scale_images),
+                            load_images(args.images_b, args.scale_images)], batch_size=args.batch_size)[0]
+    for score in scores.ravel():
+        print('{:.4f}'.format(score))
+    return loaded - start, time.perf_counter() - loaded
+
+
+def generate(args):
+    from nietzsche_lstm_text_generation import TextGeneration
+    start = time.perf_counter()
+    text_generation = TextGeneration(data_path=args.data_path, cache_dir=args.cache_dir,
+                                     tokenizer_vocab_size=args.tokenizer_vocab_size, streaming=args.streaming)
+    #an .npz model from TextGeneration.export_numpy runs without keras
+    backend = 'numpy' if args.model.endswith('.npz') else 'keras'
+    if backend == 'numpy':
+        text_generation.load_numpy_model(args.model)
+    else:
+        text_generation.load_model(args.model)
+    loaded = time.perf_counter()
+    generated = text_generation.generate_streams([args.seed], [args.temperature], args.length,
+                                                 stateful=args.stateful, backend=backend)[0]
+    print(args.seed + generated)
+    return loaded - start, time.perf_counter() - loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    digits_parser = subparsers.add_parser('digits', help='classify MNIST digits with a NumberRecognition model')
+    digits_parser.add_argument('model', help='NumberRecognition .h5 model')
+    digits_parser.add_argument('images', help='.npy file of 28x28 images')
+    digits_parser.set_defaults(run=digits)
+
+    pairs_parser = subparsers.add_parser('pairs', help='score image pairs with a SharedVisionModel model')
+    pairs_parser.add_argument('model', help='SharedVisionModel .h5 model')
+    pairs_parser.add_argument('images_a', help='.npy file of 28x28 images')
+    pairs_parser.add_argument('images_b', help='.npy file of 28x28 images')
+    pairs_parser.set_defaults(run=pairs)
+
+    for image_parser in [digits_parser, pairs_parser]:
+        image_parser.add_argument('--scale-images', action='store_true', help='scale images to [0, 1] before predicting')
+        image_parser.add_argument('--batch-size', type=int, default=256)
+
+    generate_parser = subparsers.add_parser('generate', help='generate text with a TextGeneration model')
+    generate_parser.add_argument('model', help='TextGeneration .h5 model, or .npz model saved by export_numpy')
+    generate_parser.add_argument('--seed', required=True, help='seed text of at least 40 characters')
+    generate_parser.add_argument('--length', type=int, default=400, help='number of characters to generate')
+    generate_parser.add_argument('--temperature', type=float, default=0.5)
+    generate_parser.add_argument('--stateful', action='store_true', help='decode incrementally')
+    generate_parser.add_argument('--data-path', help='local corpus file the model was trained on')
+    generate_parser.add_argument('--cache-dir', help='directory of the preprocessed dataset cache')
+    generate_parser.add_argument('--tokenizer-vocab-size', type=int, default=None,
+                                 help='vocabulary size the BPE token model was trained with')
+    generate_parser.add_argument('--streaming', action='store_true',
+                                 help='encode the corpus in chunks if it is not cached yet, for corpora larger than memory')
+    generate_parser.set_defaults(run=generate)
+
+    args = parser.parse_args()
+    start = time.perf_counter()
+    load_seconds, predict_seconds = args.run(args)
+    #timings go to stderr so the predictions can be piped
+    print('model loaded in {:.2f}s, predicted in {:.2f}s, {:.2f}s in total'
+          .format(load_seconds, predict_seconds, time.perf_counter() - start), file=sys.stderr)
+    return
+
+
+if __name__ == '__main__':
+    main()
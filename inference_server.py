@@ -0,0 +1,391 @@
+'''
+Local HTTP inference service for the trained .h5 models
+
+Keeps the models warm and groups concurrent requests into micro-batches, bounded by
+a maximum batch size and a maximum wait time, before running them through the model.
+
+Endpoints:
+    POST /digits    {"images": [28x28 uint8 images]}
+                    -> {"digits": [...], "probabilities": [[10 floats], ...]}
+    POST /pairs     {"images_a": [28x28 images], "images_b": [28x28 images]}
+                    -> {"scores": [...]}
+    POST /generate  {"seed": str of at least 40 chars, "temperature": float, "length": int}
+                    -> {"text": str}
+    GET  /metrics   latency, batch size and queue depth of every model
+
+Usage:
+    python inference_server.py --digits-model sample_number_recognition_model.h5 \
+        --pairs-model sample_model.h5 --text-model Nietzche.h5 --port 8000
+'''
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class MicroBatcher:
+    '''
+    Collects concurrent requests for one model into batches
+    A batch is run as soon as it holds max_batch_size requests or its first request
+    has waited max_wait_ms. Batches run one at a time on a dedicated thread so the
+    event loop keeps accepting requests while the model is busy. Payloads are validated
+    before they are queued and failures are kept to their own request, so one bad
+    request never fails the rest of its batch. With a batch_key only requests of the
+    same key share a batch, the others are held back for the following batches
+    '''
+    def __init__(self, predict_batch, max_batch_size=32, max_wait_ms=5., prepare=None, batch_key=None):
+        '''
+
+        :param predict_batch: function of a list of prepared payloads returning a list of results,
+            see predict_isolated
+        :param max_batch_size: maximum number of requests per batch
+        :param max_wait_ms: maximum time the first request of a batch waits for more requests
+        :param prepare: function validating and encoding a request payload before it is queued,
+            raising ValueError, KeyError or TypeError for a bad request
+        :param batch_key: function of a prepared payload, requests are only batched with
+            requests of the same key
+        '''
+        self._predict_batch = predict_batch
+        self._prepare = prepare
+        self._batch_key = batch_key
+        self._held = deque() #requests of another key than the batch they arrived during
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000.
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._latencies_ms = deque(maxlen=1000)
+        self._batch_sizes = deque(maxlen=1000)
+        self._num_requests = 0
+        self._num_batches = 0
+        return
+
+    async def submit(self, payload):
+        '''
+        queue a request and wait for its result
+
+        :param payload: request payload
+        :return: result of the request
+        '''
+        if self._prepare is not None:
+            payload = self._prepare(payload)
+        key = self._batch_key(payload) if self._batch_key is not None else None
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((payload, future, time.perf_counter(), key))
+        return await future
+
+    async def run(self):
+        '''
+        batch and run queued requests until cancelled
+        '''
+        loop = asyncio.get_event_loop()
+        while True:
+            #held back requests are older than any queued one
+            batch = [self._held.popleft() if self._held else await self._queue.get()]
+            key = batch[0][3]
+            held = deque()
+            for request in self._held:
+                if request[3] == key and len(batch) < self._max_batch_size:
+                    batch.append(request)
+                else:
+                    held.append(request)
+            self._held = held
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request[3] == key:
+                    batch.append(request)
+                else:
+                    self._held.append(request)
+            payloads = [payload for payload, _, _, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, predict_isolated, self._predict_batch, payloads)
+            except Exception as e:
+                for _, future, _, _ in batch:
+                    future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for (_, future, start, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                self._latencies_ms.append((now - start) * 1000.)
+            self._num_requests += len(batch)
+            self._num_batches += 1
+            self._batch_sizes.append(len(batch))
+
+    def metrics(self):
+        '''
+        :return: dictionary of request counts, queue depth, batch sizes and latency percentiles
+        '''
+        latencies = np.array(self._latencies_ms) if self._latencies_ms else np.zeros(1)
+        return {'requests': self._num_requests,
+                'batches': self._num_batches,
+                'queue_depth': self._queue.qsize() + len(self._held),
+                'mean_batch_size': float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.,
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99))}
+
+
+def predict_isolated(predict_batch, payloads):
+    '''
+    run a batch, and if it fails run every payload on its own so that a failure only
+    reaches the request that caused it
+
+    :param predict_batch: function of a list of payloads returning a list of results
+    :param payloads: list of prepared request payloads
+    :return: list of one result, or exception, per payload
+    '''
+    try:
+        return predict_batch(payloads)
+    except Exception as e:
+        if len(payloads) == 1:
+            return [e]
+    results = []
+    for payload in payloads:
+        try:
+            results.extend(predict_batch([payload]))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def split_results(outputs, sizes):
+    '''
+    split a batched model output back into one result per request
+
+    :param outputs: array whose first axis is the concatenation of every request
+    :param sizes: number of rows of every request
+    :return: list of arrays, one per request
+    '''
+    return np.split(outputs, np.cumsum(sizes)[:-1])
+
+
+def generation_length_bucket(payload):
+    '''
+    batch key of /generate requests, every stream of a batch runs to the longest requested
+    length, so requests are only batched with requests of at most twice their length
+
+    :param payload: prepared /generate payload
+    :return: power of two bucket of the requested length
+    '''
+    return max(payload['length'], 1).bit_length()
+
+
+def images_array(images, scale):
+    '''
+    :param images: nested list of 28x28 images
+    :param scale: scale the images to [0, 1]
+    :return: (N, 28, 28, 1) float32 array
+    '''
+    images = np.asarray(images, dtype=np.float32)
+    if images.ndim not in (3, 4) or images.shape[1:3] != (28, 28) or images.shape[3:] not in [(), (1,)]:
+        raise ValueError('Expected a list of 28x28 images, got shape {}'.format(images.shape))
+    images = images.reshape((-1, 28, 28, 1))
+    return images / 255. if scale else images
+
+
+class InferenceService:
+    '''
+    Holds the loaded models and their micro-batchers
+    '''
+    def __init__(self, digits_model=None, pairs_model=None, text_model=None, text_data_path=None,
+                 scale_images=False, stateful_generation=False, max_batch_size=32, max_wait_ms=5.):
+        '''
+
+        :param digits_model: path of a NumberRecognition .h5 model
+        :param pairs_model: path of a SharedVisionModel .h5 model
+        :param text_model: path of a TextGeneration .h5 model, or of an .npz model saved by
+            TextGeneration.export_numpy, which generates with numpy and without keras
+        :param text_data_path: local corpus file the text model was trained on, the
+            Nietzsche corpus is used if not given
+        :param scale_images: scale images to [0, 1], for models trained with an input pipeline
+        :param stateful_generation: decode text incrementally, see TextGeneration.generate_streams
+        :param max_batch_size: maximum number of requests per batch
+        :param max_wait_ms: maximum time a request waits for more requests
+        '''
+        self._scale_images = scale_images
+        self._stateful_generation = stateful_generation
+        self._generation_backend = 'keras'
+        self.batchers = {}
+        if digits_model is not None or pairs_model is not None:
+            import keras
+        if digits_model is not None:
+            self._digits_model = keras.models.load_model(digits_model)
+            self.batchers['/digits'] = MicroBatcher(self._predict_digits, max_batch_size, max_wait_ms,
+                                                    self._prepare_digits)
+        if pairs_model is not None:
+            from mnist_shared_vision_model import CUSTOM_OBJECTS
+            self._pairs_model = keras.models.load_model(pairs_model, custom_objects=CUSTOM_OBJECTS)
+            self.batchers['/pairs'] = MicroBatcher(self._predict_pairs, max_batch_size, max_wait_ms,
+                                                   self._prepare_pairs)
+        if text_model is not None:
+            from nietzsche_lstm_text_generation import TextGeneration
+            self._text_generation = TextGeneration(data_path=text_data_path)
+            if text_model.endswith('.npz'):
+                self._generation_backend = 'numpy'
+                self._text_generation.load_numpy_model(text_model)
+            else:
+                self._text_generation.load_model(text_model)
+                #the vocabulary comes from the corpus, load it now rather than in the first request
+                self._text_generation._load_corpus()
+            self.batchers['/generate'] = MicroBatcher(self._generate, max_batch_size, max_wait_ms,
+                                                      self._prepare_generate, generation_length_bucket)
+        return
+
+    def _prepare_digits(self, payload):
+        return images_array(payload['images'], self._scale_images)
+
+    def _predict_digits(self, payloads):
+        images = payloads
+        probabilities = self._digits_model.predict(np.concatenate(images), batch_size=256)
+        return [{'digits': result.argmax(axis=1).tolist(), 'probabilities': result.tolist()}
+                for result in split_results(probabilities, [len(x) for x in images])]
+
+    def _prepare_pairs(self, payload):
+        images_a = images_array(payload['images_a'], self._scale_images)
+        images_b = images_array(payload['images_b'], self._scale_images)
+        if len(images_a) != len(images_b):
+            raise ValueError('images_a has {} images but images_b has {}'.format(len(images_a), len(images_b)))
+        return images_a, images_b
+
+    def _predict_pairs(self, payloads):
+        images_a = [a for a, _ in payloads]
+        images_b = [b for _, b in payloads]
+        scores = self._pairs_model.predict([np.concatenate(images_a), np.concatenate(images_b)], batch_size=256)[0]
+        return [{'scores': result.ravel().tolist()}
+                for result in split_results(scores, [len(x) for x in images_a])]
+
+    def _prepare_generate(self, payload):
+        seed = payload['seed']
+        if not isinstance(seed, str):
+            raise ValueError('seed must be a string')
+        temperature = float(payload.get('temperature', 1.0))
+        length = int(payload.get('length', 400))
+        if temperature <= 0:
+            raise ValueError('temperature must be positive, got {}'.format(temperature))
+        if length < 0:
+            raise ValueError('length must not be negative, got {}'.format(length))
+        #raises for seeds that are too short or have characters outside the vocabulary
+        self._text_generation._encode_seed(seed)
+        return {'seed': seed, 'temperature': temperature, 'length': length}
+
+    def _generate(self, payloads):
+        #every stream of the batch is advanced together, shorter requests are truncated,
+        #batches only mix lengths of one generation_length_bucket
+        lengths = [payload['length'] for payload in payloads]
+        texts = self._text_generation.generate_streams([payload['seed'] for payload in payloads],
+                                                       [payload['temperature'] for payload in payloads],
+                                                       max(lengths),
+                                                       stateful=self._stateful_generation,
+                                                       backend=self._generation_backend)
+        return [{'text': text[:length]} for text, length in zip(texts, lengths)]
+
+    def metrics(self):
+        return dict((path, batcher.metrics()) for path, batcher in self.batchers.items())
+
+
+async def read_request(reader):
+    '''
+    read one HTTP/1.1 request
+
+    :return: method, path and body, or None if the connection closed
+    '''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            content_length = int(value.strip())
+    body = await reader.readexactly(content_length) if content_length else b''
+    return method, path, body
+
+
+def http_response(status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    header = 'HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(status, len(body))
+    return header.encode('latin-1') + body
+
+
+async def serve(service, host='127.0.0.1', port=8000):
+    '''
+    run the HTTP server and the micro-batchers until cancelled
+    '''
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                if method == 'GET' and path == '/metrics':
+                    response = http_response('200 OK', service.metrics())
+                elif method == 'POST' and path in service.batchers:
+                    try:
+                        result = await service.batchers[path].submit(json.loads(body.decode('utf-8')))
+                        response = http_response('200 OK', result)
+                    except (ValueError, KeyError, TypeError) as e:
+                        response = http_response('400 Bad Request', {'error': str(e)})
+                    except Exception as e:
+                        response = http_response('500 Internal Server Error', {'error': str(e)})
+                else:
+                    response = http_response('404 Not Found', {'error': 'Unknown endpoint {} {}'.format(method, path)})
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+        return
+
+    batcher_tasks = [asyncio.ensure_future(batcher.run()) for batcher in service.batchers.values()]
+    server = await asyncio.start_server(handle, host, port)
+    print('Serving {} on http://{}:{}'.format(', '.join(sorted(service.batchers)), host, port))
+    try:
+        await server.serve_forever()
+    finally:
+        for task in batcher_tasks:
+            task.cancel()
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--digits-model', help='NumberRecognition .h5 model')
+    parser.add_argument('--pairs-model', help='SharedVisionModel .h5 model')
+    parser.add_argument('--text-model', help='TextGeneration .h5 model, or .npz model saved by export_numpy')
+    parser.add_argument('--text-data-path', help='local corpus file the text model was trained on')
+    parser.add_argument('--scale-images', action='store_true', help='scale images to [0, 1] before predicting')
+    parser.add_argument('--stateful-generation', action='store_true', help='decode text incrementally')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    if not (args.digits_model or args.pairs_model or args.text_model):
+        parser.error('at least one model is required')
+
+    service = InferenceService(args.digits_model, args.pairs_model, args.text_model, args.text_data_path,
+                               args.scale_images, args.stateful_generation, args.max_batch_size, args.max_wait_ms)
+    asyncio.get_event_loop().run_until_complete(serve(service, args.host, args.port))
+    return
+
+
+if __name__ == '__main__':
+    main()
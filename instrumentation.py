@@ -0,0 +1,277 @@
+'''
+Named timers and counters for the training and generation hot paths
+
+Instrumentation is off unless the LEARNING_KERAS_PROFILE environment variable is set or
+enable() is called, for example through the --profile flag of the model scripts. While it
+is off, timer() hands back one shared no-op context manager and count() returns at once,
+so the instrumented code paths cost a function call and nothing else.
+
+Usage:
+    LEARNING_KERAS_PROFILE=1 python nietzsche_lstm_text_generation.py
+    python mnist_number_recognition.py --profile --trace trace.json --cprofile train.prof
+'''
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ENV_VAR = 'LEARNING_KERAS_PROFILE'
+
+_enabled = bool(os.environ.get(ENV_VAR))
+_lock = threading.Lock()
+_timings = defaultdict(float) #total seconds per timer name
+_calls = defaultdict(int) #number of runs per timer name
+_counters = defaultdict(int)
+_trace_events = None #chrome trace events, only collected when a trace was requested
+_start = time.perf_counter()
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def enable(trace=False):
+    '''
+    :param trace: also record every timer run as a chrome trace event
+    '''
+    global _enabled, _trace_events
+    _enabled = True
+    if trace and _trace_events is None:
+        _trace_events = []
+    return
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    return
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''
+    forget every recorded timing, counter and trace event
+    '''
+    global _trace_events
+    with _lock:
+        _timings.clear()
+        _calls.clear()
+        _counters.clear()
+        if _trace_events is not None:
+            _trace_events = []
+    return
+
+
+class _Timer:
+    def __init__(self, name):
+        self._name = name
+        self._start = None
+        return
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        with _lock:
+            _timings[self._name] += end - self._start
+            _calls[self._name] += 1
+            if _trace_events is not None:
+                _trace_events.append({'name': self._name, 'ph': 'X', 'pid': os.getpid(),
+                                      'tid': threading.get_ident(),
+                                      'ts': (self._start - _start) * 1e6, 'dur': (end - self._start) * 1e6})
+        return False
+
+
+def timer(name):
+    '''
+    time a block of code under a name
+
+    :param name: timer name, runs under the same name are summed
+    :return: context manager
+    '''
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+def count(name, value=1):
+    '''
+    add to a named counter
+
+    :param name: counter name
+    :param value: amount to add
+    '''
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+    return
+
+
+def report():
+    '''
+    :return: dictionary of timers, with total seconds and number of runs, and counters
+    '''
+    with _lock:
+        return {'timers': dict((name, {'seconds': _timings[name], 'calls': _calls[name]}) for name in _timings),
+                'counters': dict(_counters)}
+
+
+def print_report(file=sys.stderr):
+    '''
+    print every timer, slowest first, and every counter
+    '''
+    recorded = report()
+    print('{:<40} {:>10} {:>10} {:>12}'.format('timer', 'seconds', 'calls', 'ms/call'), file=file)
+    for name, timing in sorted(recorded['timers'].items(), key=lambda item: -item[1]['seconds']):
+        print('{:<40} {:>10.3f} {:>10d} {:>12.3f}'.format(name, timing['seconds'], timing['calls'],
+                                                          1000. * timing['seconds'] / timing['calls']), file=file)
+    for name, value in sorted(recorded['counters'].items()):
+        print('{:<40} {:>10}'.format(name, value), file=file)
+    return
+
+
+def write_chrome_trace(path):
+    '''
+    write the recorded timer runs in the Chrome trace event format, viewable in
+    chrome://tracing or https://ui.perfetto.dev
+    '''
+    with _lock:
+        events = list(_trace_events or [])
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return
+
+
+def rss_mb():
+    '''
+    :return: resident memory of this process in MB, the peak where the current value is unavailable
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def peak_rss_mb():
+    '''
+    :return: peak resident memory of this process in MB
+    '''
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #linux reports KB, macOS reports bytes
+    return peak / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+
+class EpochStats:
+    '''
+    Logs the mean step time, samples per second and host memory after every epoch
+    '''
+    def __init__(self, name, batch_size):
+        '''
+
+        :param name: prefix of the logged timers and counters
+        :param batch_size: samples per step, used when keras does not report the batch size
+        '''
+        self._name = name
+        self._batch_size = batch_size
+        self._epoch_start = None
+        self._step_start = None
+        self._step_seconds = 0.
+        self._steps = 0
+        self._samples = 0
+        return
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._step_seconds = 0.
+        self._steps = 0
+        self._samples = 0
+        return
+
+    def on_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+        return
+
+    def on_batch_end(self, batch, logs=None):
+        self._step_seconds += time.perf_counter() - self._step_start
+        self._steps += 1
+        self._samples += (logs or {}).get('size', self._batch_size)
+        return
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_seconds = time.perf_counter() - self._epoch_start
+        step_ms = 1000. * self._step_seconds / max(self._steps, 1)
+        print('{} epoch {}: {:.1f}s, {:.2f} ms/step, {:.0f} samples/sec, {:.0f} MB rss'
+              .format(self._name, epoch + 1, epoch_seconds, step_ms, self._samples / epoch_seconds, rss_mb()),
+              file=sys.stderr)
+        with _lock:
+            _timings[self._name + '.epoch'] += epoch_seconds
+            _calls[self._name + '.epoch'] += 1
+            _counters[self._name + '.steps'] += self._steps
+            _counters[self._name + '.samples'] += self._samples
+        return
+
+    def callback(self):
+        '''
+        :return: keras callback running these hooks
+        '''
+        import keras
+        return keras.callbacks.LambdaCallback(on_epoch_begin=self.on_epoch_begin,
+                                              on_batch_begin=self.on_batch_begin,
+                                              on_batch_end=self.on_batch_end,
+                                              on_epoch_end=self.on_epoch_end)
+
+
+def epoch_callbacks(name, batch_size):
+    '''
+    :return: list with an EpochStats keras callback if instrumentation is enabled, else an empty list
+    '''
+    return [EpochStats(name, batch_size).callback()] if _enabled else []
+
+
+def add_arguments(parser):
+    '''
+    add the --profile, --trace and --cprofile flags to an argparse parser
+    '''
+    parser.add_argument('--profile', action='store_true',
+                        help='print per phase timings and counters, also enabled by ' + ENV_VAR)
+    parser.add_argument('--trace', default=None, help='write a Chrome trace of the timed phases to this path')
+    parser.add_argument('--cprofile', default=None, help='write cProfile stats of the whole run to this path')
+    return
+
+
+@contextlib.contextmanager
+def session(profile=False, trace_path=None, cprofile_path=None):
+    '''
+    enable instrumentation for a block and report when it finishes
+
+    :param profile: enable the timers and counters, they are also enabled by the environment variable
+    :param trace_path: path to write a Chrome trace to
+    :param cprofile_path: path to write cProfile stats to
+    '''
+    if profile or trace_path is not None:
+        enable(trace=trace_path is not None)
+    profiler = cProfile.Profile() if cprofile_path is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            print('cProfile stats written to {}'.format(cprofile_path), file=sys.stderr)
+        if trace_path is not None:
+            write_chrome_trace(trace_path)
+            print('Chrome trace written to {}'.format(trace_path), file=sys.stderr)
+        if _enabled:
+            print_report()
+    return
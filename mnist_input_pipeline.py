@@ -0,0 +1,120 @@
+import numpy as np
+import keras
+
+
+class ImageSequence(keras.utils.Sequence):
+    '''
+    Serves batches of MNIST images and one hot labels from uint8 source arrays
+    The source arrays are never copied, every batch is gathered, augmented and
+    scaled on its own
+    '''
+    def __init__(self, images, labels, batch_size, shuffle=True, preprocess=None, augment=None, sparse_labels=False):
+        '''
+
+        :param images: uint8 images of shape (N, 28, 28) or (N, 28, 28, 1)
+        :param labels: integer digit label of every image
+        :param batch_size: size of batches
+        :param shuffle: reshuffle the images at the end of every epoch
+        :param preprocess: function applied to every uint8 batch before it is served
+        :param augment: function applied to every uint8 batch before preprocessing
+        :param sparse_labels: serve integer labels instead of one hot labels
+        '''
+        self._images = np.reshape(images, (-1, 28, 28, 1))
+        self._labels = labels
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._preprocess = preprocess
+        self._augment = augment
+        self._sparse_labels = sparse_labels
+        self._one_hot = np.eye(10, dtype=np.float32)
+        self._order = np.arange(len(self._images))
+        self.on_epoch_end()
+        return
+
+    def __len__(self):
+        return int(np.ceil(len(self._images) / float(self._batch_size)))
+
+    def __getitem__(self, idx):
+        batch = self._order[idx*self._batch_size: (idx+1)*self._batch_size]
+        images = self._images[batch]
+        if self._augment is not None:
+            images = self._augment(images)
+        if self._preprocess is not None:
+            images = self._preprocess(images)
+        labels = self._labels[batch]
+        return images, labels if self._sparse_labels else self._one_hot[labels]
+
+    def on_epoch_end(self):
+        if self._shuffle:
+            np.random.shuffle(self._order)
+        return
+
+    def get_state(self):
+        '''
+        :return: the current sample order, to be saved with a checkpoint
+        '''
+        return {'order': self._order.copy()}
+
+    def set_state(self, state):
+        '''
+        continue from a sample order saved by get_state
+        '''
+        self._order = np.asarray(state['order'])
+        return
+
+
+class InputPipeline:
+    '''
+    Shared input pipeline settings for the MNIST trainers
+    Batches are cast and scaled on the fly, optionally augmented, and prepared
+    ahead of the training step by parallel worker threads
+    '''
+    def __init__(self, workers=4, prefetch=10, scale=True, augment=None):
+        '''
+
+        :param workers: number of worker threads preparing batches
+        :param prefetch: number of batches prepared ahead of the training step
+        :param scale: cast images to float32 and scale them to [0, 1]
+        :param augment: function applied to every uint8 training batch, must be thread safe
+        '''
+        self._workers = workers
+        self._prefetch = prefetch
+        self._scale = scale
+        self.augment = augment
+        return
+
+    def preprocess(self, images):
+        '''
+        cast and scale a batch of uint8 images
+
+        :param images: uint8 images
+        :return: float32 images scaled to [0, 1], or the images unchanged if scaling is off
+        '''
+        if not self._scale:
+            return images
+        return images.astype(np.float32) / 255.
+
+    def image_sequence(self, images, labels, batch_size, training=True, sparse_labels=False):
+        '''
+        create a sequence over uint8 images
+
+        :param images: uint8 images of shape (N, 28, 28) or (N, 28, 28, 1)
+        :param labels: integer digit label of every image
+        :param batch_size: size of batches
+        :param training: shuffle and augment the images
+        :param sparse_labels: serve integer labels instead of one hot labels
+        :return: ImageSequence
+        '''
+        return ImageSequence(images, labels, batch_size,
+                             shuffle=training,
+                             preprocess=self.preprocess,
+                             augment=self.augment if training else None,
+                             sparse_labels=sparse_labels)
+
+    def fit_kwargs(self):
+        '''
+        :return: keyword arguments for fit_generator and evaluate_generator
+        '''
+        return {'workers': self._workers,
+                'use_multiprocessing': False,
+                'max_queue_size': self._prefetch}
@@ -1,31 +1,90 @@
+import argparse
+import contextlib
+
 import numpy as np
-import keras
-from keras.layers import Conv2D, MaxPooling2D, Input, Dense, Dropout, Flatten
-from keras.models import Model
-from keras.datasets import mnist
+
+import instrumentation
+from dataset_cache import DatasetCache, load_mnist
+from model_export import export_and_report
 
 class NumberRecognition:
     '''
     Implementing a model that will train to classify whether two MNIST digits
     are the same or different
+    The data set and the model are only built on first use and keras is only imported
+    then, so loading a saved model for inference skips both
     '''
-    def __init__(self, model_name='sample_number_recognition_model', epochs=12, batch_size=128):
+    def __init__(self, model_name='sample_number_recognition_model', epochs=12, batch_size=128, input_pipeline=None,
+                 sparse_labels=False, data_path=None, cache_dir=None, distribute_strategy=None,
+                 learning_rate_scale=1., checkpoint_dir=None, max_checkpoints=3):
         '''
 
         :param model_name: name of the model
         :param epochs: number of epochs
         :param batch_size: size of batches
+        :param input_pipeline: mnist_input_pipeline.InputPipeline that scales, shuffles, augments
+            and prefetches batches in worker threads, by default the whole in-memory arrays are
+            handed to fit
+        :param sparse_labels: train on integer labels with sparse_categorical_crossentropy
+            instead of one hot labels
+        :param data_path: local mnist.npz file, downloaded through keras if not given
+        :param cache_dir: directory of the preprocessed dataset cache, see dataset_cache.DatasetCache
+        :param distribute_strategy: tf.distribute strategy to build and train the model with,
+            see distributed_training.py. batch_size is then the global batch size
+        :param learning_rate_scale: factor applied to the default learning rate, usually the
+            number of workers when training with a distribute_strategy
+        :param checkpoint_dir: directory to save a checkpoint to in the background after every epoch,
+            see checkpointing.CheckpointManager
+        :param max_checkpoints: number of most recent checkpoints to keep
         '''
         self._model_name = model_name
         self._epochs = epochs
         self._batch_size = batch_size
-        self._train = {}
-        self._test = {}
+        self._input_pipeline = input_pipeline
+        self._sparse_labels = sparse_labels
+        self._data_path = data_path
+        self._dataset_cache = DatasetCache(cache_dir)
+        if distribute_strategy is not None and input_pipeline is not None:
+            raise ValueError('The input pipeline does not support distributed training')
+        if distribute_strategy is not None and checkpoint_dir is not None:
+            raise ValueError('Checkpoints are not supported with distributed training')
+        self._distribute_strategy = distribute_strategy
+        self._learning_rate_scale = learning_rate_scale
+        self._checkpoint_manager = None
+        if checkpoint_dir is not None:
+            from checkpointing import CheckpointManager
+            self._checkpoint_manager = CheckpointManager(checkpoint_dir, max_checkpoints)
+        self._train = None
+        self._test = None
         self._classification_model = None
-        self._create_data_set()
-        self._define_model()
         return
 
+    def build(self):
+        '''
+        create the data set and define the model now instead of on first use
+        '''
+        self._get_data_set()
+        self._get_model()
+        return
+
+    def _get_data_set(self):
+        '''
+        :return: training and test dictionaries of images and labels, created on first use
+        '''
+        if self._train is None:
+            with instrumentation.timer('number_recognition.create_data_set'):
+                self._create_data_set()
+        return self._train, self._test
+
+    def _get_model(self):
+        '''
+        :return: the classification model, defined and compiled on first use
+        '''
+        if self._classification_model is None:
+            with self._strategy_scope(), instrumentation.timer('number_recognition.define_model'):
+                self._define_model()
+        return self._classification_model
+
     def _create_data_set(self):
         '''
         Create data set for pairs of images and whether the two digits match or not
@@ -39,14 +98,47 @@ class NumberRecognition:
             one_hot[np.arange(labels.shape[0]), labels] = 1
             return one_hot
         #load MNIST data
-        (x_train, y_train), (x_test, y_test) = mnist.load_data()
+        (x_train, y_train), (x_test, y_test) = self._load_mnist()
+        self._train = {}
+        self._test = {}
         #create pairs of images with label
         self._train['images'] = np.reshape(x_train, (-1, 28, 28, 1))
-        self._train['labels'] = one_hot_encode(y_train)
         self._test['images'] = np.reshape(x_test, (-1, 28, 28, 1))
-        self._test['labels'] = one_hot_encode(y_test)
+        if self._input_pipeline is not None or self._sparse_labels:
+            #labels are one hot encoded per batch by the input pipeline, if at all
+            self._train['labels'] = y_train
+            self._test['labels'] = y_test
+        else:
+            self._train['labels'] = one_hot_encode(y_train)
+            self._test['labels'] = one_hot_encode(y_test)
         return
 
+    def _load_mnist(self):
+        '''
+        load the MNIST arrays, memory-mapped from the dataset cache
+
+        :return: (x_train, y_train), (x_test, y_test)
+        '''
+        return load_mnist(self._data_path, self._dataset_cache)
+
+    def _optimizer(self):
+        '''
+        Adadelta optimizer, its learning rate scaled along with the global batch size
+        '''
+        import keras
+        optimizer = keras.optimizers.Adadelta()
+        if self._learning_rate_scale != 1:
+            keras.backend.set_value(optimizer.lr, keras.backend.get_value(optimizer.lr)*self._learning_rate_scale)
+        return optimizer
+
+    def _strategy_scope(self):
+        '''
+        :return: scope of the distribution strategy, if any, to build the model in
+        '''
+        if self._distribute_strategy is None:
+            return contextlib.nullcontext()
+        return self._distribute_strategy.scope()
+
     def _define_model(self):
         '''
         define the model to be trained
@@ -54,6 +146,9 @@ class NumberRecognition:
         https://github.com/keras-team/keras/blob/master/examples/mnist_cnn.py
         Transfered Sequential Model to a Transfer Model
         '''
+        import keras
+        from keras.layers import Conv2D, MaxPooling2D, Input, Dense, Dropout, Flatten
+        from keras.models import Model
 
         # First, define the vision modules
         digit_input = Input(shape=(28, 28, 1))
@@ -67,29 +162,83 @@ class NumberRecognition:
         out = Dense(10, activation='softmax')(hidden_layer)
 
         self._classification_model = Model(digit_input, out)
-        self._classification_model.compile( loss=keras.losses.categorical_crossentropy,
-                                            optimizer=keras.optimizers.Adadelta(),
+        if self._sparse_labels:
+            loss = keras.losses.sparse_categorical_crossentropy
+        else:
+            loss = keras.losses.categorical_crossentropy
+        self._classification_model.compile( loss=loss,
+                                            optimizer=self._optimizer(),
                                             metrics=['accuracy'])
         return
 
-    def train_model(self):
+    def train_model(self, resume=False, callbacks=None):
         '''
         train the model
+
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param callbacks: additional keras callbacks
         '''
-        self._classification_model.fit(self._train['images'],
-                                       self._train['labels'], epochs=self._epochs, batch_size=self._batch_size,
-                                       validation_data=(self._test['images'], self._test['labels']))
+        train, test = self._get_data_set()
+        model = self._get_model()
+        train_sequence = None
+        if self._input_pipeline is not None:
+            train_sequence = self._input_pipeline.image_sequence(train['images'],
+                                                                 train['labels'],
+                                                                 self._batch_size,
+                                                                 sparse_labels=self._sparse_labels)
+        callbacks = list(callbacks) if callbacks is not None else []
+        initial_epoch = 0
+        if self._checkpoint_manager is not None:
+            from checkpointing import CheckpointCallback
+            #in-memory training is shuffled by the numpy random state saved with every checkpoint
+            get_state = train_sequence.get_state if train_sequence is not None else None
+            set_state = train_sequence.set_state if train_sequence is not None else None
+            if resume:
+                initial_epoch = self._checkpoint_manager.resume(model, set_state)
+            callbacks.append(CheckpointCallback(self._checkpoint_manager, get_state))
+        elif resume:
+            raise ValueError('Resuming needs a checkpoint_dir')
+        callbacks += instrumentation.epoch_callbacks('number_recognition.train', self._batch_size)
+
+        with instrumentation.timer('number_recognition.fit'):
+            if train_sequence is not None:
+                model.fit_generator(train_sequence,
+                                    epochs=self._epochs,
+                                    validation_data=self._test_sequence(),
+                                    callbacks=callbacks,
+                                    initial_epoch=initial_epoch,
+                                    **self._input_pipeline.fit_kwargs())
+            else:
+                model.fit(train['images'],
+                          train['labels'], epochs=self._epochs, batch_size=self._batch_size,
+                          validation_data=(test['images'], test['labels']),
+                          callbacks=callbacks, initial_epoch=initial_epoch)
         return
 
+    def _test_sequence(self):
+        '''
+        :return: sequence over the test set through the input pipeline
+        '''
+        _, test = self._get_data_set()
+        return self._input_pipeline.image_sequence(test['images'], test['labels'],
+                                                   self._batch_size, training=False,
+                                                   sparse_labels=self._sparse_labels)
+
     def evaluate_model(self):
         '''
         Evaluate model using test set data
-        :return:
+        :return: test loss and metrics
         '''
-        score = self._classification_model.evaluate(self._test['images'], self._test['labels'])
+        model = self._get_model()
+        with instrumentation.timer('number_recognition.evaluate'):
+            if self._input_pipeline is not None:
+                score = model.evaluate_generator(self._test_sequence(), **self._input_pipeline.fit_kwargs())
+            else:
+                _, test = self._get_data_set()
+                score = model.evaluate(test['images'], test['labels'])
         print('Test loss: {}'.format(score[0]))
         print('Test accuracy: {}'.format(score[1]))
-        return
+        return score
 
     def save_model(self, save_path=''):
         '''
@@ -98,10 +247,31 @@ class NumberRecognition:
         :param save_path: path to save the model at
         :return:
         '''
-        self._classification_model.save(save_path+self._model_name+'.h5')
+        self._get_model().save(save_path+self._model_name+'.h5')
         print('Model saved to '+save_path+self._model_name+'.h5')
         return
 
+    def export_quantized(self, save_path='', num_representative_samples=200, num_eval_samples=1000):
+        '''
+        export float32, float16 and int8 quantized TFLite versions of the model and report
+        their size, latency and accuracy against the Keras model
+
+        :param save_path: path to save the exported models at
+        :param num_representative_samples: number of training images used to calibrate int8 quantization
+        :param num_eval_samples: number of test images used to compare accuracy
+        :return: dictionary of size, latency and accuracy per format
+        '''
+        train, test = self._get_data_set()
+        preprocess = self._input_pipeline.preprocess if self._input_pipeline is not None else np.asarray
+        test_labels = test['labels'][:num_eval_samples]
+        if test_labels.ndim == 2:
+            test_labels = np.argmax(test_labels, axis=1)
+        return export_and_report(self._get_model(),
+                                 save_path+self._model_name,
+                                 [preprocess(train['images'][:num_representative_samples])],
+                                 [preprocess(test['images'][:num_eval_samples])],
+                                 test_labels)
+
     def load_model(self, model_path):
         '''
         loads a model
@@ -109,11 +279,26 @@ class NumberRecognition:
         :param model_path: path to the model
         :return:
         '''
+        import keras
         self._classification_model = keras.models.load_model(model_path)
         return
 
 if __name__ == '__main__':
-    NumberRecognitionInstance = NumberRecognition()
-    NumberRecognitionInstance.train_model()
-    NumberRecognitionInstance.evaluate_model()
-    NumberRecognitionInstance.save_model()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint-dir', default='checkpoints/sample_number_recognition_model',
+                        help='directory of the training checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    parser.add_argument('--augment', action='store_true',
+                        help='randomly shift, rotate and distort the training images in background threads')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    input_pipeline = None
+    if args.augment:
+        from augmentation import BatchAugmenter
+        from mnist_input_pipeline import InputPipeline
+        input_pipeline = InputPipeline(augment=BatchAugmenter())
+    with instrumentation.session(args.profile, args.trace, args.cprofile):
+        NumberRecognitionInstance = NumberRecognition(input_pipeline=input_pipeline, checkpoint_dir=args.checkpoint_dir)
+        NumberRecognitionInstance.train_model(resume=args.resume)
+        NumberRecognitionInstance.evaluate_model()
+        NumberRecognitionInstance.save_model()
@@ -1,85 +1,198 @@
+import argparse
+import contextlib
+
 import numpy as np
-import keras
-from keras.layers import Conv2D, MaxPooling2D, Input, Dense, Flatten, Dropout
-from keras.models import Model
-from keras.datasets import mnist
+
+import instrumentation
+from dataset_cache import DatasetCache, load_mnist
+from embedding_cache import EmbeddingCache, hash_rows
+from model_export import export_and_report
+
+
+def one_hot_binary_crossentropy(y_true, y_pred):
+    '''
+    binary_crossentropy of integer digit labels against the softmax digit outputs, the same
+    loss the one hot labels train with
+    '''
+    import keras
+    from keras import backend as K
+    y_true = K.one_hot(K.cast(K.flatten(y_true), 'int32'), K.int_shape(y_pred)[-1])
+    return keras.losses.binary_crossentropy(y_true, y_pred)
+
+
+#needed by keras.models.load_model for models trained with sparse labels
+CUSTOM_OBJECTS = {'one_hot_binary_crossentropy': one_hot_binary_crossentropy}
 
 class SharedVisionModel:
     '''
     Implementing a model that will train to classify whether two MNIST digits
     are the same or different
+    The data set and the model are only built on first use and keras is only imported
+    then, so loading a saved model for inference skips both
     '''
-    def __init__(self, model_name='sample_model', epochs=4, batch_size=32, train_size=60000, test_size=18000):
+    def __init__(self, model_name='sample_model', epochs=4, batch_size=32, train_size=60000, test_size=18000,
+                 embedding_cache_size=100000, input_pipeline=None, sparse_labels=False,
+                 data_path=None, cache_dir=None, distribute_strategy=None, learning_rate_scale=1.,
+                 checkpoint_dir=None, max_checkpoints=3, loss_weights=(0.1, 1, 1), hard_negative_miner=None):
+        '''
+
+        :param model_name: name of the model
+        :param epochs: number of epochs
+        :param batch_size: size of batches
+        :param train_size: number of training pairs per epoch
+        :param test_size: number of test pairs
+        :param embedding_cache_size: number of vision model outputs cached at inference
+        :param input_pipeline: mnist_input_pipeline.InputPipeline that scales, augments and
+            prefetches batches in worker threads, by default raw uint8 batches are
+            gathered in the training thread
+        :param sparse_labels: train the digit outputs on integer labels, expanded to one hot
+            inside the loss so training matches the one hot labels
+        :param data_path: local mnist.npz file, downloaded through keras if not given
+        :param cache_dir: directory of the preprocessed dataset cache, see dataset_cache.DatasetCache
+        :param distribute_strategy: tf.distribute strategy to build and train the model with,
+            see distributed_training.py. batch_size is then the global batch size
+        :param learning_rate_scale: factor applied to the default learning rate, usually the
+            number of workers when training with a distribute_strategy
+        :param checkpoint_dir: directory to save a checkpoint to in the background after every epoch,
+            see checkpointing.CheckpointManager
+        :param max_checkpoints: number of most recent checkpoints to keep
+        :param loss_weights: weights of the match loss and of the two digit losses
+        :param hard_negative_miner: hard_negative_mining.HardNegativeMiner that periodically embeds the
+            training images and swaps part of the random non-matching training pairs for pairs the
+            model scores as similar, by default pairs are drawn uniformly
+        '''
         self._model_name = model_name
         self._epochs = epochs
         self._batch_size = batch_size
         self._train_size = train_size
         self._test_size = test_size
+        self._input_pipeline = input_pipeline
+        self._sparse_labels = sparse_labels
+        self._data_path = data_path
+        self._dataset_cache = DatasetCache(cache_dir)
+        if distribute_strategy is not None and input_pipeline is not None:
+            raise ValueError('The input pipeline does not support distributed training')
+        if distribute_strategy is not None and checkpoint_dir is not None:
+            raise ValueError('Checkpoints are not supported with distributed training')
+        self._distribute_strategy = distribute_strategy
+        self._learning_rate_scale = learning_rate_scale
+        self._loss_weights = list(loss_weights)
+        self._hard_negative_miner = hard_negative_miner
+        self._checkpoint_manager = None
+        if checkpoint_dir is not None:
+            from checkpointing import CheckpointManager
+            self._checkpoint_manager = CheckpointManager(checkpoint_dir, max_checkpoints)
         self._train = None
         self._test = None
         self._classification_model = None
-        self._create_data_set()
-        self._define_model()
+        self._vision_model = None
+        #vision model outputs keyed by image hash, used at inference
+        self._embedding_cache = EmbeddingCache(embedding_cache_size, 10)
+        return
+
+    def build(self):
+        '''
+        create the data set and define the model now instead of on first use
+        '''
+        self._get_data_set()
+        self._get_model()
         return
 
+    def _get_data_set(self):
+        '''
+        :return: training and test PairSequences, created on first use
+        '''
+        if self._train is None:
+            with instrumentation.timer('shared_vision_model.create_data_set'):
+                self._create_data_set()
+        return self._train, self._test
+
+    def _get_model(self):
+        '''
+        :return: the classification model, defined and compiled on first use
+        '''
+        if self._classification_model is None:
+            with self._strategy_scope(), instrumentation.timer('shared_vision_model.define_model'):
+                self._define_model()
+        return self._classification_model
+
+    def _get_vision_model(self):
+        '''
+        :return: the shared vision model inside the classification model
+        '''
+        self._get_model()
+        return self._vision_model
+
     def _create_data_set(self):
         '''
         Create data set for pairs of images and whether the two digits match or not
+        pairs are stored as indices into the MNIST arrays and gathered per batch,
+        training pairs are redrawn every epoch
         '''
-        def get_img_pairs_and_labels(imgs, labels, desired_size):
-            '''
-            creates image pairs with appropriate label vector
-            '''
-            half_desired_size = int(desired_size/2)
-            data = {}
-            num_img = imgs.shape[0]
-            #reshape to dim 4
-            imgs = np.reshape(imgs, (-1, 28, 28, 1))
-
-            #get num_img random digits between 0 and num_img-1
-            digit_a_idx = np.random.choice(num_img-1, desired_size*10)
-            digit_b_idx = np.random.choice(num_img-1, desired_size*10)
-            digit_a = np.take(imgs, digit_a_idx, axis=0)
-            digit_b = np.take(imgs, digit_b_idx, axis=0)
-
-            #get labels as 0 when digits don't match, 1 otherwise
-            labels_a = np.take(labels, digit_a_idx, axis=0)
-            labels_b = np.take(labels, digit_b_idx, axis=0)
-            labels = (labels_a == labels_b).astype(int)
-
-            #need to make data even in terms of digits that match vs don't match
-            idx_false = np.nonzero(labels)[0]
-            mask_true = np.ones(len(labels))
-            mask_true[idx_false] = 0
-            idx_true = np.nonzero(mask_true)[0]
-            idx_false = idx_false[0:half_desired_size]
-            idx_true = idx_true[0:half_desired_size]
-            idx_images = np.concatenate((idx_true, idx_false))
-            data['labels'] = labels[idx_images]
-            data['digit_a'] = digit_a[idx_images]
-            data['digit_b'] = digit_b[idx_images]
-
-            #make labels that will be used as the secondary output by the vision model
-            data['digit_a_labels'] = np.zeros((half_desired_size*2, 10))
-            data['digit_b_labels'] = np.zeros((half_desired_size*2, 10))
-            data['digit_a_labels'][np.arange(half_desired_size*2), labels_a[idx_images]] = 1
-            data['digit_b_labels'][np.arange(half_desired_size*2), labels_b[idx_images]] = 1
-            return data
-
+        from pair_sampling import PairSequence
         #load MNIST data
-        (x_train, y_train), (x_test, y_test) = mnist.load_data()
+        (x_train, y_train), (x_test, y_test) = self._load_mnist()
+
+        preprocess = augment = None
+        if self._input_pipeline is not None:
+            preprocess = self._input_pipeline.preprocess
+            augment = self._input_pipeline.augment
+
+        sampler = None
+        if self._hard_negative_miner is not None:
+            self._hard_negative_miner.set_data(x_train, y_train)
+            sampler = self._hard_negative_miner.sample_pairs
 
         #create pairs of images with label
-        self._train = get_img_pairs_and_labels(x_train, y_train, desired_size=self._train_size)
-        self._test = get_img_pairs_and_labels(x_test, y_test, desired_size=self._test_size)
+        self._train = PairSequence(x_train, y_train, self._train_size, batch_size=self._batch_size,
+                                   preprocess=preprocess, augment=augment, sparse_labels=self._sparse_labels,
+                                   sampler=sampler)
+        self._test = PairSequence(x_test, y_test, self._test_size, batch_size=self._batch_size, resample=False,
+                                  preprocess=preprocess, sparse_labels=self._sparse_labels)
         return
 
+    def _fit_kwargs(self):
+        '''
+        :return: worker and prefetch keyword arguments of the input pipeline, if any
+        '''
+        return self._input_pipeline.fit_kwargs() if self._input_pipeline is not None else {}
+
+    def _load_mnist(self):
+        '''
+        load the MNIST arrays, memory-mapped from the dataset cache
+
+        :return: (x_train, y_train), (x_test, y_test)
+        '''
+        return load_mnist(self._data_path, self._dataset_cache)
+
+    def _optimizer(self):
+        '''
+        Adadelta optimizer, its learning rate scaled along with the global batch size
+        '''
+        import keras
+        optimizer = keras.optimizers.Adadelta()
+        if self._learning_rate_scale != 1:
+            keras.backend.set_value(optimizer.lr, keras.backend.get_value(optimizer.lr)*self._learning_rate_scale)
+        return optimizer
+
+    def _strategy_scope(self):
+        '''
+        :return: scope of the distribution strategy, if any, to build the model in
+        '''
+        if self._distribute_strategy is None:
+            return contextlib.nullcontext()
+        return self._distribute_strategy.scope()
+
     def _define_model(self):
         '''
         define the model to be trained
         Original code taken from:
         https://keras.io/getting-started/functional-api-guide/
         '''
+        import keras
+        from keras.layers import Conv2D, MaxPooling2D, Input, Dense, Flatten, Dropout
+        from keras.models import Model
+
         # First, define the vision modules
         digit_input = Input(shape=(28, 28, 1))
         hidden_layer = Conv2D(32, (3, 3), activation='relu')(digit_input)
@@ -92,6 +205,7 @@ class SharedVisionModel:
         out = Dense(10, activation='softmax')(hidden_layer)
 
         vision_model = Model(digit_input, out)
+        self._vision_model = vision_model
 
         # Then define the tell-digits-apart model
         digit_a = Input(shape=(28, 28, 1))
@@ -104,10 +218,16 @@ class SharedVisionModel:
         out = keras.layers.Dot(axes=1)([out_a, out_b])
 
         self._classification_model = Model(inputs=[digit_a, digit_b], outputs=[out, out_a, out_b])
-        self._classification_model.compile( optimizer=keras.optimizers.Adadelta(),
-                                            loss='binary_crossentropy',
+        if self._sparse_labels:
+            #the digit outputs train on binary_crossentropy as with one hot labels, 'accuracy'
+            #follows the label shape and is the argmax accuracy with either format
+            loss = ['binary_crossentropy', one_hot_binary_crossentropy, one_hot_binary_crossentropy]
+        else:
+            loss = 'binary_crossentropy'
+        self._classification_model.compile( optimizer=self._optimizer(),
+                                            loss=loss,
                                             metrics=['accuracy'],
-                                            loss_weights = [0.1, 1, 1]
+                                            loss_weights = self._loss_weights
                                           )
         return
 
@@ -117,12 +237,14 @@ class SharedVisionModel:
 
         :return: None
         '''
+        _, test = self._get_data_set()
+        inputs, targets = test.get_arrays()
         print('#############################')
         print('Reference')
-        print('Digit A Labels: {}'.format(self._test['digit_a_labels']))
-        print('Digit B Labels: {}'.format(self._test['digit_b_labels']))
-        print('Classification Label: {}'.format(self._test['labels']))
-        output = self._classification_model.predict([self._test['digit_a'], self._test['digit_b']])
+        print('Digit A Labels: {}'.format(targets[1]))
+        print('Digit B Labels: {}'.format(targets[2]))
+        print('Classification Label: {}'.format(targets[0]))
+        output = self._get_model().predict(inputs)
         print('#############################')
         print('Predictions')
         print('Digit A Labels: {}'.format(output[1]))
@@ -132,48 +254,178 @@ class SharedVisionModel:
         return
 
 
-    def train_model(self):
+    def embed_images(self, images, batch_size=256):
+        '''
+        run the shared vision model once per unique image
+        outputs are cached by image hash so repeated images are never recomputed
+
+        :param images: MNIST images of shape (N, 28, 28) or (N, 28, 28, 1)
+        :param batch_size: batch size for the images that are not cached yet
+        :return: (N, 10) array of vision model outputs
+        '''
+        images = np.reshape(images, (-1, 28, 28, 1))
+        keys = hash_rows(images)
+        if self._input_pipeline is not None:
+            images = self._input_pipeline.preprocess(images)
+
+        def embed(indices):
+            with instrumentation.timer('shared_vision_model.embed'):
+                return self._get_vision_model().predict(images[indices], batch_size=batch_size)
+        embeddings, num_embedded = self._embedding_cache.get_or_compute(keys, embed)
+        instrumentation.count('shared_vision_model.embedding_cache_hits', len(keys) - num_embedded)
+        instrumentation.count('shared_vision_model.images_embedded', num_embedded)
+        return embeddings
+
+    def _embed_training_images(self, images):
+        '''
+        run the shared vision model over a batch of training images without the embedding
+        cache, for hard negative mining
+
+        :param images: uint8 MNIST images of shape (N, 28, 28)
+        :return: (N, 10) array of vision model outputs
+        '''
+        images = np.reshape(images, (-1, 28, 28, 1))
+        if self._input_pipeline is not None:
+            images = self._input_pipeline.preprocess(images)
+        return self._get_vision_model().predict(images, batch_size=len(images))
+
+    def pairwise_similarity(self, images_a, images_b=None):
+        '''
+        compute the Dot output of the classification model for every pair of images
+        with one vision model pass per unique image and a single matrix product
+
+        :param images_a: MNIST images of shape (N, 28, 28) or (N, 28, 28, 1)
+        :param images_b: MNIST images of shape (M, 28, 28) or (M, 28, 28, 1),
+            defaults to comparing images_a against itself
+        :return: (N, M) array of similarity scores
+        '''
+        embeddings_a = self.embed_images(images_a)
+        embeddings_b = embeddings_a if images_b is None else self.embed_images(images_b)
+        return np.dot(embeddings_a, embeddings_b.T)
+
+    def train_model(self, resume=False, callbacks=None):
         '''
         train the model
+
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param callbacks: additional keras callbacks
         '''
-        self._classification_model.fit([self._train['digit_a'], self._train['digit_b']],
-                                       [self._train['labels'], self._train['digit_a_labels'], self._train['digit_b_labels']],
-                                       epochs=self._epochs,
-                                       batch_size=self._batch_size,
-                                       validation_data=([self._test['digit_a'], self._test['digit_b']],
-                                                        [self._test['labels'], self._test['digit_a_labels'], self._test['digit_b_labels']]),
-                                       )
+        train, test = self._get_data_set()
+        model = self._get_model()
+        callbacks = list(callbacks) if callbacks is not None else []
+        if self._hard_negative_miner is not None:
+            callbacks.append(self._hard_negative_miner.callback(self._embed_training_images))
+        if self._distribute_strategy is not None:
+            #keras shards in-memory arrays between workers, every worker draws the same
+            #pairs as long as they share the numpy random seed. the pairs are already in
+            #random order, so they are not shuffled again
+            validation_data = test.get_arrays()
+            for epoch in range(self._epochs):
+                with instrumentation.timer('shared_vision_model.gather_pairs'):
+                    inputs, targets = train.get_arrays()
+                with instrumentation.timer('shared_vision_model.fit'):
+                    model.fit(inputs, targets,
+                              batch_size=self._batch_size,
+                              epochs=epoch + 1,
+                              initial_epoch=epoch,
+                              validation_data=validation_data,
+                              callbacks=callbacks,
+                              shuffle=False)
+                train.on_epoch_end()
+            self._embedding_cache.clear()
+            return
+        initial_epoch = 0
+        if self._checkpoint_manager is not None:
+            from checkpointing import CheckpointCallback
+            if resume:
+                initial_epoch = self._checkpoint_manager.resume(model, train.set_state)
+            callbacks.append(CheckpointCallback(self._checkpoint_manager, train.get_state))
+        elif resume:
+            raise ValueError('Resuming needs a checkpoint_dir')
+        callbacks += instrumentation.epoch_callbacks('shared_vision_model.train', self._batch_size)
+        with instrumentation.timer('shared_vision_model.fit'):
+            model.fit_generator(train,
+                                epochs=self._epochs,
+                                validation_data=test,
+                                callbacks=callbacks,
+                                initial_epoch=initial_epoch,
+                                **self._fit_kwargs()
+                                )
+        #cached outputs came from the old weights
+        self._embedding_cache.clear()
         return
 
     def save_model(self, save_path=''):
         '''
         save the model
         '''
-        self._classification_model.save(save_path+self._model_name+'.h5')
+        self._get_model().save(save_path+self._model_name+'.h5')
         print('Model saved to '+save_path+self._model_name+'.h5')
         return
 
     def evaluate_model(self):
         '''
         Evaluate model using test set data
-        :return:
+        :return: test loss and metrics
         '''
 
-        score = self._classification_model.evaluate([self._test['digit_a'], self._test['digit_b']],
-                                                    [self._test['labels'], self._test['digit_a_labels'], self._test['digit_b_labels']])
+        _, test = self._get_data_set()
+        model = self._get_model()
+        with instrumentation.timer('shared_vision_model.evaluate'):
+            if self._distribute_strategy is not None:
+                inputs, targets = test.get_arrays()
+                score = model.evaluate(inputs, targets, batch_size=self._batch_size)
+            else:
+                score = model.evaluate_generator(test, **self._fit_kwargs())
         print('Test loss: {}'.format(score[0]))
         print('Test accuracy: {}'.format(score[1]))
-        return
+        return score
+
+    def export_quantized(self, save_path='', num_representative_samples=200, num_eval_samples=1000):
+        '''
+        export float32, float16 and int8 quantized TFLite versions of the shared vision model
+        and report their size, latency and digit accuracy against the Keras vision model
+
+        :param save_path: path to save the exported models at
+        :param num_representative_samples: number of training images used to calibrate int8 quantization
+        :param num_eval_samples: number of test images used to compare accuracy
+        :return: dictionary of size, latency and accuracy per format
+        '''
+        preprocess = self._input_pipeline.preprocess if self._input_pipeline is not None else np.asarray
+        (x_train, _), (x_test, y_test) = self._load_mnist()
+        return export_and_report(self._get_vision_model(),
+                                 save_path+self._model_name+'_vision',
+                                 [preprocess(np.reshape(x_train[:num_representative_samples], (-1, 28, 28, 1)))],
+                                 [preprocess(np.reshape(x_test[:num_eval_samples], (-1, 28, 28, 1)))],
+                                 np.asarray(y_test[:num_eval_samples]))
 
     def load_model(self, model_path):
         '''
         load a model
         '''
-        self._classification_model = keras.models.load_model(model_path)
+        import keras
+        from keras.models import Model
+        self._classification_model = keras.models.load_model(model_path, custom_objects=CUSTOM_OBJECTS)
+        #the shared vision model is the nested model layer
+        self._vision_model = [layer for layer in self._classification_model.layers if isinstance(layer, Model)][0]
+        self._embedding_cache.clear()
         return
 
 if __name__ == '__main__':
-    MNISTDigitCompare = SharedVisionModel()
-    MNISTDigitCompare.train_model()
-    MNISTDigitCompare.evaluate_model()
-    MNISTDigitCompare.save_model()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint-dir', default='checkpoints/sample_model', help='directory of the training checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    parser.add_argument('--augment', action='store_true',
+                        help='randomly shift, rotate and distort the training images in background threads')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    input_pipeline = None
+    if args.augment:
+        from augmentation import BatchAugmenter
+        from mnist_input_pipeline import InputPipeline
+        input_pipeline = InputPipeline(augment=BatchAugmenter())
+    with instrumentation.session(args.profile, args.trace, args.cprofile):
+        MNISTDigitCompare = SharedVisionModel(input_pipeline=input_pipeline, checkpoint_dir=args.checkpoint_dir)
+        MNISTDigitCompare.train_model(resume=args.resume)
+        MNISTDigitCompare.evaluate_model()
+        MNISTDigitCompare.save_model()
@@ -0,0 +1,149 @@
+'''
+Export trained Keras models as float32, float16 and int8 post-training-quantized TFLite
+models and compare their size, latency and accuracy against the Keras model
+'''
+import os
+import tempfile
+import time
+
+import numpy as np
+
+EXPORT_MODES = ['float32', 'float16', 'int8']
+
+
+def convert_to_tflite(keras_model, mode='float32', representative_inputs=None):
+    '''
+    convert a Keras model to a TFLite flatbuffer
+
+    :param keras_model: keras model
+    :param mode: 'float32', 'float16' for float16 weights or 'int8' for full integer
+        quantization of weights and activations, with float fallback for unsupported ops
+    :param representative_inputs: list with one array of sample inputs per model input,
+        required to calibrate the int8 activation ranges
+    :return: bytes of the TFLite model
+    '''
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if mode == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        if representative_inputs is None:
+            raise ValueError('int8 quantization needs representative inputs')
+
+        def representative_dataset():
+            for i in range(len(representative_inputs[0])):
+                yield [inputs[i:i+1].astype(np.float32) for inputs in representative_inputs]
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+    elif mode != 'float32':
+        raise ValueError('Invalid export mode {}'.format(mode))
+    return converter.convert()
+
+
+class TFLiteModel:
+    '''
+    Minimal predict interface over a TFLite interpreter
+    '''
+    def __init__(self, model_path, num_threads=None):
+        '''
+
+        :param model_path: path of the .tflite file
+        :param num_threads: number of interpreter threads
+        '''
+        import tensorflow as tf
+        self._interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+        self._input_details = self._interpreter.get_input_details()
+        self._output_details = self._interpreter.get_output_details()
+        return
+
+    def predict_on_batch(self, inputs):
+        '''
+        run one batch, resizing the interpreter inputs to the batch size if needed
+
+        :param inputs: list with one array per model input
+        :return: first model output
+        '''
+        resized = False
+        for detail, x in zip(self._input_details, inputs):
+            if tuple(detail['shape']) != x.shape:
+                self._interpreter.resize_tensor_input(detail['index'], x.shape)
+                resized = True
+        if resized:
+            self._interpreter.allocate_tensors()
+            self._input_details = self._interpreter.get_input_details()
+        for detail, x in zip(self._input_details, inputs):
+            self._interpreter.set_tensor(detail['index'], x.astype(detail['dtype']))
+        self._interpreter.invoke()
+        return self._interpreter.get_tensor(self._output_details[0]['index'])
+
+    def predict(self, inputs, batch_size=1):
+        '''
+        :param inputs: list with one array per model input
+        :param batch_size: size of batches
+        :return: first model output for every sample
+        '''
+        return np.concatenate([self.predict_on_batch([x[i:i+batch_size] for x in inputs])
+                               for i in range(0, len(inputs[0]), batch_size)])
+
+
+def single_sample_latency_ms(predict_on_batch, inputs, repeat=100):
+    '''
+    :return: median latency in ms of predicting one sample
+    '''
+    sample = [x[:1] for x in inputs]
+    predict_on_batch(sample)
+    times = []
+    for i in range(repeat):
+        sample = [x[i % len(x):i % len(x) + 1] for x in inputs]
+        start = time.perf_counter()
+        predict_on_batch(sample)
+        times.append((time.perf_counter() - start) * 1000.)
+    return float(np.median(times))
+
+
+def export_and_report(keras_model, export_prefix, representative_inputs, eval_inputs, eval_targets, modes=None):
+    '''
+    export a Keras model in every mode and compare each export against the Keras model
+
+    :param keras_model: keras model whose first output is a softmax
+    :param export_prefix: path prefix of the exported files, the mode and .tflite are appended
+    :param representative_inputs: list with one array of calibration inputs per model input
+    :param eval_inputs: list with one array of evaluation inputs per model input
+    :param eval_targets: integer class of every evaluation sample
+    :param modes: export modes, defaults to EXPORT_MODES
+    :return: dictionary of size, latency and accuracy per format
+    '''
+    modes = modes if modes is not None else EXPORT_MODES
+    #the .h5 copy is only written to measure its size
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        keras_path = os.path.join(tmp_dir, 'model.h5')
+        keras_model.save(keras_path)
+        keras_size = os.path.getsize(keras_path)
+
+    def first_output(outputs):
+        return outputs[0] if isinstance(outputs, list) else outputs
+    keras_accuracy = float(np.mean(np.argmax(first_output(keras_model.predict(eval_inputs)), axis=1) == eval_targets))
+    report = {'keras': {'size_bytes': keras_size,
+                        'latency_ms': single_sample_latency_ms(lambda x: keras_model.predict_on_batch(x), eval_inputs),
+                        'accuracy': keras_accuracy,
+                        'accuracy_delta': 0.}}
+    for mode in modes:
+        path = '{}_{}.tflite'.format(export_prefix, mode)
+        with open(path, 'wb') as f:
+            f.write(convert_to_tflite(keras_model, mode, representative_inputs))
+        tflite_model = TFLiteModel(path)
+        accuracy = float(np.mean(np.argmax(tflite_model.predict(eval_inputs), axis=1) == eval_targets))
+        report[mode] = {'path': path,
+                        'size_bytes': os.path.getsize(path),
+                        'latency_ms': single_sample_latency_ms(tflite_model.predict_on_batch, eval_inputs),
+                        'accuracy': accuracy,
+                        'accuracy_delta': accuracy - keras_accuracy}
+
+    print('{:<10} {:>12} {:>12} {:>10} {:>10}'.format('format', 'size (KB)', 'latency (ms)', 'accuracy', 'delta'))
+    for name, row in report.items():
+        print('{:<10} {:>12.1f} {:>12.3f} {:>10.4f} {:>+10.4f}'.format(name, row['size_bytes'] / 1024.,
+                                                                      row['latency_ms'], row['accuracy'],
+                                                                      row['accuracy_delta']))
+    return report
@@ -1,17 +1,18 @@
 from __future__ import print_function
 
+import argparse
 import numpy as np
 import random
-import sys
 import io
-import keras
 
 from collections import namedtuple
-from keras.callbacks import LambdaCallback
-from keras.layers import Dense, LSTM, Input
-from keras.models import Model
-from keras.optimizers import RMSprop
-from keras.utils.data_utils import get_file
+
+import instrumentation
+from bpe_tokenizer import BPETokenizer
+from dataset_cache import DatasetCache
+from embedding_cache import EmbeddingCache
+from model_export import export_and_report
+from text_sampling import Sampler
 
 class TextGeneration:
     '''
@@ -20,36 +21,122 @@ class TextGeneration:
         https://github.com/keras-team/keras/blob/master/examples/lstm_text_generation.py
     I am reformatting it into a class structure as way to learn and understand text generation
     I am also using the Keras Functional API instead of the Sequential API used in the example code
+    The corpus, the training data and the model are only built on first use and keras is
+    only imported then, so loading a saved model for generation skips the training data
     '''
-    def __init__(self, corpus_name='Nietzche', sentence_char_len = 40, step = 3):
+    def __init__(self, corpus_name='Nietzche', sentence_char_len = 40, step = 3, sampler = None, sparse_labels = False,
+                 epochs = 60, batch_size = 128, data_path = None, cache_dir = None, checkpoint_dir = None,
+                 max_checkpoints = 3, tokenizer_vocab_size = None, streaming = False, sentences_per_epoch = None,
+                 prediction_cache_size = 0):
         '''
 
         :param corpus_name: name of corpuse
         :param sentence_char_len: length of each sentence in terms of characters
         :param step: overlapping step size between training sentences
+        :param sampler: text_sampling.Sampler used to pick generated characters,
+            defaults to unseeded cumulative sum sampling
+        :param sparse_labels: train on integer next character targets with
+            sparse_categorical_crossentropy instead of one hot targets
+        :param epochs: number of epochs
+        :param batch_size: size of batches
+        :param data_path: local text file to use as the corpus instead of downloading corpus_name
+        :param cache_dir: directory of the preprocessed dataset cache, see dataset_cache.DatasetCache
+        :param checkpoint_dir: directory to save a checkpoint to in the background after every epoch,
+            see checkpointing.CheckpointManager. replaces saving the model every 5 epochs
+        :param max_checkpoints: number of most recent checkpoints to keep
+        :param tokenizer_vocab_size: train a bpe_tokenizer.BPETokenizer with this many tokens on the
+            corpus and feed the LSTM embedded tokens instead of one hot characters. sentence_char_len
+            and step then count tokens, so the same window covers several times more text and every
+            step generates a whole token
+        :param streaming: for corpora larger than memory, build the vocabulary and the encoded
+            corpus in bounded chunks and train on sentences at random multiples of step into
+            the memory-mapped corpus, see text_generation_data.RandomWindowSequence
+        :param sentences_per_epoch: sentences drawn per epoch in streaming mode, defaults to the
+            number of sentences of the corpus
+        :param prediction_cache_size: number of next character probability vectors cached by
+            context window for windowed generation, repeated seeds and repeated text then skip
+            the model. 0 disables the cache
         '''
+        if streaming and tokenizer_vocab_size is not None:
+            raise ValueError('Streaming corpora are only supported for the character model')
         self._model_name = corpus_name
+        if tokenizer_vocab_size is not None:
+            self._model_name = '{}_bpe{}'.format(corpus_name, tokenizer_vocab_size)
+        self._corpus_name = corpus_name
         self._sentence_char_len = sentence_char_len
-
-        self._text = None
+        self._step = step
+        self._sampler = sampler if sampler is not None else Sampler()
+        self._sparse_labels = sparse_labels
+        self._epochs = epochs
+        self._batch_size = batch_size
+        self._data_path = data_path
+        self._dataset_cache = DatasetCache(cache_dir)
+        self._checkpoint_manager = None
+        if checkpoint_dir is not None:
+            from checkpointing import CheckpointManager
+            self._checkpoint_manager = CheckpointManager(checkpoint_dir, max_checkpoints)
+
+        self._tokenizer_vocab_size = tokenizer_vocab_size
+        self._tokenizer = None
+        self._streaming = streaming
+        self._sentences_per_epoch = sentences_per_epoch
+        self._vocabulary = None #sorted characters of the corpus, or the tokens of the tokenizer
+        self._encoded_text = None #one integer index per character, or token, of the corpus
         self._num_chars = None
-        self._load_data(corpus_name)
-
+        self._symbol_lengths = None #number of characters of every vocabulary entry
         self._indices_char_dict = None
         self._char_indices_dict = None
-        self._generate_char_index()
+        self._training_sequence = None #serves training input and target batches
+        self._text_generation_model = None
+        self._decoding_models = {} #stateful single step copies keyed by batch size
+        self._numpy_model = None #numpy_lstm.NumpyLSTM copy of the model for generation without keras
+        self._prediction_cache_size = prediction_cache_size
+        self._prediction_cache = None #next character probabilities keyed by encoded context window
+        return
 
-        self._sentences = None #training input
-        self._next_chars = None #training target
-        self._generate_training_data(step)
+    def build(self):
+        '''
+        load the corpus, create the training data and define the model now instead of on first use
+        '''
+        self._get_training_sequence()
+        self._get_model()
+        return
 
-        self._text_generation_model = None
-        self._define_model()
+    def _load_corpus(self):
+        '''
+        load the encoded corpus and its character indices on first use
+        '''
+        if self._vocabulary is None:
+            with instrumentation.timer('text.load_data'):
+                self._load_data(self._corpus_name)
+                self._generate_char_index()
         return
 
+    def _get_training_sequence(self):
+        '''
+        :return: the SentenceSequence over the corpus, created on first use
+        '''
+        if self._training_sequence is None:
+            self._load_corpus()
+            with instrumentation.timer('text.build_windows'):
+                self._generate_training_data(self._step)
+        return self._training_sequence
+
+    def _get_model(self):
+        '''
+        :return: the text generation model, defined and compiled on first use
+        '''
+        if self._text_generation_model is None:
+            self._load_corpus()
+            with instrumentation.timer('text.define_model'):
+                self._define_model()
+        return self._text_generation_model
+
     def _load_data(self, corpus_name):
         '''
         load corpus data
+        the lowercased corpus is integer encoded once and cached on disk together with
+        its vocabulary, later runs memory-map both from the dataset cache
 
         :param corpus_name: corpus name, for now only using Nietzche data
         :return:
@@ -62,28 +149,56 @@ class TextGeneration:
             'Nietzche': CorpusEntry('nietzsche.txt', 'https://s3.amazonaws.com/text-datasets/nietzsche.txt')
             }
 
-        #make sure corpus exists
-        if dict_corpus.get(corpus_name) is None:
-            raise ValueError('Invalid Corpus {}'.format(corpus_name))
-
-        #load corpus
-        path = get_file(dict_corpus[corpus_name].file_name, origin=dict_corpus[corpus_name].website)
-        with io.open(path, encoding='utf-8') as f:
-            text = f.read().lower()
-        self._text = text
+        if self._data_path is not None:
+            path = self._data_path
+        else:
+            from keras.utils.data_utils import get_file
+            #make sure corpus exists
+            if dict_corpus.get(corpus_name) is None:
+                raise ValueError('Invalid Corpus {}'.format(corpus_name))
+            path = get_file(dict_corpus[corpus_name].file_name, origin=dict_corpus[corpus_name].website)
+
+        def build():
+            from text_generation_data import encode_text
+            #load corpus
+            with io.open(path, encoding='utf-8') as f:
+                text = f.read().lower()
+            if self._tokenizer_vocab_size is not None:
+                tokenizer = BPETokenizer.train(text, self._tokenizer_vocab_size)
+                arrays = tokenizer.to_arrays()
+                arrays['encoded_text'] = tokenizer.encode(text)
+                return arrays
+            chars = sorted(list(set(text)))
+            return {'vocabulary': np.array(chars), 'encoded_text': encode_text(text, chars)}
+        if self._tokenizer_vocab_size is not None:
+            key = DatasetCache.key('corpus', self._dataset_cache.source_digest(path), 'lower', 'bpe',
+                                   self._tokenizer_vocab_size)
+        else:
+            key = DatasetCache.key('corpus', self._dataset_cache.source_digest(path), 'lower')
+        if self._streaming:
+            from text_generation_data import encode_text_file
+            #same arrays as build, so both modes share the cache entry
+            arrays = self._dataset_cache.load_or_build_files(key, lambda entry_dir: encode_text_file(path, entry_dir))
+        else:
+            arrays = self._dataset_cache.load_or_build(key, build)
+        self._vocabulary = arrays['vocabulary']
+        self._encoded_text = arrays['encoded_text']
+        if self._tokenizer_vocab_size is not None:
+            self._tokenizer = BPETokenizer(arrays['vocabulary'], arrays['merges'])
         return
 
     def _generate_char_index(self):
         '''
-        enumerate all the characters used in text to have an index
+        enumerate all the characters of the vocabulary to have an index
         save characters and its corresponding index number to two dictionary
             dict 1: key->index, value->character
             dict 2: key->character, value->index
         this will be used for character embeddings
         :return:
         '''
-        chars = sorted(list(set(self._text)))
+        chars = [str(c) for c in self._vocabulary]
         self._num_chars = len(chars)
+        self._symbol_lengths = np.array([len(c) for c in chars])
         self._indices_char_dict = dict((i, c) for i, c in enumerate(chars))
         self._char_indices_dict = dict((c, i) for i, c in enumerate(chars))
         return
@@ -95,134 +210,358 @@ class TextGeneration:
             a string of characters of length sentence_char_len in vectorized form
         training output will be the next character in text after the "sentence"
             also in vectorized form
+        sentences are strided views into the encoded corpus and are only
+        vectorized one batch at a time during training, in streaming mode they are drawn
+        at random multiples of step into the memory-mapped corpus
 
         :param step: overlapping step size between sentences
         :return:
         '''
-
-        def vectorize_chars(char_string):
-            '''
-            vectorize a list of characters
-            :param sentence:
-            :return:
-            '''
-            char_vectors = np.zeros((len(char_string), self._num_chars), dtype=np.bool)
-            #one hot incode
-            for i, char in enumerate(char_string):
-                char_vectors[i, self._char_indices_dict[char]] = 1
-            return char_vectors
-
-        text_char_len = len(self._text)
-        num_sentences = int(((text_char_len - self._sentence_char_len)/step)+1)
-
-        #initialize matricies
-        sentences = np.zeros((num_sentences, self._sentence_char_len, self._num_chars), dtype=np.bool)
-        next_chars = np.zeros((num_sentences, self._num_chars), dtype=np.bool)
-
-        #load text data from corpus into matrix form
-        for i in range(0, text_char_len - self._sentence_char_len, step):
-            sentence_string = self._text[i: i + self._sentence_char_len]
-            next_char_string = self._text[i + self._sentence_char_len]
-            sentences[int(i/step)] = vectorize_chars(sentence_string)
-            next_chars[int(i/step)] = vectorize_chars(next_char_string)
-        self._sentences = sentences
-        self._next_chars = next_chars
+        from text_generation_data import RandomWindowSequence, SentenceSequence
+        if self._streaming:
+            self._training_sequence = RandomWindowSequence(self._encoded_text,
+                                                           self._num_chars,
+                                                           self._sentence_char_len,
+                                                           step,
+                                                           batch_size=self._batch_size,
+                                                           sentences_per_epoch=self._sentences_per_epoch,
+                                                           sparse_labels=self._sparse_labels)
+            return
+        self._training_sequence = SentenceSequence(self._encoded_text,
+                                                   self._num_chars,
+                                                   self._sentence_char_len,
+                                                   step,
+                                                   batch_size=self._batch_size,
+                                                   sparse_labels=self._sparse_labels,
+                                                   one_hot_inputs=self._tokenizer is None)
         return
 
+    def _model_input(self, batch_shape):
+        '''
+        input of the text generation model, one hot characters or embedded tokens
+
+        :param batch_shape: batch size and window length, either may be None
+        :return: input layer, and the layer feeding the LSTM
+        '''
+        from keras.layers import Embedding, Input
+        if self._tokenizer is None:
+            text_input = Input(batch_shape=batch_shape + (self._num_chars,))
+            return text_input, text_input
+        text_input = Input(batch_shape=batch_shape)
+        #token 0 is padding, masked so left padded seeds leave the LSTM state alone
+        return text_input, Embedding(self._num_chars, 64, mask_zero=True)(text_input)
+
     def _define_model(self):
         '''
         define text generation model using Functional keras
 
         :return:
         '''
-        text_input = Input(shape=(self._sentence_char_len, self._num_chars))
-        hidden_layer = LSTM(128)(text_input)
+        from keras.layers import Dense, LSTM
+        from keras.models import Model
+        from keras.optimizers import RMSprop
+        text_input, hidden_layer = self._model_input((None, self._sentence_char_len))
+        hidden_layer = LSTM(128)(hidden_layer)
         out = Dense(self._num_chars, activation='softmax')(hidden_layer)
         self._text_generation_model = Model(text_input, out)
         optimizer = RMSprop(lr=0.01)
-        self._text_generation_model.compile(loss='categorical_crossentropy', optimizer=optimizer)
+        loss = 'sparse_categorical_crossentropy' if self._sparse_labels else 'categorical_crossentropy'
+        self._text_generation_model.compile(loss=loss, optimizer=optimizer)
+        return
+
+    def _get_decoding_model(self, batch_size=1):
+        '''
+        get a stateful copy of the text generation model that consumes any number of
+        characters per call and carries the LSTM hidden and cell state between calls
+        the weights are refreshed from _text_generation_model on every call so the copy
+        always matches the trained model
+
+        :param batch_size: number of streams decoded together
+        :return: stateful decoding model
+        '''
+        if batch_size not in self._decoding_models:
+            from keras.layers import Dense, LSTM
+            from keras.models import Model
+            text_input, hidden_layer = self._model_input((batch_size, None))
+            hidden_layer = LSTM(128, stateful=True)(hidden_layer)
+            out = Dense(self._num_chars, activation='softmax')(hidden_layer)
+            self._decoding_models[batch_size] = Model(text_input, out)
+        decoding_model = self._decoding_models[batch_size]
+        decoding_model.set_weights(self._get_model().get_weights())
+        decoding_model.reset_states()
+        return decoding_model
+
+    def _get_numpy_model(self):
+        '''
+        :return: NumpyLSTM copy of the text generation model, made on first use after the
+            weights change or loaded by load_numpy_model
+        '''
+        if self._numpy_model is None:
+            from numpy_lstm import NumpyLSTM
+            self._numpy_model = NumpyLSTM.from_keras_model(self._get_model())
+        return self._numpy_model
+
+    def _get_prediction_cache(self):
+        '''
+        :return: EmbeddingCache of next character probabilities, created on first use once the
+            vocabulary is known, or None if the cache is disabled or the vocabulary is not loaded yet
+        '''
+        if self._prediction_cache is None and self._prediction_cache_size > 0 and self._num_chars is not None:
+            self._prediction_cache = EmbeddingCache(self._prediction_cache_size, self._num_chars)
+        return self._prediction_cache
+
+    def _clear_prediction_cache(self):
+        '''
+        drop the cached probabilities, they are only valid for the weights they came from
+        '''
+        if self._prediction_cache is not None:
+            self._prediction_cache.clear()
         return
 
+    def prediction_cache_stats(self):
+        '''
+        :return: size, hits, misses and hit rate of the prediction cache since it was last
+            cleared, or None if the cache is disabled or nothing was generated yet
+        '''
+        cache = self._get_prediction_cache()
+        return cache.stats() if cache is not None else None
+
+    def _cached_predict(self, predict, windows):
+        '''
+        next character probabilities of every window, only windows that are neither cached nor
+        repeated within the batch are predicted
+
+        :param predict: function returning the probabilities of a batch of windows
+        :param windows: (batch, sentence_char_len) array of character, or token, indices
+        :return: (batch, num_chars) array of probabilities
+        '''
+        cache = self._get_prediction_cache()
+        if cache is None:
+            return predict(windows)
+        keys = [window.tobytes() for window in np.ascontiguousarray(windows, dtype=np.int64)]
+        preds, num_predicted = cache.get_or_compute(keys, lambda indices: predict(windows[indices]))
+        instrumentation.count('text.prediction_cache_hits', len(keys) - num_predicted)
+        return preds
+
     def _sample(self, preds, temperature=1.0):
-        # helper function to sample an index from a probability array
-        preds = np.asarray(preds).astype('float64')
-        preds = np.log(preds) / temperature
-        exp_preds = np.exp(preds)
-        preds = exp_preds / np.sum(exp_preds)
-        probas = np.random.multinomial(1, preds, 1)
-        return np.argmax(probas)
+        '''
+        helper function to sample indices from probability arrays
+
+        :param preds: probability array of shape (num_chars,) or (batch, num_chars)
+        :param temperature: a temperature for all rows or one temperature per row
+        :return: the sampled index, or an array with one sampled index per row
+        '''
+        return self._sampler.sample(preds, temperature)
 
     def _on_epoch_end(self, epoch, _):
         # Function invoked at end of each epoch. Prints generated text.
         # This code was essentially copied over from the example code
         print()
         print('----- Generating text after Epoch: %d' % epoch)
-
-        start_index = random.randint(0, len(self._text) - self._sentence_char_len - 1)
-        sentence = self._text[start_index: start_index + self._sentence_char_len]
-        self.generate_text(seed=sentence)
-        if epoch%5==0:
+        #the weights changed during the epoch
+        self._clear_prediction_cache()
+
+        start_index = random.randint(0, len(self._encoded_text) - self._sentence_char_len - 1)
+        #in tokenizer mode the seed is re-encoded, and left padded if that gives fewer tokens
+        sentence = ''.join(self._indices_char_dict[index]
+                           for index in self._encoded_text[start_index: start_index + self._sentence_char_len])
+        with instrumentation.timer('text.epoch_end_generation'):
+            self.generate_text(raw_seed=sentence)
+        #with a checkpoint manager every epoch is already saved in the background
+        if self._checkpoint_manager is None and epoch%5==0:
             self.save_model(save_path='epoch_'+str(epoch)+'_')
         return
 
-    def generate_text(self, raw_seed = None, num_char_to_generate = 400):
+    def generate_batch(self, seeds, temperatures, num_char_to_generate = 400, stateful = False, backend = 'keras'):
+        '''
+        Generates text for every (seed, temperature) pair at once
+        all streams are advanced together as one batch per step and their next
+        characters are sampled together
+
+        :param seeds: list of strings that must be equal to or longer than sentence_char_len characters
+        :param temperatures: list of sampling temperatures
+        :param num_char_to_generate: the number of characters to generate after each seed
+        :param stateful: decode incrementally, see generate_streams
+        :param backend: 'keras' or 'numpy', see generate_streams
+        :return: list of generated strings, excluding the seeds, ordered seed by seed
+            and temperature by temperature within each seed
+        '''
+        return self.generate_streams([seed for seed in seeds for _ in temperatures],
+                                     [temperature for _ in seeds for temperature in temperatures],
+                                     num_char_to_generate,
+                                     stateful=stateful,
+                                     backend=backend)
+
+    def generate_streams(self, seeds, temperatures, num_char_to_generate = 400, stateful = False, backend = 'keras'):
+        '''
+        Generates text for every seed with its own temperature
+        all streams are advanced together as one batch per step and their next
+        characters are sampled together
+
+        :param seeds: list of strings that must be equal to or longer than sentence_char_len characters,
+            in tokenizer mode seeds of any length are encoded and left padded to the window length
+        :param temperatures: sampling temperature of every seed
+        :param num_char_to_generate: the number of characters to generate after each seed
+        :param stateful: decode incrementally, priming a stateful copy of the LSTM with the
+            seeds once and then feeding it one character per step instead of re-running the
+            last sentence_char_len characters for every generated character. the stateful model
+            keeps the whole generated text as context rather than a sliding window
+        :param backend: 'keras' to predict with the keras model, or 'numpy' to run the same
+            model with numpy_lstm.NumpyLSTM, which avoids the per call overhead of keras
+            and, after load_numpy_model, does not import keras at all. windowed generation goes
+            through the prediction cache if it is enabled, stateful generation does not since its
+            context is more than the window
+        :return: list of generated strings, excluding the seeds
+        '''
+        if backend not in ('keras', 'numpy'):
+            raise ValueError('Invalid backend {}, expected keras or numpy'.format(backend))
+        self._load_corpus()
+        windows = np.array([self._encode_seed(raw_seed) for raw_seed in seeds])
+        stream_temperatures = np.array(temperatures, dtype='float64')
+        batch_size = len(windows)
+        if num_char_to_generate <= 0:
+            return ['' for _ in seeds]
+        if backend == 'numpy':
+            numpy_model = self._get_numpy_model()
+            predict = numpy_model.predict
+            if stateful:
+                numpy_model.reset(batch_size)
+                advance = numpy_model.feed
+        else:
+            model = self._get_model()
+            if self._tokenizer is None:
+                one_hot = np.eye(self._num_chars, dtype=np.float32)
+                model_inputs = lambda indices: one_hot[indices]
+            else:
+                model_inputs = lambda indices: indices
+            predict = lambda windows: model.predict(model_inputs(windows), batch_size=batch_size, verbose=0)
+            if stateful:
+                decoding_model = self._get_decoding_model(batch_size)
+                advance = lambda indices: np.asarray(decoding_model.predict_on_batch(model_inputs(indices)))
+        #a step generates one character, or one token of one or more characters
+        generated = []
+        generated_lengths = np.zeros(batch_size, dtype=np.int64)
+
+        if stateful:
+            #prime the hidden states with the whole seeds once
+            with instrumentation.timer('text.predict'):
+                preds = advance(windows)
+            instrumentation.count('text.predict_calls')
+        while True:
+            if not stateful:
+                with instrumentation.timer('text.predict'):
+                    preds = self._cached_predict(predict, windows)
+                instrumentation.count('text.predict_calls')
+            with instrumentation.timer('text.sample'):
+                next_indices = self._sample(preds, stream_temperatures)
+            generated.append(next_indices)
+            generated_lengths += self._symbol_lengths[next_indices]
+            if generated_lengths.min() >= num_char_to_generate:
+                break
+            if stateful:
+                #advance the carried states by the new characters only
+                with instrumentation.timer('text.predict'):
+                    preds = advance(next_indices[:, np.newaxis])
+                instrumentation.count('text.predict_calls')
+            else:
+                windows[:, :-1] = windows[:, 1:]
+                windows[:, -1] = next_indices
+        instrumentation.count('text.chars_generated', batch_size * num_char_to_generate)
+        return [''.join(self._indices_char_dict[index] for index in row)[:num_char_to_generate]
+                for row in np.stack(generated, axis=1)]
+
+    def _encode_seed(self, raw_seed):
+        '''
+        :param raw_seed: seed string
+        :return: the last window of the seed as character, or token, indices
+        '''
+        if self._tokenizer is not None:
+            tokens = self._tokenizer.encode(raw_seed.lower())[-self._sentence_char_len:]
+            window = np.zeros(self._sentence_char_len, dtype=np.int64)
+            window[self._sentence_char_len - len(tokens):] = tokens
+            return window
+        if len(raw_seed) < self._sentence_char_len:
+            raise ValueError('Seed must be at least {} characters: "{}"'.format(self._sentence_char_len, raw_seed))
+        #need to make sure seed is exactly sentence_char_len characters long
+        seed = raw_seed.lower()[len(raw_seed)-self._sentence_char_len:]
+        unknown_chars = set(seed) - set(self._char_indices_dict)
+        if unknown_chars:
+            raise ValueError('Seed has characters outside the vocabulary: {}'.format(sorted(unknown_chars)))
+        return np.array([self._char_indices_dict[char] for char in seed])
+
+    def generate_text(self, raw_seed = None, num_char_to_generate = 400, stateful = False, backend = 'keras'):
         '''
         Generates text using the model given a seed
+        the four diversities are generated together as one batch
 
-        :param seed: a string that must be equal to or longer than 40 characters
+        :param seed: a string that must be equal to or longer than sentence_char_len characters
         :param num_char_to_generate: the number of characters to generate after the seed
+        :param stateful: decode incrementally, see generate_batch
+        :param backend: 'keras' or 'numpy', see generate_streams
         :return: None
         '''
         if raw_seed is None:
             raw_seed = 'he who has a why to live can bear almost'
         raw_seed = raw_seed.lower()
-        if len(raw_seed) > 40:
-            #need to make sure seed is exactly 40 characters long
-            seed = raw_seed[len(raw_seed)-40:]
-        elif len(raw_seed) < 40:
-            print('Please input a seed of at least 40 characters')
+        if len(raw_seed) < self._sentence_char_len:
+            print('Please input a seed of at least {} characters'.format(self._sentence_char_len))
             return
-        else:
-            #seed is exactly 40 characters long
-            seed = raw_seed
-        for diversity in [0.2, 0.5, 1.0, 1.2]:
-            sentence = seed
+        diversities = [0.2, 0.5, 1.0, 1.2]
+        generated = self.generate_batch([raw_seed], diversities, num_char_to_generate, stateful=stateful,
+                                        backend=backend)
+        for diversity, generated_text in zip(diversities, generated):
             print('----- diversity:', diversity)
-            generated = ''
-            generated += sentence
             print('----- Generating with seed: "' + raw_seed + '"')
-            sys.stdout.write(raw_seed)
-            for i in range(num_char_to_generate):
-                x_pred = np.zeros((1, self._sentence_char_len, self._num_chars))
-                for t, char in enumerate(sentence):
-                    x_pred[0, t, self._char_indices_dict[char]] = 1.
-                preds = self._text_generation_model.predict(x_pred, verbose=0)[0]
-                next_index = self._sample(preds, diversity)
-                next_char = self._indices_char_dict[next_index]
-
-                generated += next_char
-                sentence = sentence[1:] + next_char
-
-                sys.stdout.write(next_char)
-                sys.stdout.flush()
-            print()
+            print(raw_seed + generated_text)
         return
 
 
-    def train_model(self, print_callback_flag = True):
+    def _get_training_state(self):
+        '''
+        :return: sentence order and sampler generator state, saved with every checkpoint
+        '''
+        return {'sequence': self._training_sequence.get_state(),
+                'sampler_rng': self._sampler.rng.bit_generator.state}
+
+    def _set_training_state(self, state):
+        self._get_training_sequence().set_state(state['sequence'])
+        self._sampler.rng.bit_generator.state = state['sampler_rng']
+        return
+
+    def train_model(self, print_callback_flag = True, resume = False, callbacks = None):
         '''
         train the model
 
+        :param print_callback_flag: print generated text after every epoch
+        :param resume: continue from the latest checkpoint in checkpoint_dir
+        :param callbacks: additional keras callbacks
         :return:
         '''
-        print_callback = LambdaCallback(on_epoch_end=self._on_epoch_end)
-        self._text_generation_model.fit(
-                                        self._sentences,
-                                        self._next_chars,
-                                        batch_size=128,
-                                        epochs=60,
-                                        callbacks=[print_callback] if print_callback_flag else None
-                                        )
+        from keras.callbacks import LambdaCallback
+        training_sequence = self._get_training_sequence()
+        model = self._get_model()
+        callbacks = list(callbacks) if callbacks is not None else []
+        if print_callback_flag:
+            callbacks.append(LambdaCallback(on_epoch_end=self._on_epoch_end))
+        initial_epoch = 0
+        if self._checkpoint_manager is not None:
+            from checkpointing import CheckpointCallback
+            if resume:
+                initial_epoch = self._checkpoint_manager.resume(model, self._set_training_state)
+            callbacks.append(CheckpointCallback(self._checkpoint_manager, self._get_training_state))
+        elif resume:
+            raise ValueError('Resuming needs a checkpoint_dir')
+        callbacks += instrumentation.epoch_callbacks('text.train', self._batch_size)
+        with instrumentation.timer('text.fit'):
+            model.fit_generator(
+                                training_sequence,
+                                epochs=self._epochs,
+                                callbacks=callbacks,
+                                initial_epoch=initial_epoch
+                                )
+        #the numpy copy and the cached predictions have the old weights
+        self._numpy_model = None
+        self._clear_prediction_cache()
         return
 
     def save_model(self, save_path=''):
@@ -232,10 +571,37 @@ class TextGeneration:
         :param save_path: path to save the model at
         :return:
         '''
-        self._text_generation_model.save(save_path+self._model_name+'.h5')
+        self._get_model().save(save_path+self._model_name+'.h5')
         print('Model saved to '+save_path+self._model_name+'.h5')
         return
 
+    def export_quantized(self, save_path='', num_representative_samples=200, num_eval_samples=1000):
+        '''
+        export float32, float16 and int8 quantized TFLite versions of the model and report
+        their size, latency and next character accuracy against the Keras model
+
+        :param save_path: path to save the exported models at
+        :param num_representative_samples: number of training sentences used to calibrate int8 quantization
+        :param num_eval_samples: number of training sentences used to compare accuracy
+        :return: dictionary of size, latency and accuracy per format
+        '''
+        training_sequence = self._get_training_sequence()
+        sentences = []
+        next_chars = []
+        for i in range(len(training_sequence)):
+            x, y = training_sequence[i]
+            sentences.append(x)
+            next_chars.append(y if y.ndim == 1 else np.argmax(y, axis=1))
+            if sum(len(batch) for batch in sentences) >= max(num_representative_samples, num_eval_samples):
+                break
+        sentences = np.concatenate(sentences).astype(np.float32)
+        next_chars = np.concatenate(next_chars)
+        return export_and_report(self._get_model(),
+                                 save_path+self._model_name,
+                                 [sentences[:num_representative_samples]],
+                                 [sentences[:num_eval_samples]],
+                                 next_chars[:num_eval_samples])
+
     def load_model(self, model_path):
         '''
         loads a model
@@ -243,7 +609,59 @@ class TextGeneration:
         :param model_path: path to the model
         :return:
         '''
+        import keras
         self._text_generation_model = keras.models.load_model(model_path)
+        self._decoding_models = {}
+        self._numpy_model = None
+        self._clear_prediction_cache()
+        return
+
+    def export_numpy(self, save_path='', num_check_windows=64, tolerance=1e-4):
+        '''
+        save the weights and the vocabulary as an .npz file that load_numpy_model generates
+        text from without keras, after checking the numpy model against the keras model
+
+        :param save_path: path to save the model at
+        :param num_check_windows: number of corpus windows the two models are compared on
+        :param tolerance: largest absolute difference of the softmax outputs accepted
+        :return: largest absolute difference of the softmax outputs
+        '''
+        from numpy_lstm import NumpyLSTM, max_abs_difference
+        self._load_corpus()
+        numpy_model = NumpyLSTM.from_keras_model(self._get_model())
+        starts = np.random.randint(0, len(self._encoded_text) - self._sentence_char_len, num_check_windows)
+        windows = np.asarray(self._encoded_text)[starts[:, np.newaxis] + np.arange(self._sentence_char_len)]
+        difference = max_abs_difference(self._get_model(), numpy_model, windows,
+                                        self._num_chars if self._tokenizer is None else None)
+        if difference > tolerance:
+            raise ValueError('NumPy model differs from the keras model by {}'.format(difference))
+        arrays = numpy_model.to_arrays()
+        arrays['vocabulary'] = np.asarray(self._vocabulary)
+        if self._tokenizer is not None:
+            arrays['merges'] = self._tokenizer.to_arrays()['merges']
+        np.savez(save_path+self._model_name+'.npz', **arrays)
+        print('NumPy model saved to '+save_path+self._model_name+'.npz, largest difference {:.2e}'.format(difference))
+        return difference
+
+    def load_numpy_model(self, model_path):
+        '''
+        load a model saved by export_numpy, for generate_streams with backend='numpy'
+        the vocabulary comes with the model, so neither the corpus nor keras is loaded
+
+        :param model_path: path to the .npz model
+        :return:
+        '''
+        from numpy_lstm import NumpyLSTM
+        with np.load(model_path) as f:
+            arrays = dict((name, f[name]) for name in f.files)
+        vocabulary = arrays.pop('vocabulary')
+        merges = arrays.pop('merges', None)
+        self._numpy_model = NumpyLSTM(**arrays)
+        #the vocabulary size may change along with the model
+        self._prediction_cache = None
+        self._vocabulary = vocabulary
+        self._tokenizer = BPETokenizer(vocabulary, merges) if merges is not None else None
+        self._generate_char_index()
         return
 
     def prompt(self):
@@ -265,8 +683,8 @@ class TextGeneration:
                 if raw_seed == 'exit':
                     print('Exiting...')
                     return
-                if len(raw_seed)<40:
-                    print('Please input a seed of at least 40 characters')
+                if len(raw_seed)<self._sentence_char_len:
+                    print('Please input a seed of at least {} characters'.format(self._sentence_char_len))
                     raw_seed = None
             while num_char_to_generate is None:
                 num_char_to_generate = input(input_number_of_characters)
@@ -289,8 +707,24 @@ class TextGeneration:
             num_char_to_generate = None
 
 if __name__ == '__main__':
-    NietzcheTextGeneration = TextGeneration()
-    NietzcheTextGeneration.train_model()
-    NietzcheTextGeneration.save_model()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint-dir', default='checkpoints/Nietzche', help='directory of the training checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint')
+    parser.add_argument('--data-path', default=None, help='local text file to train on instead of the Nietzsche corpus')
+    parser.add_argument('--streaming', action='store_true',
+                        help='encode the corpus in chunks and train from random offsets, for corpora larger than memory')
+    parser.add_argument('--sentences-per-epoch', type=int, default=None, help='sentences drawn per epoch when streaming')
+    parser.add_argument('--prediction-cache-size', type=int, default=0,
+                        help='next character probabilities cached by context window when generating, 0 disables')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    with instrumentation.session(args.profile, args.trace, args.cprofile):
+        NietzcheTextGeneration = TextGeneration(data_path=args.data_path,
+                                                checkpoint_dir=args.checkpoint_dir,
+                                                streaming=args.streaming,
+                                                sentences_per_epoch=args.sentences_per_epoch,
+                                                prediction_cache_size=args.prediction_cache_size)
+        NietzcheTextGeneration.train_model(resume=args.resume)
+        NietzcheTextGeneration.save_model()
     NietzcheTextGeneration.load_model('Nietzche.h5')
     NietzcheTextGeneration.prompt()
\ No newline at end of file
@@ -0,0 +1,227 @@
+'''
+NumPy inference of the TextGeneration model, without TensorFlow
+
+The trained LSTM(128) and softmax Dense layers, and the Embedding layer of the token
+model, are copied into plain arrays. The input projection of every vocabulary entry is
+precomputed with the bias folded in, one hot inputs select a row of the LSTM kernel
+so no input matmul is left, and every step runs the four gates through a single
+recurrent matmul into buffers that are allocated once per batch size. This removes the
+per call framework overhead that dominates predict for a model this small.
+'''
+import numpy as np
+
+
+def sigmoid(x, out):
+    np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1.
+    np.reciprocal(out, out=out)
+    return out
+
+
+def hard_sigmoid(x, out):
+    #keras 2 definition
+    np.multiply(x, 0.2, out=out)
+    out += 0.5
+    np.clip(out, 0., 1., out=out)
+    return out
+
+
+def tanh(x, out):
+    return np.tanh(x, out=out)
+
+
+def linear(x, out):
+    out[...] = x
+    return out
+
+
+ACTIVATIONS = \
+    {
+    'sigmoid': sigmoid,
+    'hard_sigmoid': hard_sigmoid,
+    'tanh': tanh,
+    'linear': linear,
+    }
+
+
+class NumpyLSTM:
+    '''
+    Stateful batched inference of an (Embedding,) LSTM, Dense softmax model
+    The state of every stream is carried between feed calls until reset, predict runs
+    whole windows from a zero state like the Keras model. An instance holds the buffers
+    of one batch at a time, so it must not be shared between threads
+    '''
+    def __init__(self, kernel, recurrent_kernel, bias, dense_kernel, dense_bias, embeddings=None,
+                 activation='tanh', recurrent_activation='hard_sigmoid'):
+        '''
+
+        :param kernel: (input_size, 4 * units) LSTM kernel, gates in the keras order i, f, c, o
+        :param recurrent_kernel: (units, 4 * units) LSTM recurrent kernel
+        :param bias: (4 * units,) LSTM bias
+        :param dense_kernel: (units, num_outputs) kernel of the softmax layer
+        :param dense_bias: (num_outputs,) bias of the softmax layer
+        :param embeddings: (vocabulary_size, input_size) Embedding weights of the token model, index 0
+            is masked padding. without embeddings inputs are one hot over input_size entries
+        :param activation: name of the LSTM activation
+        :param recurrent_activation: name of the LSTM recurrent activation
+        '''
+        activation = str(activation)
+        recurrent_activation = str(recurrent_activation)
+        for name in [activation, recurrent_activation]:
+            if name not in ACTIVATIONS:
+                raise ValueError('Unsupported activation {}, expected one of {}'.format(name, sorted(ACTIVATIONS)))
+        self._activation_name = activation
+        self._recurrent_activation_name = recurrent_activation
+        self._activation = ACTIVATIONS[activation]
+        self._recurrent_activation = ACTIVATIONS[recurrent_activation]
+        self._kernel = np.asarray(kernel, dtype=np.float32)
+        self._recurrent_kernel = np.ascontiguousarray(recurrent_kernel, dtype=np.float32)
+        self._bias = np.asarray(bias, dtype=np.float32)
+        self._dense_kernel = np.ascontiguousarray(dense_kernel, dtype=np.float32)
+        self._dense_bias = np.asarray(dense_bias, dtype=np.float32)
+        self._embeddings = None if embeddings is None else np.asarray(embeddings, dtype=np.float32)
+        self._units = self._recurrent_kernel.shape[0]
+        #input projection of every vocabulary entry with the bias folded in
+        if self._embeddings is None:
+            self._input_table = self._kernel + self._bias
+        else:
+            self._input_table = np.dot(self._embeddings, self._kernel) + self._bias
+        self._batch_size = None
+        return
+
+    @classmethod
+    def from_keras_model(cls, model):
+        '''
+        copy the weights of a trained TextGeneration model
+
+        :param model: keras model of an optional Embedding, an LSTM and a softmax Dense layer
+        :return: NumpyLSTM
+        '''
+        layers = dict((layer.__class__.__name__, layer) for layer in model.layers)
+        if 'LSTM' not in layers or 'Dense' not in layers:
+            raise ValueError('Expected an LSTM and a Dense layer, got {}'.format([layer.__class__.__name__
+                                                                                  for layer in model.layers]))
+        lstm_config = layers['LSTM'].get_config()
+        if layers['Dense'].get_config()['activation'] != 'softmax':
+            raise ValueError('Expected a softmax output layer')
+        if not lstm_config.get('use_bias', True):
+            raise ValueError('LSTM layers without a bias are not supported')
+        kernel, recurrent_kernel, bias = layers['LSTM'].get_weights()
+        dense_kernel, dense_bias = layers['Dense'].get_weights()
+        embeddings = layers['Embedding'].get_weights()[0] if 'Embedding' in layers else None
+        return cls(kernel, recurrent_kernel, bias, dense_kernel, dense_bias, embeddings,
+                   lstm_config['activation'], lstm_config['recurrent_activation'])
+
+    def to_arrays(self):
+        '''
+        :return: dictionary of arrays that NumpyLSTM(**arrays) is rebuilt from, to be saved with np.savez
+        '''
+        arrays = {'kernel': self._kernel,
+                  'recurrent_kernel': self._recurrent_kernel,
+                  'bias': self._bias,
+                  'dense_kernel': self._dense_kernel,
+                  'dense_bias': self._dense_bias,
+                  'activation': np.array(self._activation_name),
+                  'recurrent_activation': np.array(self._recurrent_activation_name)}
+        if self._embeddings is not None:
+            arrays['embeddings'] = self._embeddings
+        return arrays
+
+    def reset(self, batch_size):
+        '''
+        zero the state of batch_size streams, reallocating the buffers if the batch size changed
+        '''
+        if batch_size != self._batch_size:
+            self._batch_size = batch_size
+            self._h = np.zeros((batch_size, self._units), dtype=np.float32)
+            self._c = np.zeros((batch_size, self._units), dtype=np.float32)
+            self._gates = np.empty((batch_size, 4 * self._units), dtype=np.float32)
+            self._inputs = np.empty((batch_size, 4 * self._units), dtype=np.float32)
+            self._scratch = np.empty((batch_size, self._units), dtype=np.float32)
+            self._logits = np.empty((batch_size, len(self._dense_bias)), dtype=np.float32)
+        else:
+            self._h.fill(0.)
+            self._c.fill(0.)
+        return
+
+    def _step(self, indices):
+        '''
+        advance every stream by one input
+
+        :param indices: (batch_size,) input indices
+        '''
+        units = self._units
+        gates = self._gates
+        np.dot(self._h, self._recurrent_kernel, out=gates)
+        np.take(self._input_table, indices, axis=0, out=self._inputs)
+        gates += self._inputs
+        #input and forget gates are contiguous, the cell candidate and output gates follow
+        self._recurrent_activation(gates[:, :2 * units], out=gates[:, :2 * units])
+        self._activation(gates[:, 2 * units: 3 * units], out=gates[:, 2 * units: 3 * units])
+        self._recurrent_activation(gates[:, 3 * units:], out=gates[:, 3 * units:])
+        #c = f * c + i * g, h = o * activation(c)
+        self._c *= gates[:, units: 2 * units]
+        np.multiply(gates[:, :units], gates[:, 2 * units: 3 * units], out=self._scratch)
+        self._c += self._scratch
+        self._activation(self._c, out=self._scratch)
+        np.multiply(gates[:, 3 * units:], self._scratch, out=self._h)
+        return
+
+    def feed(self, indices):
+        '''
+        advance the carried state of every stream through a sequence of inputs
+
+        :param indices: (batch_size, steps) input indices
+        :return: (batch_size, num_outputs) softmax output after the last step
+        '''
+        indices = np.asarray(indices)
+        if self._batch_size != len(indices):
+            raise ValueError('Expected {} streams, got {}, call reset first'.format(self._batch_size, len(indices)))
+        for step in range(indices.shape[1]):
+            step_indices = indices[:, step]
+            if self._embeddings is not None and not step_indices.all():
+                #padding keeps the state of its stream, as the masked keras Embedding does
+                h, c = self._h.copy(), self._c.copy()
+                self._step(step_indices)
+                padded = step_indices == 0
+                self._h[padded] = h[padded]
+                self._c[padded] = c[padded]
+            else:
+                self._step(step_indices)
+        return self._softmax()
+
+    def predict(self, windows):
+        '''
+        run every window from a zero state, the equivalent of the keras model predict
+
+        :param windows: (batch_size, steps) input indices
+        :return: (batch_size, num_outputs) softmax outputs
+        '''
+        self.reset(len(windows))
+        return self.feed(windows)
+
+    def _softmax(self):
+        logits = self._logits
+        np.dot(self._h, self._dense_kernel, out=logits)
+        logits += self._dense_bias
+        logits -= np.max(logits, axis=1, keepdims=True)
+        np.exp(logits, out=logits)
+        logits /= np.sum(logits, axis=1, keepdims=True)
+        return logits.copy()
+
+
+def max_abs_difference(keras_model, numpy_model, windows, one_hot_size=None):
+    '''
+    compare the outputs of the keras model and of its NumpyLSTM copy
+
+    :param keras_model: trained keras model
+    :param numpy_model: NumpyLSTM built from keras_model
+    :param windows: (batch_size, steps) input indices
+    :param one_hot_size: vocabulary size if the keras model takes one hot inputs
+    :return: largest absolute difference between the softmax outputs
+    '''
+    windows = np.asarray(windows)
+    inputs = np.eye(one_hot_size, dtype=np.float32)[windows] if one_hot_size is not None else windows
+    expected = keras_model.predict(inputs, batch_size=len(windows), verbose=0)
+    return float(np.max(np.abs(expected - numpy_model.predict(windows))))
@@ -0,0 +1,121 @@
+import numpy as np
+import keras
+
+
+def sample_pairs(labels, num_pairs):
+    '''
+    draw index pairs of images, half of them showing the same digit and half not
+    the classes are balanced by construction, the second image of a pair is drawn
+    directly from the digit class it needs to have
+
+    :param labels: digit label of every image
+    :param num_pairs: number of pairs to draw
+    :return: (num_pairs, 2) array of image indices, and whether each pair matches
+    '''
+    num_match = num_pairs // 2
+    class_indices = [np.flatnonzero(labels == digit) for digit in range(10)]
+
+    idx_a = np.random.randint(0, len(labels), num_pairs)
+    labels_a = labels[idx_a]
+    #first half keeps the digit of a, second half shifts it to any other digit
+    labels_b = labels_a.copy()
+    labels_b[num_match:] = (labels_b[num_match:] + np.random.randint(1, 10, num_pairs - num_match)) % 10
+    idx_b = np.empty_like(idx_a)
+    for digit in range(10):
+        mask = labels_b == digit
+        idx_b[mask] = class_indices[digit][np.random.randint(0, len(class_indices[digit]), np.count_nonzero(mask))]
+
+    order = np.random.permutation(num_pairs)
+    pairs = np.stack((idx_a, idx_b), axis=1)[order]
+    return pairs, (labels_a == labels_b)[order].astype(np.uint8)
+
+
+class PairSequence(keras.utils.Sequence):
+    '''
+    Serves batches of image pairs for the shared vision model
+    Only index pairs into the shared image array are stored, the images of a pair
+    are gathered when its batch is requested
+    '''
+    def __init__(self, images, labels, num_pairs, batch_size=32, resample=True, preprocess=None, augment=None,
+                 sparse_labels=False, sampler=None):
+        '''
+
+        :param images: uint8 MNIST images of shape (N, 28, 28), not copied
+        :param labels: digit label of every image
+        :param num_pairs: number of pairs per epoch
+        :param batch_size: size of batches
+        :param resample: draw fresh pairs at the end of every epoch
+        :param preprocess: function applied to every uint8 batch of images before it is served
+        :param augment: function applied to every uint8 batch of images before preprocessing
+        :param sparse_labels: serve integer digit labels instead of one hot digit labels
+        :param sampler: function drawing the pairs of an epoch with the signature of sample_pairs,
+            for example hard_negative_mining.HardNegativeMiner.sample_pairs, defaults to sample_pairs
+        '''
+        self._images = np.reshape(images, (-1, 28, 28, 1))
+        self._labels = labels
+        self._num_pairs = num_pairs
+        self._batch_size = batch_size
+        self._resample = resample
+        self._preprocess = preprocess
+        self._augment = augment
+        self._sparse_labels = sparse_labels
+        self._one_hot = np.eye(10, dtype=np.float32)
+        self._sampler = sampler if sampler is not None else sample_pairs
+        self._pairs, self._match = self._sampler(self._labels, self._num_pairs)
+        return
+
+    def __len__(self):
+        return int(np.ceil(self._num_pairs / float(self._batch_size)))
+
+    def __getitem__(self, idx):
+        batch = slice(idx*self._batch_size, (idx+1)*self._batch_size)
+        return self._gather(self._pairs[batch], self._match[batch])
+
+    def _gather(self, pairs, match):
+        '''
+        gather the model inputs and targets for index pairs
+
+        :param pairs: (batch, 2) array of image indices
+        :param match: whether each pair matches
+        :return: ([digit_a, digit_b], [labels, digit_a_labels, digit_b_labels])
+        '''
+        idx_a = pairs[:, 0]
+        idx_b = pairs[:, 1]
+        digits = [self._images[idx_a], self._images[idx_b]]
+        if self._augment is not None:
+            digits = [self._augment(digit) for digit in digits]
+        if self._preprocess is not None:
+            digits = [self._preprocess(digit) for digit in digits]
+        labels_a = self._labels[idx_a]
+        labels_b = self._labels[idx_b]
+        if not self._sparse_labels:
+            labels_a = self._one_hot[labels_a]
+            labels_b = self._one_hot[labels_b]
+        return digits, [match, labels_a, labels_b]
+
+    def get_arrays(self):
+        '''
+        materialize every pair of the current epoch
+
+        :return: ([digit_a, digit_b], [labels, digit_a_labels, digit_b_labels])
+        '''
+        return self._gather(self._pairs, self._match)
+
+    def on_epoch_end(self):
+        if self._resample:
+            self._pairs, self._match = self._sampler(self._labels, self._num_pairs)
+        return
+
+    def get_state(self):
+        '''
+        :return: the pairs of the current epoch, to be saved with a checkpoint
+        '''
+        return {'pairs': self._pairs.copy(), 'match': self._match.copy()}
+
+    def set_state(self, state):
+        '''
+        continue from pairs saved by get_state
+        '''
+        self._pairs = np.asarray(state['pairs'])
+        self._match = np.asarray(state['match'])
+        return
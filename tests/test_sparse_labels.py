@@ -0,0 +1,95 @@
+'''
+Sparse integer labels must train every model exactly like one hot labels
+
+For each model both label formats are built on the same synthetic data with the same
+weights, their targets must agree and their losses and accuracies, evaluated with dropout
+inactive, must match output by output. The sparse labels must also take less memory.
+
+Usage:
+    python -m pytest tests/test_sparse_labels.py
+'''
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+keras = pytest.importorskip('keras')
+
+from run_benchmarks import synthetic_corpus, synthetic_mnist
+
+
+def build_pair(model_class, **kwargs):
+    '''
+    :return: the model built with one hot labels and with sparse labels, sharing their weights
+    '''
+    models = []
+    for sparse_labels in [False, True]:
+        #the same seed draws the same data order and pairs for both label formats
+        np.random.seed(0)
+        model = model_class(sparse_labels=sparse_labels, **kwargs)
+        model.build()
+        models.append(model)
+    dense, sparse = models
+    sparse._get_model().set_weights(dense._get_model().get_weights())
+    return dense, sparse
+
+
+def assert_same_scores(dense_model, sparse_model, inputs, dense_targets, sparse_targets):
+    '''
+    compare total loss, every output loss and every metric by position, the layer names
+    of the second model are uniquified by keras
+    '''
+    dense_scores = dense_model.evaluate(inputs, dense_targets, batch_size=64, verbose=0)
+    sparse_scores = sparse_model.evaluate(inputs, sparse_targets, batch_size=64, verbose=0)
+    assert len(dense_model.metrics_names) == len(sparse_model.metrics_names)
+    np.testing.assert_allclose(np.atleast_1d(dense_scores), np.atleast_1d(sparse_scores), rtol=1e-5, atol=1e-6)
+    return
+
+
+def test_number_recognition(tmp_path):
+    from mnist_number_recognition import NumberRecognition
+    data_path = synthetic_mnist(str(tmp_path), 600, 200)
+    dense, sparse = build_pair(NumberRecognition, data_path=data_path, cache_dir=str(tmp_path))
+    (dense_train, dense_test), (sparse_train, sparse_test) = dense._get_data_set(), sparse._get_data_set()
+    np.testing.assert_array_equal(dense_train['labels'].argmax(axis=1), sparse_train['labels'])
+    assert sparse_train['labels'].nbytes * 10 <= dense_train['labels'].nbytes
+
+    images = dense_test['images'] / 255.
+    assert_same_scores(dense._get_model(), sparse._get_model(), images, dense_test['labels'], sparse_test['labels'])
+
+
+def test_shared_vision_model(tmp_path):
+    from mnist_shared_vision_model import SharedVisionModel
+    data_path = synthetic_mnist(str(tmp_path), 600, 200)
+    dense, sparse = build_pair(SharedVisionModel, train_size=256, test_size=64, data_path=data_path,
+                               cache_dir=str(tmp_path))
+    dense_inputs, dense_targets = dense._get_data_set()[0].get_arrays()
+    sparse_inputs, sparse_targets = sparse._get_data_set()[0].get_arrays()
+    for dense_digits, sparse_digits in zip(dense_inputs, sparse_inputs):
+        np.testing.assert_array_equal(dense_digits, sparse_digits)
+    np.testing.assert_array_equal(dense_targets[0], sparse_targets[0])
+    for dense_labels, sparse_labels in zip(dense_targets[1:], sparse_targets[1:]):
+        np.testing.assert_array_equal(dense_labels.argmax(axis=1), sparse_labels)
+        assert sparse_labels.nbytes * 10 <= dense_labels.nbytes
+
+    inputs = [digits / 255. for digits in dense_inputs]
+    assert_same_scores(dense._get_model(), sparse._get_model(), inputs, dense_targets, sparse_targets)
+
+
+def test_text_generation(tmp_path):
+    from nietzsche_lstm_text_generation import TextGeneration
+    data_path = synthetic_corpus(str(tmp_path), 5000)
+    dense, sparse = build_pair(TextGeneration, data_path=data_path, cache_dir=str(tmp_path), batch_size=64)
+    dense_x, dense_y = dense._get_training_sequence()[0]
+    sparse_x, sparse_y = sparse._get_training_sequence()[0]
+    np.testing.assert_array_equal(dense_x, sparse_x)
+    np.testing.assert_array_equal(dense_y.argmax(axis=1), sparse_y)
+    assert sparse_y.nbytes * 4 <= dense_y.nbytes
+
+    inputs = dense_x.astype(np.float32)
+    assert_same_scores(dense._get_model(), sparse._get_model(), inputs, dense_y.astype(np.float32), sparse_y)
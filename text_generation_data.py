@@ -0,0 +1,231 @@
+import io
+import os
+import sys
+
+import numpy as np
+import keras
+
+import instrumentation
+
+
+def encode_text(text, chars):
+    '''
+    integer encode a string, one index per character
+
+    uses the smallest unsigned integer type that can hold the vocabulary so the
+    encoded corpus costs one or two bytes per character
+
+    :param text: string to encode
+    :param chars: sorted list of the characters in the vocabulary
+    :return: 1d numpy array of character indices
+    '''
+    dtype = np.uint8 if len(chars) <= 256 else np.uint16
+    #sorted characters are in code point order so searchsorted gives their index
+    vocab_codes = np.array([ord(c) for c in chars], dtype=np.uint32)
+    text_codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    return np.searchsorted(vocab_codes, text_codes).astype(dtype)
+
+
+def read_chunks(path, chunk_chars=1 << 22):
+    '''
+    read a utf-8 text file lowercased, a bounded number of characters at a time
+
+    :param path: path to the text file
+    :param chunk_chars: characters read at a time
+    :return: generator of lowercased strings
+    '''
+    with io.open(path, encoding='utf-8') as f:
+        for chunk in iter(lambda: f.read(chunk_chars), ''):
+            yield chunk.lower()
+
+
+def encode_text_file(path, directory, chunk_chars=1 << 22):
+    '''
+    integer encode a text file that may not fit in memory
+    the vocabulary is collected in one chunked pass and the file is then encoded and
+    appended to a .npy file chunk by chunk, so memory use is bounded by the chunk size.
+    writes vocabulary.npy and encoded_text.npy, the same arrays encode_text gives for the
+    whole lowercased file
+
+    :param path: path to the text file
+    :param directory: directory to write the .npy files into
+    :param chunk_chars: characters read at a time
+    :return: None
+    '''
+    #both passes work on code points, marking and looking up every unicode code point in a table
+    seen = np.zeros(sys.maxunicode + 1, dtype=bool)
+    length = 0
+    for chunk in read_chunks(path, chunk_chars):
+        seen[np.frombuffer(chunk.encode('utf-32-le'), dtype=np.uint32)] = True
+        length += len(chunk)
+    vocab_codes = np.flatnonzero(seen)
+    chars = [chr(code) for code in vocab_codes]
+    np.save(os.path.join(directory, 'vocabulary.npy'), np.array(chars))
+
+    dtype = np.uint8 if len(chars) <= 256 else np.uint16
+    char_indices = np.zeros(sys.maxunicode + 1, dtype=dtype)
+    char_indices[vocab_codes] = np.arange(len(chars))
+    #plain writes instead of a writable memory map, whose dirty pages would count towards RSS
+    with open(os.path.join(directory, 'encoded_text.npy'), 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order': False,
+                                                 'shape': (length,)})
+        for chunk in read_chunks(path, chunk_chars):
+            f.write(char_indices[np.frombuffer(chunk.encode('utf-32-le'), dtype=np.uint32)].tobytes())
+    return
+
+
+def sliding_windows(encoded_text, sentence_char_len, step):
+    '''
+    strided view of every training "sentence" in the encoded text
+    no data is copied, row i is encoded_text[i*step: i*step + sentence_char_len]
+
+    :param encoded_text: 1d array of character indices
+    :param sentence_char_len: length of each sentence in terms of characters
+    :param step: overlapping step size between sentences
+    :return: read only array of shape (num_sentences, sentence_char_len)
+    '''
+    num_sentences = max(0, (len(encoded_text) - sentence_char_len - 1) // step + 1)
+    item_size = encoded_text.strides[0]
+    return np.lib.stride_tricks.as_strided(encoded_text,
+                                           shape=(num_sentences, sentence_char_len),
+                                           strides=(step*item_size, item_size),
+                                           writeable=False)
+
+
+class SentenceSequence(keras.utils.Sequence):
+    '''
+    Serves batches of (sentence, next character) pairs from an integer encoded corpus
+    Only the current batch is one hot encoded, so memory is O(corpus) instead of
+    O(corpus x sentence_char_len x num_chars)
+    '''
+    def __init__(self, encoded_text, num_chars, sentence_char_len, step, batch_size=128, shuffle=True, sparse_labels=False,
+                 one_hot_inputs=True):
+        '''
+
+        :param encoded_text: 1d array of character indices
+        :param num_chars: size of the vocabulary
+        :param sentence_char_len: length of each sentence in terms of characters
+        :param step: overlapping step size between sentences
+        :param batch_size: size of batches
+        :param shuffle: reshuffle the sentences at the end of every epoch
+        :param sparse_labels: serve the next character as an integer index instead of one hot
+        :param one_hot_inputs: serve sentences one hot encoded, otherwise as integer indices for
+            an Embedding input
+        '''
+        self._sentences = sliding_windows(encoded_text, sentence_char_len, step)
+        self._next_chars = encoded_text[sentence_char_len::step][:len(self._sentences)]
+        self._one_hot = np.eye(num_chars, dtype=bool)
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._sparse_labels = sparse_labels
+        self._one_hot_inputs = one_hot_inputs
+        self._order = np.arange(len(self._sentences))
+        instrumentation.count('text.windows_built', len(self._sentences))
+        self.on_epoch_end()
+        return
+
+    def __len__(self):
+        return int(np.ceil(len(self._sentences) / float(self._batch_size)))
+
+    def __getitem__(self, idx):
+        batch = self._order[idx*self._batch_size: (idx+1)*self._batch_size]
+        x = self._sentences[batch]
+        if self._one_hot_inputs:
+            x = self._one_hot[x]
+        y = self._next_chars[batch]
+        if not self._sparse_labels:
+            y = self._one_hot[y]
+        return x, y
+
+    def on_epoch_end(self):
+        if self._shuffle:
+            np.random.shuffle(self._order)
+        return
+
+    def get_state(self):
+        '''
+        :return: the current sample order, to be saved with a checkpoint
+        '''
+        return {'order': self._order.copy()}
+
+    def set_state(self, state):
+        '''
+        continue from a sample order saved by get_state
+        '''
+        self._order = np.asarray(state['order'])
+        return
+
+
+class RandomWindowSequence(keras.utils.Sequence):
+    '''
+    Serves batches of (sentence, next character) pairs from random offsets into an integer
+    encoded corpus, usually memory-mapped
+    Sentences start at multiples of step as in SentenceSequence, but every batch draws its
+    sentences with replacement instead of walking a shuffled index of every sentence, so
+    memory does not grow with the corpus and only the pages under the drawn sentences are read
+    '''
+    def __init__(self, encoded_text, num_chars, sentence_char_len, step, batch_size=128, sentences_per_epoch=None,
+                 sparse_labels=False, one_hot_inputs=True):
+        '''
+
+        :param encoded_text: 1d array of character indices
+        :param num_chars: size of the vocabulary
+        :param sentence_char_len: length of each sentence in terms of characters
+        :param step: overlapping step size between sentences
+        :param batch_size: size of batches
+        :param sentences_per_epoch: sentences drawn per epoch, defaults to the number of
+            sentences SentenceSequence serves for the same corpus
+        :param sparse_labels: serve the next character as an integer index instead of one hot
+        :param one_hot_inputs: serve sentences one hot encoded, otherwise as integer indices for
+            an Embedding input
+        '''
+        self._encoded_text = encoded_text
+        self._num_sentences = max(0, (len(encoded_text) - sentence_char_len - 1) // step + 1)
+        if self._num_sentences == 0:
+            raise ValueError('Corpus of {} characters is shorter than a sentence'.format(len(encoded_text)))
+        self._sentences_per_epoch = sentences_per_epoch if sentences_per_epoch is not None else self._num_sentences
+        self._sentence_char_len = sentence_char_len
+        self._step = step
+        self._char_offsets = np.arange(sentence_char_len)
+        self._one_hot = np.eye(num_chars, dtype=bool)
+        self._batch_size = batch_size
+        self._sparse_labels = sparse_labels
+        self._one_hot_inputs = one_hot_inputs
+        self._seed = None
+        self.on_epoch_end()
+        return
+
+    def __len__(self):
+        return int(np.ceil(self._sentences_per_epoch / float(self._batch_size)))
+
+    def __getitem__(self, idx):
+        #a batch only depends on the epoch seed and its index, so workers can build batches in any order
+        rng = np.random.default_rng([self._seed, idx])
+        size = min(self._batch_size, self._sentences_per_epoch - idx*self._batch_size)
+        starts = np.sort(rng.integers(0, self._num_sentences, size)) * self._step
+        x = self._encoded_text[starts[:, np.newaxis] + self._char_offsets]
+        if self._one_hot_inputs:
+            x = self._one_hot[x]
+        y = self._encoded_text[starts + self._sentence_char_len]
+        if not self._sparse_labels:
+            y = self._one_hot[y]
+        return x, y
+
+    def on_epoch_end(self):
+        #drawn from the global generator so np.random.seed and checkpoints cover it
+        self._seed = int(np.random.randint(2**31 - 1))
+        return
+
+    def get_state(self):
+        '''
+        :return: the seed of the current epoch, to be saved with a checkpoint
+        '''
+        return {'seed': self._seed}
+
+    def set_state(self, state):
+        '''
+        continue from an epoch seed saved by get_state
+        '''
+        self._seed = int(state['seed'])
+        return
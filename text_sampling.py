@@ -0,0 +1,125 @@
+import numpy as np
+
+
+def apply_temperature(preds, temperature=1.0):
+    '''
+    rescale probabilities by temperature
+
+    :param preds: probability array of shape (batch, num_chars)
+    :param temperature: a temperature for all rows or one temperature per row
+    :return: logits of shape (batch, num_chars), normalized so each row's maximum is 0
+    '''
+    temperature = np.reshape(np.asarray(temperature, dtype='float64'), (-1, 1))
+    with np.errstate(divide='ignore'):
+        logits = np.log(np.asarray(preds, dtype='float64')) / temperature
+    return logits - np.max(logits, axis=1, keepdims=True)
+
+
+def top_k_filter(logits, k):
+    '''
+    keep only the k most likely indices of every row
+
+    :param logits: array of shape (batch, num_chars)
+    :param k: number of indices to keep per row
+    :return: logits with every other index set to -inf
+    '''
+    if k >= logits.shape[1]:
+        return logits
+    kth_largest = -np.partition(-logits, k - 1, axis=1)[:, k - 1:k]
+    return np.where(logits < kth_largest, -np.inf, logits)
+
+
+def top_p_filter(logits, p):
+    '''
+    keep the smallest set of most likely indices of every row whose
+    probabilities add up to at least p (nucleus sampling)
+
+    :param logits: array of shape (batch, num_chars)
+    :param p: cumulative probability to keep, between 0 and 1
+    :return: logits with every other index set to -inf
+    '''
+    order = np.argsort(-logits, axis=1)
+    sorted_logits = np.take_along_axis(logits, order, axis=1)
+    sorted_probs = np.exp(sorted_logits)
+    sorted_probs /= np.sum(sorted_probs, axis=1, keepdims=True)
+    #probability mass before each index, the most likely index is always kept
+    mass_before = np.cumsum(sorted_probs, axis=1) - sorted_probs
+    sorted_logits[mass_before >= p] = -np.inf
+    filtered = np.empty_like(logits)
+    np.put_along_axis(filtered, order, sorted_logits, axis=1)
+    return filtered
+
+
+def gumbel_max(logits, rng):
+    '''
+    sample one index per row by adding Gumbel noise and taking the argmax
+
+    :param logits: array of shape (batch, num_chars)
+    :param rng: np.random.Generator
+    :return: array of one sampled index per row
+    '''
+    return np.argmax(logits + rng.gumbel(size=logits.shape), axis=1)
+
+
+def inverse_cdf(logits, rng):
+    '''
+    sample one index per row with a single searchsorted over the row-offset
+    cumulative distributions of the whole batch
+
+    :param logits: array of shape (batch, num_chars)
+    :param rng: np.random.Generator
+    :return: array of one sampled index per row
+    '''
+    batch_size, num_chars = logits.shape
+    cumulative = np.cumsum(np.exp(logits), axis=1)
+    cumulative /= cumulative[:, -1:]
+    #row i covers (i, i+1] so all rows can be searched at once
+    rows = np.arange(batch_size)
+    draws = rng.random(batch_size) + rows
+    flat_indices = np.searchsorted((cumulative + rows[:, np.newaxis]).ravel(), draws, side='right')
+    return np.minimum(flat_indices - rows*num_chars, num_chars - 1)
+
+
+class Sampler:
+    '''
+    Samples next character indices for a whole batch of probability arrays
+    Owns its own np.random.Generator so runs are reproducible given a seed
+    '''
+    methods = {'gumbel': gumbel_max, 'cumsum': inverse_cdf}
+
+    def __init__(self, method='cumsum', top_k=None, top_p=None, seed=None):
+        '''
+
+        :param method: 'cumsum' for inverse cdf sampling or 'gumbel' for Gumbel-max sampling
+        :param top_k: if set, only sample from the top_k most likely indices
+        :param top_p: if set, only sample from the nucleus of cumulative probability top_p
+        :param seed: seed for the random generator
+        '''
+        if method not in self.methods:
+            raise ValueError('Invalid sampling method {}'.format(method))
+        self._method = self.methods[method]
+        self._top_k = top_k
+        self._top_p = top_p
+        self._rng = np.random.default_rng(seed)
+        return
+
+    @property
+    def rng(self):
+        return self._rng
+
+    def sample(self, preds, temperature=1.0):
+        '''
+        sample an index from every row of a probability array
+
+        :param preds: probability array of shape (num_chars,) or (batch, num_chars)
+        :param temperature: a temperature for all rows or one temperature per row
+        :return: the sampled index, or an array with one sampled index per row
+        '''
+        single_row = np.ndim(preds) == 1
+        logits = apply_temperature(np.atleast_2d(preds), temperature)
+        if self._top_k is not None:
+            logits = top_k_filter(logits, self._top_k)
+        if self._top_p is not None:
+            logits = top_p_filter(logits, self._top_p)
+        indices = self._method(logits, self._rng)
+        return indices[0] if single_row else indices